@@ -0,0 +1,641 @@
+"""
+    Pruning of the user space per user, the step danny runs before computing any dot products. Walking the
+    postings of the entities a user visited in the entity-user dictionary gathers every user that shares an
+    entity with them:
+        * exact mode keeps all of these users (strict_prune_space)
+        * approximate mode heuristically scores how likely each of them is to be close to the user and only
+          keeps the user_cap best ones (approx_prune_space, or _approx_candidates_block for a whole block
+          of users at once)
+
+    The candidates of every user are kept in an n_users x n_users CSR matrix (see candidates_to_matrix).
+    These functions only read the dictionaries they are handed, the pool workers calling them are in
+    pool_workers and the batch functions driving them in dictionary_based_nn.
+
+    Hub entities:
+        Pruning a user costs the sum of the degrees of the entities they visited, so a handful of entities
+        visited by almost everyone (a homepage, a top song) make every user's candidates cover most of the
+        user base, and exact mode becomes quadratic again. A hub policy (see resolve_hub_policy) either skips
+        the entities visited by more than max_degree users while pruning, or only walks an evenly spaced
+        sample of max_degree of their users. The cut off can be given as a degree or as a percentile of the
+        entity degrees (which are summarized in the index meta when the index is built, see
+        supporting_functions.entity_hub_stats). Approximate mode can also weight each shared entity by its
+        inverse document frequency, so sharing a rare entity counts for more than sharing a popular one.
+
+    Important functions:
+        resolve_hub_policy
+        describe_hub_policy
+        find_affected_users
+"""
+import logging
+import numpy as np
+from scipy.sparse import csr_matrix
+
+DEFAULT_USER_CAP = 500
+MAX_USER_CAP = 1000
+SUM_SIGNIFICANCE = 10
+MAX_SCRATCH_ENTRIES = 2 ** 23
+DENSE_PAIR_RATIO = 4
+HUB_POLICIES = [None, "skip", "sample"]
+
+def _update_score(perc, number_of_entities_user_1, number_of_entities_user_2):
+    """
+        Heuristic used to determine how similar user_2's entity visitation pattern is to user_1's entity
+        visitation pattern. The main idea behind the function is to look at:
+            * how significant the current entity is in user_1's visitation history (the perc param)
+            * the difference in the number of entities user_1 and user_2 have visited
+
+        The more significant the current entity is in user_1's history, and the smaller the difference in the
+        number of entities visited between the two users, the more likely the two users are going to have
+        similar visitation patterns.
+
+        Note: This function is only called once we have established that user_1 and user_2 have both visited
+              the entity in question
+
+        Works element-wise when perc and number_of_entities_user_2 are arrays.
+
+        Params:
+            perc                    (float|arr) : percentage of user_1's total visits that are attributed to
+                                                  entity_a
+            number_of_entities_user_1     (int) : number of entities user_1 has visited
+            number_of_entities_user_2 (int|arr) : number of entities user_2 has visited
+
+        Returns:
+            float|arr : score to update how likely user_2's visitation pattern is close to user_1's
+                        visitation pattern
+
+    """
+    return perc / (abs(number_of_entities_user_1 - number_of_entities_user_2) + 1)
+
+def _gather_postings(user_id, user_entity_dict, entity_user_dict, hub_policy=None):
+    """
+        Walks the entities user_id has visited and gathers every posting (user_id) stored under those
+        entities in the entity-user dictionary. The slices of the entity-user indices array are concatenated
+        in one vectorized gather rather than one entity at a time.
+
+        With a hub policy, the postings of entities visited by more than max_degree users are either skipped
+        or sampled: every stride-th posting is gathered, with the stride picked so that at most max_degree
+        are, which keeps the sample the same from one run to the next.
+
+        Params:
+            user_id                 (int) : id of the user whose entities should be walked
+            user_entity_dict (csr_matrix) : user-entity dictionary in CSR form
+            entity_user_dict (csc_matrix) : entity-user dictionary in CSC form
+            hub_policy        (dict|None) : policy returned by resolve_hub_policy, None walks every posting
+
+        Returns:
+            tup : (array of user_ids sharing an entity with user_id, one entry per shared entity,
+                   array of the number of postings gathered per entity of user_id,
+                   array of user_id's counts per entity,
+                   array of the degree of each entity of user_id)
+    """
+    start = user_entity_dict.indptr[user_id]
+    end = user_entity_dict.indptr[user_id + 1]
+    entities = user_entity_dict.indices[start:end]
+    counts = user_entity_dict.data[start:end]
+
+    posting_starts = entity_user_dict.indptr[entities]
+    degrees = entity_user_dict.indptr[entities + 1] - posting_starts
+    posting_lengths = degrees
+    strides = None
+    if hub_policy is not None and hub_policy["policy"] is not None:
+        hubs = degrees > hub_policy["max_degree"]
+        if hub_policy["policy"] == "skip":
+            posting_lengths = np.where(hubs, 0, degrees)
+        elif hubs.any():
+            strides = np.where(hubs, -(-degrees // hub_policy["max_degree"]), 1)
+            posting_lengths = -(-degrees // strides)
+
+    if strides is None:
+        offsets = np.repeat(posting_starts - np.cumsum(posting_lengths) + posting_lengths, posting_lengths)
+        offsets += np.arange(len(offsets))
+    else:
+        firsts = np.repeat(np.cumsum(posting_lengths) - posting_lengths, posting_lengths)
+        offsets = np.repeat(posting_starts, posting_lengths) + \
+                  (np.arange(len(firsts)) - firsts) * np.repeat(strides, posting_lengths)
+
+    return (entity_user_dict.indices[offsets], posting_lengths, counts, degrees)
+
+def _round_scores(scores):
+    """
+        Rounds summed heuristic scores to float32 precision (kept as float64). Float64 sums of the same terms
+        added in a different order are at most a few ulps apart, far below float32's precision, so they
+        round to the same value and the users tied at a cut off do not depend on the summation order.
+
+        Params:
+            scores (arr) : summed scores
+
+        Returns:
+            arr : the rounded scores
+    """
+    return scores.astype(np.float32).astype(np.float64)
+
+def is_known_user(user_id, user_entity_dict):
+    """
+        Checks whether user_id has a (non empty) row in the user-entity dictionary
+
+        Params:
+            user_id                 (int) : id of the user to look up
+            user_entity_dict (csr_matrix) : user-entity dictionary in CSR form
+
+        Returns:
+            bool : True if the user has visited at least one entity
+    """
+    if user_id < 0 or user_id >= user_entity_dict.shape[0]:
+        return False
+
+    return user_entity_dict.indptr[user_id + 1] > user_entity_dict.indptr[user_id]
+
+def approx_prune_space(user_id, user_entity_dict, entity_user_dict, hub_policy=None):
+    """
+        Function called by the pool workers in order to establish which users are most likely to have close
+        entity visitation patterns to the user with the passed in user_id.
+
+        * The crux of what danny does is it throws out all users who do not share an entity with the user in
+          question.
+        * This function takes that one step further. Of the users who share an entity with the
+          user-in-question (user associated with the user_id) the function assigns a score as to how likely
+          each user's vistiation pattern is to the user-in-question's visitation pattern
+        * It only attempts to create this score per user if the user-in-question has had enough overall
+          visits––the benefits of the extra calculations to determine this score are not realized if the
+          user-in-question is not a high volume user
+
+        The gathered postings are deduplicated with np.unique, which sorts them, so a user with p postings
+        costs O(p*log(p)). The scores are then summed per user with np.bincount, so no per posting Python
+        work is done. When the hub policy asks for IDF weighting, each posting is also weighted by
+        log((1 + n_users) / (1 + degree of the entity)) + 1.
+
+        How a sum of floats rounds depends on the order of its terms, and the index walks a user's entities
+        in id order while the dictionary based baseline walked them in the order of the log, so the same
+        terms could add up to scores 1 ulp apart. Rounded as they are, those scores would split users the
+        baseline tied at the user_cap cut off (or tie users it split). The sums are therefore rounded to
+        float32 (see _round_scores), so a tie is a tie whatever order the terms were added in.
+
+        Params:
+            user_id                 (int) : id of the user whose list of potential close users is needed
+            user_entity_dict (csr_matrix) : user-entity dictionary, row user_id holds the entity ids user
+                                            has visited
+            entity_user_dict (csc_matrix) : entity-user dictionary, column entity_id holds the user ids that
+                                            have visited the entity
+            hub_policy        (dict|None) : policy returned by resolve_hub_policy, None walks every posting
+
+        Returns:
+            tup : (array of user_ids to look at when evaluating which users are closest to the user
+                   associated with the user_id, sorted by id,
+                   array of scores of how likely each user's visitation patterns is close to
+                   user-in-question's visitation patterns)
+    """
+    users, posting_lengths, counts, degrees = _gather_postings(user_id, user_entity_dict, entity_user_dict,
+                                                               hub_policy)
+    user_sum = counts.sum()
+    user_length = len(counts)
+
+    if user_sum > SUM_SIGNIFICANCE:
+        percs = np.repeat(counts / user_sum, posting_lengths)
+        other_lengths = user_entity_dict.indptr[users + 1] - user_entity_dict.indptr[users]
+        weights = _update_score(percs, user_length, other_lengths)
+    else:
+        weights = None
+
+    if hub_policy is not None and hub_policy["idf"]:
+        idf = np.repeat(np.log((1 + hub_policy["n_users"]) / (1 + degrees)) + 1, posting_lengths)
+        weights = idf if weights is None else weights * idf
+
+    users_to_look_at, inverse = np.unique(users, return_inverse=True)
+    scores = _round_scores(np.bincount(inverse, weights=weights, minlength=len(users_to_look_at)))
+
+    return (users_to_look_at, scores)
+
+def strict_prune_space(user_id, user_entity_dict, entity_user_dict, hub_policy=None):
+    """
+        Function called by the pool workers in order to establish which users have any chance of having close
+        entity visitation patterns to the user with the passed in user_id.
+
+        The crux of what danny does is it throws out all users who do not share an entity with the user in
+        question. It accomplishes this by looking at each entity a user has visited and then grabbing all
+        users who have visited these entities. If user_i has not shared an entity with a user_j, then there's
+        very little sense in looking at how close user_i and user_j are.
+
+        With a hub policy the users only sharing skipped (or unsampled) hub entities are left out, which is
+        what keeps the candidates from covering the whole user base.
+
+        Params:
+            user_id                 (int) : id of the user whose list of potential close users is needed
+            user_entity_dict (csr_matrix) : user-entity dictionary, row user_id holds the entity ids user
+                                            has visited
+            entity_user_dict (csc_matrix) : entity-user dictionary, column entity_id holds the user ids that
+                                            have visited the entity
+            hub_policy        (dict|None) : policy returned by resolve_hub_policy, None walks every posting
+
+        Returns:
+            arr : sorted array of user_ids to look at when evaluating which users are closest to the user
+                  associated with the user_id
+    """
+    users = _gather_postings(user_id, user_entity_dict, entity_user_dict, hub_policy)[0]
+
+    return np.unique(users)
+
+def cut_off_score(scores, n):
+    """
+        Finds the n-th largest score in O(len(scores)) with np.partition, instead of sorting all scores
+
+        Params:
+            scores (arr) : scores of the relevant users
+            n      (int) : rank of the score wanted, must be between 1 and len(scores)
+
+        Returns:
+            float : the n-th largest score
+    """
+    kth = len(scores) - n
+
+    return np.partition(scores, kth)[kth]
+
+def candidates_to_matrix(chunks, n_users):
+    """
+        Stitches the chunks returned by prune_users_batch into danny's candidates matrix, a CSR matrix where
+        row user_id holds, in its indices, the users user_id should be compared to. Users that were not
+        pruned have an empty row. In approximate mode the data holds the heuristic scores and each row is
+        ordered from the best score to the worst, otherwise the data only holds ones (int8).
+
+        Params:
+            chunks  (arr) : each element is a tuple (array of user_ids, array of lengths, array of
+                            candidates, array of scores or None), the chunks can come in any order but no
+                            user_id can be in more than one of them
+            n_users (int) : number of users (rows) in the index
+
+        Returns:
+            csr_matrix : n_users x n_users candidates matrix
+    """
+    row_lengths = np.zeros(n_users, dtype=np.int64)
+    for user_ids, lengths, _, _ in chunks:
+        row_lengths[user_ids] = lengths
+
+    indptr = np.zeros(n_users + 1, dtype=np.int64)
+    np.cumsum(row_lengths, out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    with_scores = bool(chunks) and chunks[0][3] is not None
+    data = np.empty(indptr[-1]) if with_scores else np.ones(indptr[-1], dtype=np.int8)
+    for user_ids, lengths, candidates, scores in chunks:
+        offsets = np.repeat(indptr[user_ids] - np.cumsum(lengths) + lengths, lengths)
+        offsets += np.arange(len(offsets))
+        indices[offsets] = candidates
+        if with_scores:
+            data[offsets] = scores
+
+    return csr_matrix((data, indices, indptr), shape=(n_users, n_users))
+
+def user_tuples_to_candidates(user_tuples, n_users):
+    """
+        Converts a list of (user_id, list of user_ids to compare user to) tuples, the format
+        prune_space_batch used to return, into danny's candidates matrix (see candidates_to_matrix)
+
+        Params:
+            user_tuples (arr) : each element is a tuple (user_id, list of user_ids)
+            n_users     (int) : number of users (rows) in the index
+
+        Returns:
+            csr_matrix : n_users x n_users candidates matrix
+    """
+    user_tuples = sorted({user_tuple[0]: user_tuple for user_tuple in user_tuples}.values(),
+                         key=lambda user_tuple: user_tuple[0])
+    chunk = (np.array([user_tuple[0] for user_tuple in user_tuples], dtype=np.int64),
+             np.array([len(user_tuple[1]) for user_tuple in user_tuples], dtype=np.int64),
+             np.concatenate([np.asarray(user_tuple[1], dtype=np.int32) for user_tuple in user_tuples])
+             if user_tuples else np.empty(0, dtype=np.int32),
+             None)
+
+    return candidates_to_matrix([chunk], n_users)
+
+def upper_candidates(user_ids, candidates, candidates_matrix):
+    """
+        The similarity of two users is symmetric, and exact mode candidates are too (user_i shares an entity
+        with user_j exactly when user_j shares one with user_i), so each pair of users only needs one dot
+        product. The pair is left to the user with the lower id, unless the other user is not being computed
+        at all (its row of the candidates matrix is empty), in which case nobody else would compute it.
+
+        Params:
+            user_ids                  (arr) : user of each (user, candidate) pair
+            candidates                (arr) : candidate of each pair
+            candidates_matrix  (csr_matrix) : candidates matrix the pairs come from
+
+        Returns:
+            arr : boolean mask of the pairs user_ids computes
+    """
+    candidates = np.asarray(candidates, dtype=np.int64)
+    not_computed = candidates_matrix.indptr[candidates + 1] == candidates_matrix.indptr[candidates]
+
+    return (candidates >= user_ids) | not_computed
+
+def _sum_pair_scores(posting_rows, users, weights, n_rows, n_users):
+    """
+        Sums the heuristic scores of the gathered postings per (row, user) pair, adding the postings in the
+        order they were gathered, as np.bincount does in approx_prune_space. When the pairs are dense enough
+        the scores are added straight into a dense row per user, otherwise the postings are sorted by pair
+        (stable, so the order of the additions is kept) and summed with np.add.reduceat.
+
+        Params:
+            posting_rows (arr) : row of the block each posting was gathered for, ascending
+            users        (arr) : user_id of each posting
+            weights      (arr) : score of each posting
+            n_rows       (int) : number of rows in the block
+            n_users      (int) : number of users in the index
+
+        Returns:
+            tup : (array of rows, array of user_ids, array of summed scores) of every pair, by row
+    """
+    if n_rows * n_users <= min(MAX_SCRATCH_ENTRIES, DENSE_PAIR_RATIO * len(users)):
+        scores = np.bincount(posting_rows * n_users + users, weights=weights,
+                             minlength=n_rows * n_users).reshape(n_rows, n_users)
+        pair_rows, pair_users = np.nonzero(scores)
+
+        return (pair_rows, pair_users, scores[pair_rows, pair_users])
+
+    keys = posting_rows * n_users + users
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.empty(0, dtype=np.int64)
+    scores = np.add.reduceat(weights[order], starts) if len(keys) else np.empty(0)
+    keys = keys[starts]
+
+    return (keys // n_users, keys % n_users, scores)
+
+def _approx_candidates_block(user_ids, user_entity_dict, entity_user_dict, user_cap=DEFAULT_USER_CAP):
+    """
+        Block form of approx_prune_space followed by the user_cap cut off of the user_functions. The
+        postings of every entity visited by a user in the block are gathered in one go, scored with
+        _update_score and summed per (user, other user) pair by _sum_pair_scores. The sums are rounded like
+        approx_prune_space's, so the scores, and therefore the ties at the cut off, come out exactly the
+        same. Rows are handled in passes of about MAX_SCRATCH_ENTRIES postings.
+
+        Per row the users scoring at least the user_cap-th best score are kept, ties included.
+
+        Params:
+            user_ids                (arr) : block of users whose candidates are wanted
+            user_entity_dict (csr_matrix) : user-entity dictionary in CSR form
+            entity_user_dict (csc_matrix) : entity-user dictionary in CSC form
+            user_cap                (int) : number of candidates wanted per user
+
+        Returns:
+            csr_matrix : row i holds ones at the candidates of user_ids[i]
+    """
+    #pylint: disable=too-many-locals
+    n_users = user_entity_dict.shape[0]
+    all_lengths = np.diff(user_entity_dict.indptr)
+    block = user_entity_dict[user_ids]
+    block_rows = np.repeat(np.arange(len(user_ids)), np.diff(block.indptr))
+    row_postings = np.cumsum(np.bincount(block_rows, weights=np.diff(entity_user_dict.indptr)[block.indices],
+                                         minlength=len(user_ids)))
+
+    candidate_rows = []
+    candidate_users = []
+    start = 0
+    while start < len(user_ids):
+        postings_before = row_postings[start - 1] if start else 0
+        end = max(start + 1, np.searchsorted(row_postings, postings_before + MAX_SCRATCH_ENTRIES, "right"))
+        rows_block = block[start:end]
+        n_rows = rows_block.shape[0]
+        lengths = np.diff(rows_block.indptr)
+        sums = np.asarray(rows_block.sum(axis=1)).ravel()
+        rows = np.repeat(np.arange(n_rows), lengths)
+
+        posting_starts = entity_user_dict.indptr[rows_block.indices]
+        posting_lengths = entity_user_dict.indptr[rows_block.indices + 1] - posting_starts
+        offsets = np.repeat(posting_starts - np.cumsum(posting_lengths) + posting_lengths, posting_lengths)
+        offsets += np.arange(len(offsets))
+        users = entity_user_dict.indices[offsets].astype(np.int64)
+        posting_rows = np.repeat(rows, posting_lengths)
+
+        percs = np.repeat(rows_block.data / np.maximum(sums[rows], 1), posting_lengths)
+        weights = np.where(sums[posting_rows] > SUM_SIGNIFICANCE,
+                           _update_score(percs, lengths[posting_rows], all_lengths[users]), 1.0)
+
+        pair_rows, pair_users, scores = _sum_pair_scores(posting_rows, users, weights, n_rows, n_users)
+        scores = _round_scores(scores)
+
+        cut_off_values = np.full(n_rows, -np.inf)
+        capped = np.bincount(pair_rows, minlength=n_rows) > user_cap
+        if capped.any():
+            in_capped = np.flatnonzero(capped[pair_rows])
+            order = in_capped[np.lexsort((-scores[in_capped], pair_rows[in_capped]))]
+            row_starts = np.searchsorted(pair_rows[order], np.flatnonzero(capped))
+            cut_off_values[capped] = scores[order[row_starts + user_cap - 1]]
+
+        keep = scores >= cut_off_values[pair_rows]
+        candidate_rows.append(pair_rows[keep] + start)
+        candidate_users.append(pair_users[keep])
+        start = end
+
+    candidate_rows = np.concatenate(candidate_rows) if candidate_rows else np.empty(0, dtype=np.int64)
+    candidate_users = np.concatenate(candidate_users) if candidate_users else np.empty(0, dtype=np.int64)
+
+    return csr_matrix((np.ones(len(candidate_rows)), (candidate_rows, candidate_users)),
+                      shape=(len(user_ids), n_users))
+
+def approx_mask_products(products, user_ids, user_entity_dict, entity_user_dict, user_cap=DEFAULT_USER_CAP):
+    """
+        Restricts a block of similarities from block_products to the users approximate mode would have
+        compared each user to. A row with user_cap entries or less already holds exactly the users
+        approx_prune_space would keep, so only the rows with more entries are scored and cut by
+        _approx_candidates_block.
+
+        Params:
+            products         (csr_matrix) : row i holds the similarities of user_ids[i] to every user it
+                                            shares an entity with
+            user_ids                (arr) : block of users of the rows of products
+            user_entity_dict (csr_matrix) : user-entity dictionary in CSR form
+            entity_user_dict (csc_matrix) : entity-user dictionary in CSC form
+            user_cap                (int) : number of candidates wanted per user
+
+        Returns:
+            csr_matrix : products with the entries of users that are not candidates removed
+    """
+    n_users = products.shape[1]
+    capped = np.diff(products.indptr) > user_cap
+    if not capped.any():
+        return products
+
+    candidates = _approx_candidates_block(user_ids[capped], user_entity_dict, entity_user_dict, user_cap)
+    candidate_rows = np.repeat(np.arange(candidates.shape[0]), np.diff(candidates.indptr))
+    candidate_keys = candidate_rows * n_users + candidates.indices
+
+    entry_rows = np.repeat(np.arange(products.shape[0]), np.diff(products.indptr))
+    in_capped = capped[entry_rows]
+    capped_positions = np.cumsum(capped) - 1
+    entry_keys = capped_positions[entry_rows[in_capped]] * n_users + products.indices[in_capped]
+
+    keep = ~in_capped
+    keep[in_capped] = np.isin(entry_keys, candidate_keys)
+    products = products.copy()
+    products.data[~keep] = 0
+    products.eliminate_zeros()
+
+    return products
+
+def find_affected_users(changed_users, user_entity_dict, entity_user_dict):
+    """
+        Finds the users whose nearest neighbors can change when the visitation patterns of changed_users
+        change (e.g. after index_update.update_index). A user's similarities only depend on the users they
+        share an entity with, so these are the changed users plus every user found in the entity-user
+        postings of the entities the changed users visited.
+
+        Params:
+            changed_users           (arr) : user_ids whose rows of the index changed
+            user_entity_dict (csr_matrix) : user-entity dictionary in CSR form, after the change
+            entity_user_dict (csc_matrix) : entity-user dictionary in CSC form, after the change
+
+        Returns:
+            arr : sorted user_ids whose nearest neighbors need to be recomputed
+    """
+    changed_users = np.asarray(changed_users, dtype=np.int64)
+    entities = np.unique(user_entity_dict[changed_users].indices)
+    sharing_users = entity_user_dict[:, entities].indices
+
+    return np.union1d(changed_users, sharing_users)
+
+def resolve_hub_policy(entity_user_dict, policy=None, max_degree=None, percentile=None, idf=False):
+    """
+        Turns a hub policy request into the policy the pruning workers follow (see "Hub entities" at the top
+        of this module), working out the degree cut off and how much of the index it affects.
+
+        Params:
+            entity_user_dict (csc_matrix) : entity-user dictionary in CSC form
+            policy             (str|None) : one of HUB_POLICIES, "skip" or "sample" the postings of hub
+                                            entities, None walks every posting
+            max_degree         (int|None) : entities visited by more than max_degree users are hubs
+            percentile       (float|None) : instead of max_degree, the percentile of the entity degrees above
+                                            which entities are hubs, e.g. 99.9
+            idf                    (bool) : weight the approximate scores by the entities' inverse document
+                                            frequency
+
+        Returns:
+            dict | None : policy, max_degree, percentile, idf, n_users, hub_entities (number of hubs),
+                          hub_postings and hub_work (share of the postings, and of the pruning work, sum of
+                          squared degrees, that belongs to hubs). None when nothing is to be changed
+    """
+    if policy not in HUB_POLICIES:
+        raise ValueError("hub policy must be one of {}".format(HUB_POLICIES))
+
+    if policy is not None and (max_degree is None) == (percentile is None):
+        raise ValueError("a hub policy needs either a max_degree or a percentile")
+
+    if max_degree is not None and max_degree < 1:
+        raise ValueError("max_degree must be a positive int")
+
+    if percentile is not None and not 0 < percentile <= 100:
+        raise ValueError("percentile must be between 0 and 100")
+
+    if policy is None and not idf:
+        return None
+
+    degrees = np.diff(entity_user_dict.indptr).astype(np.int64)
+    if policy is not None and percentile is not None:
+        max_degree = max(int(np.percentile(degrees, percentile)), 1) if len(degrees) else 1
+
+    hubs = degrees > max_degree if policy is not None else np.zeros(len(degrees), dtype=bool)
+    hub_policy = {"policy": policy,
+                  "max_degree": int(max_degree) if policy is not None else None,
+                  "percentile": percentile if policy is not None else None,
+                  "idf": idf,
+                  "n_users": entity_user_dict.shape[0],
+                  "hub_entities": int(hubs.sum()),
+                  "hub_postings": float(degrees[hubs].sum() / max(degrees.sum(), 1)),
+                  "hub_work": float((degrees[hubs] ** 2).sum() / max((degrees ** 2).sum(), 1))}
+    logging.info("hub policy: %s", describe_hub_policy(hub_policy))
+
+    return hub_policy
+
+def describe_hub_policy(hub_policy):
+    """
+        Describes a hub policy returned by resolve_hub_policy in one line, for reporting which one was used
+
+        Params:
+            hub_policy (dict|None) : policy returned by resolve_hub_policy
+
+        Returns:
+            str : description of the policy
+    """
+    if hub_policy is None:
+        return "none, every posting is walked"
+
+    if hub_policy["policy"] is None:
+        description = "every posting is walked"
+    else:
+        cut_off = "more than {} users".format(hub_policy["max_degree"])
+        if hub_policy["percentile"] is not None:
+            cut_off += " (the {}th percentile of entity degrees)".format(hub_policy["percentile"])
+        action = "skip" if hub_policy["policy"] == "skip" else \
+                 "sample {} users of".format(hub_policy["max_degree"])
+        description = "{} entities visited by {}, {} hub entities holding {:.1%} of the postings and " \
+                      "{:.1%} of the pruning work".format(action, cut_off, hub_policy["hub_entities"],
+                                                   hub_policy["hub_postings"], hub_policy["hub_work"])
+
+    if hub_policy["idf"]:
+        description += ", approximate scores weighted by IDF"
+
+    return description
+
+def walk_costs(user_ids, rows, column_degrees):
+    """
+        Estimates the cost of each user as the number of postings walked for it, the sum of the degrees of
+        the columns (entities) in its row, plus one for the fixed cost of a user. Used to schedule the pool
+        workers (see scheduler.schedule_chunks).
+
+        Params:
+            user_ids        (arr) : users whose cost is wanted
+            rows     (csr_matrix) : user-entity dictionary or matrix in CSR form
+            column_degrees  (arr) : number of users per entity
+
+        Returns:
+            arr : estimated cost of each user
+    """
+    block = rows[user_ids]
+    block_rows = np.repeat(np.arange(len(user_ids)), np.diff(block.indptr))
+
+    return np.bincount(block_rows, weights=column_degrees[block.indices], minlength=len(user_ids)) + 1
+
+def symmetric_row_lengths(user_ids, candidates):
+    """
+        Number of candidates each user computes the similarity of in symmetric mode (see upper_candidates),
+        used as its cost when scheduling. Users are handled in passes of about MAX_SCRATCH_ENTRIES
+        candidates, so the whole candidates matrix never has to be expanded at once.
+
+        Params:
+            user_ids         (arr) : sorted users whose candidates are being computed
+            candidates (csr_matrix) : candidates matrix
+
+        Returns:
+            arr : number of candidates per user
+    """
+    row_candidates = np.cumsum(np.diff(candidates.indptr)[user_ids])
+    lengths = np.empty(len(user_ids), dtype=np.int64)
+    start = 0
+    while start < len(user_ids):
+        candidates_before = row_candidates[start - 1] if start else 0
+        end = max(start + 1,
+                  np.searchsorted(row_candidates, candidates_before + MAX_SCRATCH_ENTRIES, "right"))
+        block = candidates[user_ids[start:end]]
+        rows = np.repeat(np.arange(end - start), np.diff(block.indptr))
+        upper = upper_candidates(user_ids[start:end][rows], block.indices, candidates)
+        lengths[start:end] = np.bincount(rows[upper], minlength=end - start)
+        start = end
+
+    return lengths
+
+def walked_degrees(entity_user_dict, hub_policy=None):
+    """
+        Number of postings pruning walks per entity, i.e. the entity degrees once the hub policy has skipped
+        or sampled the hub entities
+
+        Params:
+            entity_user_dict (csc_matrix) : entity-user dictionary in CSC form
+            hub_policy        (dict|None) : policy returned by resolve_hub_policy
+
+        Returns:
+            arr : number of postings walked per entity
+    """
+    degrees = np.diff(entity_user_dict.indptr).astype(np.int64)
+    if hub_policy is not None and hub_policy["policy"] == "skip":
+        degrees[degrees > hub_policy["max_degree"]] = 0
+    elif hub_policy is not None and hub_policy["policy"] == "sample":
+        degrees = np.minimum(degrees, hub_policy["max_degree"])
+
+    return degrees
@@ -14,13 +14,34 @@
         3. matrix      - builds the needed user_entity_matrix from the user_entity_dictionary
         4. nn          - by default will compute the nearest neighbors for all users in approximate mode.
                          The number of nearest neighbors can either be a positive int below 1000, or -1 --
-                         indicates no cap and to use the smart, but comprehensive mode of danny
+                         indicates no cap and to use the smart, but comprehensive mode of danny. Pass
+                         --engine=blocked to compute dot products one block of users at a time, and
+                         --hub_policy to skip or sample the entities almost every user visited while pruning.
+                         In exact mode --symmetric computes each pair of users once instead of twice.
+                         --fused prunes and computes dot products in a single pool. --shard=i/n only
+                         computes the i-th of n shards of the users, so the job can be split across
+                         machines, and writes them to their own part of the results. --checkpoint saves
+                         the users completed so far every few minutes, and --resume picks an interrupted
+                         run back up from them
         5. build_index - builds all three of the needed data structures for danny to figure out nearest
                          neighbors from a properly formatted log file. Essentially runs the "dictionary" and
                          then "matrix" option.
         6. batch       - computes nearest neighbors for each user from a properly formatted log file.
                          Essentially runs the "dictionary", "matrix" and finally "nn" options. Important to
                          read how to configure the "nn" to your liking.
+        7. convert     - converts a csv log file into a binary edge log (.npy), which every option that takes
+                         a --log_file accepts and memory-maps instead of parsing the csv again
+        8. update      - adds the logs in --log_file to the index already built in the output directory,
+                         instead of rebuilding the index from every log. If the index was built from a log
+                         reindexed with the "re_index" option, --log_file must hold the original ids, which
+                         are mapped through the saved reverse indexes. Follow it with the "nn" option and
+                         --changed_users_file=<output directory>/updated_users.npy to only refresh the
+                         neighbors of the users the update affected
+        9. serve       - keeps the index in the output directory memory-mapped and answers nearest neighbor
+                         queries over HTTP (see query_server.py) until interrupted. Send it SIGHUP or POST
+                         /reload once a rebuild or update has finished to start serving the new index
+        10. merge      - merges the parts written by every shard of a job run with --shard, once they are
+                         gathered in <output directory>/similarity_scores_parts/, into the similarity scores
 
     danny will take care of the file storage for you if you want. It will save all data in a folder called
     "output_data", so make sure that exists in the directory you are running this script from. If you have
@@ -32,54 +53,217 @@
 """
 import argparse
 import logging
+import re
 import supporting_functions
+import edge_log
+import index_update
+import candidate_pruning
 import dictionary_based_nn
+import sharding
+import query_server
+
+def _hub_policy(args, entity_user_dict_file):
+    """
+        Resolves the hub policy asked for on the command line against the entity-user dictionary, and
+        reports it
+
+        Params:
+            args                   (Namespace) : parsed command line arguments
+            entity_user_dict_file        (str) : path prefix of the entity-user dictionary
+
+        Returns:
+            dict | None : policy returned by candidate_pruning.resolve_hub_policy
+    """
+    if args.hub_policy is None and not args.idf:
+        return None
+
+    entity_user_dict = supporting_functions.read_index_file(entity_user_dict_file)
+    hub_policy = candidate_pruning.resolve_hub_policy(entity_user_dict, args.hub_policy, args.hub_degree,
+                                                      args.hub_percentile, args.idf)
+    print("hub policy: {}".format(candidate_pruning.describe_hub_policy(hub_policy)))
+
+    return hub_policy
+
+def _shard(value):
+    """
+        Parses the --shard argument
+
+        Params:
+            value (str) : "i/n", the i-th of n shards, i counting from 1
+
+        Returns:
+            tup : (i, n)
+    """
+    match = re.fullmatch(r"(\d+)/(\d+)", value)
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError("shard must be i/n with 1 <= i <= n, e.g. 2/8")
+
+    return (int(match.group(1)), int(match.group(2)))
 
 def main():
     #pylint: disable=too-many-branches, too-many-statements, missing-docstring
     parser = argparse.ArgumentParser()
-    parser.add_argument("--mode", choices=["re_index", "dictionary", "matrix", "nn", "build_index", "batch"],
+    parser.add_argument("--mode", choices=["re_index", "dictionary", "matrix", "nn", "build_index", "batch",
+                                           "convert", "update", "serve", "merge"],
                         const="index", nargs='?', help="what operation should danny perform")
-    parser.add_argument("--log_file", nargs='?', help="csv containing logs to be processed")
-    parser.add_argument("--user_entity_dict_file", nargs='?', help="pickle file holding \
-                        user_entity_dictionary")
-    parser.add_argument("--entity_user_dict_file", nargs='?', help="pickle file holding \
-                        entity_user_dictionary")
-    parser.add_argument("--user_entity_matrix_file", nargs='?', help="pickle file holding \
-                         entity_user_matrix")
+    parser.add_argument("--log_file", nargs='?', help="csv or binary edge log (.npy) containing logs to be \
+                        processed")
+    parser.add_argument("--with_counts", action="store_true", help="convert only, add a count column to the \
+                        binary edge log, summing repeated user, entity pairs")
+    parser.add_argument("--user_entity_dict_file", nargs='?', help="path prefix of the .npy files (or a \
+                        pickle file) holding user_entity_dictionary, e.g. output_data/user_entity_dict")
+    parser.add_argument("--entity_user_dict_file", nargs='?', help="path prefix of the .npy files (or a \
+                        pickle file) holding entity_user_dictionary, e.g. output_data/entity_user_dict")
+    parser.add_argument("--user_entity_matrix_file", nargs='?', help="path prefix of the .npy files (or a \
+                         pickle file) holding user_entity_matrix, e.g. output_data/user_entity_matrix")
     parser.add_argument("--users_to_check_file", nargs='?', help="users whose similarities are required")
+    parser.add_argument("--changed_users_file", nargs='?', help="nn only, .npy file of users whose rows \
+                        changed (e.g. output_data/updated_users.npy written by --mode update), only the \
+                        users affected by them are recomputed and patched into the saved similarity scores")
+    parser.add_argument("--save_candidates", action="store_true", help="nn only, keep the pruned candidates \
+                        in the output directory (candidates_*.npy) so later runs can skip pruning")
+    parser.add_argument("--candidates_file", nargs='?', help="nn only, path prefix of candidates kept by \
+                        --save_candidates, e.g. output_data/candidates. Skips pruning, --user_cap can only \
+                        be lowered from the one they were pruned with")
+    parser.add_argument("--hub_policy", choices=["skip", "sample"], nargs='?', help="nn and batch only, skip \
+                        the entities visited by more users than --hub_degree or --hub_percentile while \
+                        pruning, or only walk an evenly spaced sample of that many of their users")
+    parser.add_argument("--hub_degree", type=int, nargs='?', help="number of users above which an entity is \
+                        a hub")
+    parser.add_argument("--hub_percentile", type=float, nargs='?', help="percentile of the entity degrees \
+                        above which an entity is a hub, e.g. 99.9 (see hub_stats in index_meta.pickle)")
+    parser.add_argument("--idf", action="store_true", help="nn and batch only, weight the approximate mode \
+                        scores by each entity's inverse document frequency")
+    parser.add_argument("--symmetric", action="store_true", help="nn and batch only, exact mode \
+                        (--user_cap=-1) only, compute the similarity of each pair of users once and hand \
+                        it to both users")
+    parser.add_argument("--fused", action="store_true", help="nn and batch only, prune and compute dot \
+                        products in one pool, so the candidates never leave the workers (can't be combined \
+                        with --save_candidates, --candidates_file or --symmetric)")
+    parser.add_argument("--shard", type=_shard, nargs='?', help="nn only, i/n: only compute the i-th of n \
+                        shards of the users (i counting from 1) and write them to \
+                        similarity_scores_parts/part_<i>_of_<n>/ in the output directory (always in the \
+                        columnar format), to be combined with --mode merge")
+    parser.add_argument("--shard_scheme", choices=sharding.SHARD_SCHEMES, default="range", \
+                        help="how users are split into shards, contiguous ranges of user ids (range, each \
+                        machine reads only its slice of the user-entity dictionary) or scattered by a hash \
+                        of their id (hash, evens the work out when heavy users are bunched up in id order)")
+    parser.add_argument("--checkpoint", action="store_true", help="nn and batch only, columnar output \
+                        only, stream the similarity scores to similarity_scores_checkpoints/ in the output \
+                        directory as users are completed, and only merge them into similarity_scores/ at the \
+                        end, so an interrupted run can be resumed")
+    parser.add_argument("--resume", action="store_true", help="nn and batch only, rerun an interrupted \
+                        --checkpoint, --output_format=sharded or --shard run with the same arguments, only \
+                        computing the users its checkpoints don't hold yet")
     parser.add_argument("--dense", action="store_true", help="the user_entity matrix should be dense or not")
     parser.add_argument("--user_cap", type=int, nargs='?', help="cap on how many user similarity scores \
                         should be calculated, if -1 then no cap is used")
     parser.add_argument("--processes", type=int, nargs='?', help="number of processes to use when finding \
                         nearest neighbors")
+    parser.add_argument("--engine", choices=["rowwise", "blocked"], default="rowwise", help="how dot \
+                        products are computed in the nn stage, one mat-vec per user (rowwise) or one sparse \
+                        product per block of users (blocked)")
+    parser.add_argument("--block_size", type=int, nargs='?', help="number of users per block for the \
+                        blocked engine")
+    parser.add_argument("--top_k", type=int, nargs='?', help="blocked engine only, number of most similar \
+                        users to keep per user")
+    parser.add_argument("--thresh", type=float, nargs='?', help="blocked engine only, minimum similarity for \
+                        a user to be kept")
+    parser.add_argument("--output_format", choices=["pickle", "columnar", "sharded"], default="pickle", \
+                        help="save similarity scores as a pickled dictionary (pickle, \
+                        similarity_scores.pickle as before), as a compact directory of .npy arrays \
+                        (columnar) or as columnar shards written while the users are computed (sharded)")
+    parser.add_argument("--quantize", action="store_true", help="columnar and sharded output only, store \
+                        similarity scores as uint16 instead of float32")
+    parser.add_argument("--start_method", choices=["fork", "spawn", "forkserver"], nargs='?', help="how \
+                        the nn worker processes are started, defaults to the platform's default")
     parser.add_argument("--one_hot", action="store_true", help="should the matrix be constructed from count \
                         vectors or one-hot encoded vectors")
     parser.add_argument("--output_dir", nargs='?', help="where all files should be outputted to")
+    parser.add_argument("--host", nargs='?', help="serve only, address to listen on, defaults to 127.0.0.1")
+    parser.add_argument("--port", type=int, nargs='?', help="serve only, port to listen on, defaults to 8700")
+    parser.add_argument("--workers", type=int, nargs='?', help="serve only, number of threads answering \
+                        queries, defaults to 8")
     parser.add_argument("--verbose", action="store_true", help="print out timings for each step of the \
                         process")
-    
+
     args = parser.parse_args()
 
     user_cap = args.user_cap if args.user_cap else 500
     sparse = False if args.dense else True
     processes = args.processes if args.processes else None
-    
+    block_size = args.block_size if args.block_size else dictionary_based_nn.DEFAULT_BLOCK_SIZE
+    thresh = args.thresh if args.thresh is not None else -1.0
+
     if args.verbose:
         logging.basicConfig(level=logging.INFO)
 
     if args.mode == "re_index":
         if args.log_file:
             if args.output_dir:
-                supporting_functions.reindex_log_file(args.log_file, output_dir=args.output_dir)
-                print("saved re-indexed log file and one way mapping to {}".format(args.output_dir))
+                supporting_functions.reindex_log_file(args.log_file,
+                                                      output_dir=args.output_dir,
+                                                      n_processes=processes)
+                print("saved re-indexed log file and reverse index arrays to {}".format(args.output_dir))
             else:
-                supporting_functions.reindex_log_file(args.log_file)
-                print("saved re-indexed log file and one way mapping to \"output_data\"")
+                supporting_functions.reindex_log_file(args.log_file, n_processes=processes)
+                print("saved re-indexed log file and reverse index arrays to \"output_data\"")
         else:
             raise ValueError("need log file to re-index")
 
 
+    if args.mode == "convert":
+        if args.log_file:
+            if args.output_dir:
+                edge_log.convert_log_file(args.log_file,
+                                          with_counts=args.with_counts,
+                                          n_processes=processes,
+                                          output_dir=args.output_dir)
+                print("saved binary edge log to {}".format(args.output_dir))
+            else:
+                edge_log.convert_log_file(args.log_file,
+                                          with_counts=args.with_counts,
+                                          n_processes=processes)
+                print("saved binary edge log to \"output_data\"")
+        else:
+            raise ValueError("need log file to convert into a binary edge log")
+
+    if args.mode == "update":
+        if args.log_file:
+            one_hot = True if args.one_hot else None
+            if args.output_dir:
+                index_update.update_index(args.log_file,
+                                          one_hot=one_hot,
+                                          n_processes=processes,
+                                          output_dir=args.output_dir)
+                print("updated index in {}".format(args.output_dir))
+            else:
+                index_update.update_index(args.log_file,
+                                          one_hot=one_hot,
+                                          n_processes=processes)
+                print("updated index in \"output_data\"")
+        else:
+            raise ValueError("need log file to update the index with")
+
+    if args.mode == "serve":
+        host = args.host if args.host else query_server.DEFAULT_HOST
+        port = args.port if args.port else query_server.DEFAULT_PORT
+        workers = args.workers if args.workers else query_server.DEFAULT_WORKERS
+        print("serving nearest neighbor queries on {}:{}".format(host, port))
+        if args.output_dir:
+            query_server.serve(output_dir=args.output_dir, host=host, port=port, n_workers=workers)
+        else:
+            query_server.serve(host=host, port=port, n_workers=workers)
+
+    if args.mode == "merge":
+        quantize = True if args.quantize else None
+        if args.output_dir:
+            sharding.merge_shard_parts(output_dir=args.output_dir, quantize=quantize)
+            print("merged similarity score parts into {}".format(args.output_dir))
+        else:
+            sharding.merge_shard_parts(quantize=quantize)
+            print("merged similarity score parts into \"output_data\"")
+
     if args.mode == "dictionary":
         if args.log_file:
             if args.output_dir:
@@ -141,44 +325,51 @@ def main():
             supporting_functions.create_matrix(sparse=sparse)
             print("saved matrix to \"output_data\"")
 
+    # keyword arguments shared by every nn and batch call, output_dir only when given so the default applies
+    nn_kwargs = {"sparse": sparse,
+                 "user_cap": user_cap,
+                 "n_processes": processes,
+                 "engine": args.engine,
+                 "block_size": block_size,
+                 "top_k": args.top_k,
+                 "thresh": thresh,
+                 "output_format": args.output_format,
+                 "quantize": args.quantize,
+                 "start_method": args.start_method,
+                 "symmetric": args.symmetric,
+                 "fused": args.fused,
+                 "checkpoint": args.checkpoint,
+                 "resume": args.resume}
+    if args.output_dir:
+        nn_kwargs["output_dir"] = args.output_dir
+    output_dir = args.output_dir if args.output_dir else dictionary_based_nn.DEFAULT_DIR
+    saved_to = args.output_dir if args.output_dir else "\"output_data\""
+
     if args.mode == "nn":
+        nn_kwargs.update(changed_users=args.changed_users_file,
+                         save_candidates=args.save_candidates,
+                         candidates_file=args.candidates_file,
+                         shard=args.shard,
+                         shard_scheme=args.shard_scheme)
         if args.user_entity_dict_file and args.entity_user_dict_file and args.user_entity_matrix_file:
+            hub_policy = _hub_policy(args, args.entity_user_dict_file)
             file_1 = args.user_entity_dict_file
             file_2 = args.entity_user_dict_file
             file_3 = args.user_entity_matrix_file
-            
+
             if args.users_to_check_file:
                 file_names = [file_1, file_2, file_3, args.users_to_check_file]
             else:
                 file_names = [file_1, file_2, file_3]
 
-            if args.output_dir:
-                dictionary_based_nn.get_nearest_neighbors_batch(input_type="files",
-                                                                file_names=file_names,
-                                                                sparse=sparse,
-                                                                user_cap=user_cap,
-                                                                n_processes=processes,
-                                                                output_dir=args.output_dir)
-                print("saved similarity scores to {}".format(args.output_dir))
-            else:
-                dictionary_based_nn.get_nearest_neighbors_batch(input_type="files",
-                                                                file_names=file_names,
-                                                                sparse=sparse,
-                                                                user_cap=user_cap,
-                                                                n_processes=processes)
-                print("saved similarity scores to \"output_data\"")
+            dictionary_based_nn.get_nearest_neighbors_batch(input_type="files",
+                                                            file_names=file_names,
+                                                            hub_policy=hub_policy,
+                                                            **nn_kwargs)
         else:
-            if args.output_dir:
-                dictionary_based_nn.get_nearest_neighbors_batch(sparse=sparse,
-                                                                user_cap=user_cap,
-                                                                n_processes=processes,
-                                                                output_dir=args.output_dir)
-                print("saved similarity scores to {}".format(args.output_dir))
-            else:
-                dictionary_based_nn.get_nearest_neighbors_batch(sparse=sparse,
-                                                                user_cap=user_cap,
-                                                                n_processes=processes)
-                print("saved similarity scores to \"output_data\"")
+            hub_policy = _hub_policy(args, output_dir + "entity_user_dict")
+            dictionary_based_nn.get_nearest_neighbors_batch(hub_policy=hub_policy, **nn_kwargs)
+        print("saved similarity scores to {}".format(saved_to))
 
     if args.mode == "batch":
         if args.log_file:
@@ -203,17 +394,9 @@ def main():
             supporting_functions.create_matrix(sparse=sparse)
             print("saved matrix to \"output_data\"")
 
-        if args.output_dir:
-            dictionary_based_nn.get_nearest_neighbors_batch(sparse=sparse,
-                                                            user_cap=user_cap,
-                                                            n_processes=processes,
-                                                            output_dir=args.output_dir)
-            print("saved similarity scores to {}".format(args.output_dir))
-        else:
-            dictionary_based_nn.get_nearest_neighbors_batch(sparse=sparse,
-                                                            user_cap=user_cap,
-                                                            n_processes=processes)
-            print("saved similarity scores to \"output_data\"")
+        hub_policy = _hub_policy(args, output_dir + "entity_user_dict")
+        dictionary_based_nn.get_nearest_neighbors_batch(hub_policy=hub_policy, **nn_kwargs)
+        print("saved similarity scores to {}".format(saved_to))
 
 if __name__ == '__main__':
     main()
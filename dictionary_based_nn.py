@@ -4,12 +4,12 @@
     multiprocessing library, but these functions could be easily ported over to a Map Reduce job.
 
     The three needed data structures are:
-        1. user-entity dictionary: key - user_id | value - dictionary
-            sub dictionary: key - entity_id | value - either total visits by user_id to entity_id
-                                                      or 1 for one hot encoding
-        2. entity-user dictionary: key - entity_id | value - dictionary
-            sub dictionary: key - user_id | value - either total visits by user_id to entity_id
-                                                    or 1 for one hot encoding
+        1. user-entity dictionary: CSR matrix (int32 indptr/indices/data arrays)
+            row user_id: indices - entity_ids | data - either total visits by user_id to entity_id
+                                                       or 1 for one hot encoding
+        2. entity-user dictionary: CSC matrix (int32 indptr/indices/data arrays)
+            column entity_id: indices - user_ids | data - either total visits by user_id to entity_id
+                                                          or 1 for one hot encoding
         3. user-entity matrix:
             * can be sparse or dense
             * row_index = user_index (x_i)
@@ -33,19 +33,24 @@
 
         Once the search space per user is reduced to only those users who share a common entity, we can
         search through this space using matrix mulltiplication, but with a much smaller number of
-        calculations needed per user. This is done in _find_similarities.
+        calculations needed per user. This is done in pool_workers.find_similarities.
 
         To use this functionality you must call get_nearest_neighbors_batch with user_cap=-1
 
+        As similarity is symmetric and so are these candidates (user_i shares an entity with user_j exactly
+        when user_j shares one with user_i), passing symmetric=True computes each pair of users only once and
+        hands the similarity to both users, which about halves the dot products.
+
         Let G, be a bi-partite graph G(U, V, E), where U = set of all users, V = set of all entities,
         E = set of all edges
             * For reference, general time complexity of NN is O(|U|^2*|V|)
 
         Average Time complexity:
             let k = average number of users per user who share a common entity
+            let p = avg_d(u) * avg_d(v) = number of postings gathered per user, deduplicated with a sort
+
+            * Pruning the space: O(|U| * p*log(p)) = O(|U|*(|E|/|U|)*(|E|/|V|)*log(p)) = O(|E|^2/|V| * log(p))
 
-            * Pruning the space: O(|U| * avg_d(u) * avg_d(v)) = O(|U|*(|E|/|U|)*(|E|/|V|)) = O(|E|^2/|V|)
-           
             * Matrix mulltiplication: O(|U|*|V|*k)
 
             So when O(|E|) << O(|U|*|V|): (Note: |E| is maxed out at |U|*|V| in a bipartite graph)
@@ -53,7 +58,7 @@
                 * O(|E|^2) <<<< O((|U|*|V|)^2)
                 * therefore: O(|E|^2/|V|) <<<< O((|U|*|V|)^2 / |V|)
                 * but (|U|*|V|)^2 / |V| == |U|^2*|V|
-                * therefore: O(|E|^2/|V|) <<<< O(|U|^2*|V|)
+                * therefore: O(|E|^2/|V|) <<<< O(|U|^2*|V|), the sort only adds a log(p) <= log(|E|) factor
 
                 * also if O(k) << O(|U|)
                     * which is highly likley given the degrees of each vertex (user and entity) is low
@@ -64,9 +69,10 @@
         common entity, danny assigns a "closeness score" to each user that shares an entity with a given user
         . danny then selects the top-n users from this list of users with common entities, where n by default
         is 500, but is configurable. These top-n users are the only users who will be compared to a given
-        user in the matrix multiplication step. Extra time is spent here as we sort the list of users with a
-        common entity, but it is justified as we can set a cap on the number of dot products required per
-        user without loosing too much accuracy.
+        user in the matrix multiplication step. Extra time is spent here as we select the top-n out of the
+        list of users with a common entity (a partial selection, linear in the length of the list), but it
+        is justified as we can set a cap on the number of dot products required per user without loosing too
+        much accuracy.
 
         Let G, be a bi-partite graph G(U, V, E), where U = set of all users, V = set of all entities,
         E = set of all edges
@@ -76,507 +82,656 @@
             For reference, general time complexity of NN is O(|U|^2*|V|)
 
             let k = average number of users per user who share a common entity
+            let p = avg_d(u) * avg_d(v) = number of postings gathered per user, p >= k
+
+            * Pruning the space (sort the postings to sum the scores per user, then a partial selection):
+                                 O(|U| * (p*log(p) + k))
+                               = O(|U|*((|E|/|U|)*(|E|/|V|)*log(p) + k))
+                               = O(|E|^2/|V| * log(p) + |U|*k)
 
-            * Pruning the space: O(|U| * (avg_d(u) * avg_d(v) + klog(k)))
-                               = O(|U|*((|E|/|U|)*(|E|/|V|) + klog(k)))
-                               = O(|E|^2/|V| + |U|*klog(k))
-           
             * Matrix mulltiplication: O(|U|*|V|)
 
             So when O(|E|) << O(|U|*|V|): (Note: |E| is maxed out at |U|*|V| in a bipartite graph)
 
                 * if O(k) << O(|U|)
                     * which is highly likley given the degrees of each vertex (user and entity) is low
-                * then O(|U|*klog(k)) ~ O(|U|)
-                * then O(|E|^2/|V| + |U|*klog(k)) ~ O(|E|^2/|V| + |U|)
-                * but O(|E|^2/|V|) <<<< O(|U|^2*|V|) (shown above)
+                * then O(|U|*k) ~ O(|U|)
+                * then O(|E|^2/|V| * log(p) + |U|*k) ~ O(|E|^2/|V| * log(p) + |U|)
+                * but O(|E|^2/|V| * log(p)) <<<< O(|U|^2*|V|) (shown above)
                 * and |U| <= |E| <= |E|^2/|E| <= |E|^2/|V|
-                * therfore  O(|E|^2/|V| + |U|) <<<< O(|U|^2*|V|)
+                * therfore  O(|E|^2/|V| * log(p) + |U|) <<<< O(|U|^2*|V|)
 
                 * O(|U|*|V|) << O(|U|^2*|V|)
 
+    Hub entities:
+        A handful of entities visited by almost everyone (a homepage, a top song) make every user's
+        candidates cover most of the user base. A hub policy skips or samples their postings while pruning,
+        see "Hub entities" in candidate_pruning.
+
+    Splitting the work across machines:
+        A job can be split into shards of users that run on different machines against copies of the same
+        index (get_nearest_neighbors_batch's shard), see sharding.
+
     You can also just prune your search space in a parralelized way, or just get the matrix mulltiplications
     done in a parralelized way if desired.
 
+    The module is split along the stages of the search:
+        * candidate_pruning : pruning the user space per user and scoring the candidates, hub policies
+        * pool_workers      : the pool, and the functions its workers run for both stages
+        * sharding          : splitting a job into shards of users and merging their results
+        * this module       : the batch functions driving the stages and saving their results
+
     Important functions:
         prune_space_batch
         matrix_multiplication_batch
+        prune_and_multiply_batch
         get_nearest_neighbors_batch
 """
 import gc
 import logging
-from multiprocessing import Pool, cpu_count
-from operator import itemgetter
-import random
+from multiprocessing import cpu_count
+import os
+import shutil
 import time
-from numpy import dot
-from supporting_functions import read_pickle_file
-from supporting_functions import write_pickle_file
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+from supporting_functions import read_index_file, read_pickle_file
+from supporting_functions import write_pickle_file, write_sparse_arrays
+from neighbor_store import ShardedNeighborWriter, patch_neighbor_store, results_to_columns
+from neighbor_store import merge_shards, write_neighbor_store
+from scheduler import describe_utilization, run_scheduled, schedule_chunks
+from candidate_pruning import DEFAULT_USER_CAP, MAX_USER_CAP, candidates_to_matrix, symmetric_row_lengths
+from candidate_pruning import user_tuples_to_candidates, walk_costs, walked_degrees
+from candidate_pruning import describe_hub_policy, find_affected_users
+from pool_workers import create_pool, get_block_similarities_batch, get_similarities_batch
+from pool_workers import prune_and_multiply_users, prune_users_batch, results_to_dict, top_k_positions
+from sharding import shard_part_path, shard_user_ids
 
 DEFAULT_DIR = "output_data/"
 MAX_PROCESSES = cpu_count()
-DEFAULT_USER_CAP = 500
-MAX_USER_CAP = 1000
-SUM_SIGNIFICANCE = 10
-
-USER_ENTITY_DICT = None
-ENTITY_USER_DICT = None
-USER_ENTITY_MATRIX = None
-
-def _update_score(perc, number_of_entities_user_1, number_of_entities_user_2):
+DEFAULT_BLOCK_SIZE = 256
+ENGINES = ["rowwise", "blocked"]
+OUTPUT_FORMATS = ["pickle", "columnar", "sharded"]
+CHECKPOINT_DIR = "similarity_scores_checkpoints/"
+CHECKPOINT_SECONDS = 300
+START_METHODS = [None, "fork", "spawn", "forkserver"]
+
+def _scatter_symmetric(result_tuples, user_ids, n_users, top_k=None):
     """
-        Heuristic used to determine how similar user_2's entity visitation pattern is to user_1's entity
-        visitation pattern. The main idea behind the function is to look at:
-            * how significant the current entity is in user_1's visitation history (the perc param)
-            * the difference in the number of entities user_1 and user_2 have visited
-
-        The more significant the current entity is in user_1's history, and the smaller the difference in the
-        number of entities visited between the two users, the more likely the two users are going to have
-        similar visitation patterns.
+        Turns the results of a symmetric mode run, where each pair of users was only computed by one of
+        them, back into full results: every similarity is also handed to the other user of the pair, when
+        that user is being computed. The handed over similarities are the transpose of the computed ones, so
+        they are gathered block by block and transposed with one CSR to CSC conversion. Each user then gets
+        the similarities handed to it (from users with a lower id, in id order) followed by the ones it
+        computed, and with a top_k they are cut to the top_k largest ones (see top_k_positions).
 
-        Note: This function is only called once we have established that user_1 and user_2 have both visited
-              the entity in question
+        The tuples are replaced in place, so the computed half of the results is freed as the full results
+        are built, and the parent never holds much more than the results and the handed over half.
 
         Params:
-            perc                    (float) : percentage of user_1's total visits that are attributed to
-                                              entity_a
-            number_of_entities_user_1 (int) : number of entities user_1 has visited
-            number_of_entities_user_2 (int) : number of entities user_2 has visited
+            result_tuples (arr) : each element is a tuple (user_id, array of user_ids, array of
+                                  similarities), one per user in user_ids, replaced by the full results
+            user_ids      (arr) : users being computed
+            n_users       (int) : number of users in the index
+            top_k    (int|None) : number of most similar users to keep per user, None keeps all
 
         Returns:
-            float : score to update how likely user_2's visitation pattern is close to user_1's
-                    visitation pattern
-
+            arr : result_tuples, each element is a tuple (user_id, array of user_ids, array of similarities)
     """
-    return perc / (abs(number_of_entities_user_1 - number_of_entities_user_2) + 1)
-
-def _approx_prune_space(user_id, user_entity_dict, entity_user_dict):
+    computed = np.zeros(n_users, dtype=bool)
+    computed[user_ids] = True
+    handed_rows = []
+    handed_columns = []
+    handed_similarities = []
+    for start in range(0, len(result_tuples), DEFAULT_BLOCK_SIZE):
+        block = result_tuples[start:start + DEFAULT_BLOCK_SIZE]
+        rows = np.repeat(np.array([result_tuple[0] for result_tuple in block], dtype=np.int32),
+                         [len(result_tuple[1]) for result_tuple in block])
+        columns = np.concatenate([result_tuple[1] for result_tuple in block])
+        mirror = (columns > rows) & computed[columns]
+        handed_rows.append(rows[mirror])
+        handed_columns.append(columns[mirror])
+        handed_similarities.append(np.concatenate([result_tuple[2] for result_tuple in block])[mirror])
+
+    handed_rows = np.concatenate(handed_rows + [np.empty(0, dtype=np.int32)])
+    indptr = np.zeros(n_users + 1, dtype=np.int64)
+    np.cumsum(np.bincount(handed_rows, minlength=n_users), out=indptr[1:])
+    del handed_rows
+    handed_over = csr_matrix((np.concatenate(handed_similarities + [np.empty(0)]),
+                              np.concatenate(handed_columns + [np.empty(0, dtype=np.int32)]), indptr),
+                             shape=(n_users, n_users))
+    del handed_columns, handed_similarities, indptr
+    handed_over = handed_over.tocsc()
+
+    for i, (user_id, similar_users, similarities) in enumerate(result_tuples):
+        start = handed_over.indptr[user_id]
+        end = handed_over.indptr[user_id + 1]
+        if end > start:
+            similar_users = np.concatenate([handed_over.indices[start:end], similar_users])
+            similarities = np.concatenate([handed_over.data[start:end], similarities])
+        if top_k is not None:
+            positions = top_k_positions(similarities, top_k)
+            similar_users = similar_users[positions]
+            similarities = similarities[positions]
+        result_tuples[i] = (user_id, similar_users, similarities)
+
+    return result_tuples
+
+def prune_space_batch(file_names, n_processes=None, user_cap=DEFAULT_USER_CAP, *, start_method=None,
+                      user_ids=None, save=False, output_dir=DEFAULT_DIR, hub_policy=None):
     """
-        Function called by the pool workers in order to establish which users are most likely to have close
-        entity visitation patterns to the user with the passed in user_id.
-
-        * The crux of what danny does is it throws out all users who do not share an entity with the user in
-          question.
-        * This function takes that one step further. Of the users who share an entity with the
-          user-in-question (user associated with the user_id) the function assigns a score as to how likely
-          each user's vistiation pattern is to the user-in-question's visitation pattern
-        * It only attempts to create this score per user if the user-in-question has had enough overall
-          visits––the benefits of the extra calculations to determine this score are not realized if the
-          user-in-question is not a high volume user
-       
-        Params:
-            user_id           (int) : id of the user whose list of potential close users is needed
-            user_entity_dict (dict) : dictionary where: key – user_id | value - list of entity ids user
-                                      has visited
-            entity_user_dict (dict) : dictionary where: key - entity_id | value - list of user ids that
-                                      have visited the entity
-
-        Returns:
-            dict : dictionary containing users to look at when evaluating which users are closest to the user
-                   associated with the user_id
-                   key - user_id | value - score of how likely that user's visitation patterns is close to
-                                           user-in-question's visitation patterns
-    """
-    users_to_look_at = {}
-    user_sum = sum(user_entity_dict[user_id].values())
-    is_sum_sig = user_sum > SUM_SIGNIFICANCE
-    user_length = len(user_entity_dict[user_id])
-   
-    for entity in user_entity_dict[user_id]:
-        users_associated_with_entity = entity_user_dict[entity]
-        if is_sum_sig:
-            user_count = user_entity_dict[user_id][entity]
-            perc = user_count / user_sum
-        for key in users_associated_with_entity:
-            if key in users_to_look_at:
-                if is_sum_sig:
-                    users_to_look_at[key] += _update_score(perc, user_length, len(user_entity_dict[key]))
-                else:
-                    users_to_look_at[key] += 1
-            else:
-                if is_sum_sig:
-                    users_to_look_at[key] = _update_score(perc, user_length, len(user_entity_dict[key]))
-                else:
-                    users_to_look_at[key] = 1
-
-    return users_to_look_at
-
-def _strict_prune_space(user_id, user_entity_dict, entity_user_dict):
-    """
-        Function called by the pool workers in order to establish which users have any chance of having close
-        entity visitation patterns to the user with the passed in user_id.
-
-        The crux of what danny does is it throws out all users who do not share an entity with the user in
-        question. It accomplishes this by looking at each entity a user has visited and then grabbing all
-        users who have visited these entities. If user_i has not shared an entity with a user_j, then there's
-        very little sense in looking at how close user_i and user_j are.
-       
-        Params:
-            user_id           (int) : id of the user whose list of potential close users is needed
-            user_entity_dict (dict) : dictionary where: key – user_id | value - list of entity ids user
-                                      has visited
-            entity_user_dict (dict) : dictionary where: key - entity_id | value - list of user ids that
-                                      have visited the entity
-
-        Returns:
-            dict : dictionary containing users to look at when evaluating which users are closest to the user
-                   associated with the user_id, key - user_id | value - 1
-    """
-    users_to_look_at = {}
-   
-    for entity in user_entity_dict[user_id]:
-        users_associated_with_entity = entity_user_dict[entity]
-        for key in users_associated_with_entity:
-            users_to_look_at[key] = 1
-   
-    return users_to_look_at
-
-def _get_top_n_users_batch(user_id_user_cap):
-    """
-        Actual function called by pool workers to pick out the top n most likely users similar to a given
-        user (user-in-question) for the final vector comparison. This function is called when danny is
-        running in approximate mode.
-
-        Function first calls _approx_prune_space, which assings a scores (via a heuristic) to every relevant
-        user. This score is a measure of how likely each relevant user's visitation patterns are to the
-        user-in-question's visitation pattern.
-            * A relevant user is a user whose visitation pattern shares at least one entity with the
-              user-in-question's visitation pattern.
-
-        Next the function sorts the relevant users by their scores, and then selects the top n users, where
-        n is passed in (user_cap). If there is a tie in scores that causes the list to expand past n users,
-        the function randomly samples from the tied users and ensures the list is below the max number of
-        associated users per each user-in-question. The max number is 1000 and this is done for storage
-        purposes.
+        Function that sets up the mulitprocessing environment and sets off the extraction of either the full
+        list of possible nearest neighbors or the approximate top_n nearest neighbors for each user.
 
-        Params:
-            user_id_user_cap (tup) : user_id, number of similar users desired (max is 1000)
+        Excpets up to three files names:
+            1. file name for the user_entity dictionary (see supporting_functions.read_index_file)
+            2. file name for the entity_user dictionary (see supporting_functions.read_index_file)
+            3. pickle file name for a list of user ids whose similar users are desired
+                * if this isn't provided then all users will be used
 
-        Returns:
-            tup : user_id, list of n most similar users
+        The dictionaries are memory-mapped, so the pool workers all read the same pages of the page cache
+        instead of slowly duplicating the index as reference counts get updated. Workers attach to them in a
+        pool initializer (see create_pool), so any multiprocessing start method can be used. Users are
+        handed to the workers in chunks of about equal estimated cost, the number of postings pruning walks
+        for them (see walk_costs and scheduler.schedule_chunks), and how busy each worker was is logged.
 
-    """
-    user_id = user_id_user_cap[0]
-    user_cap = min(user_id_user_cap[1], MAX_USER_CAP)
-
-    users_to_look_at = _approx_prune_space(user_id, USER_ENTITY_DICT, ENTITY_USER_DICT)
-   
-    if len(users_to_look_at) > user_cap:
-        sorted_users = sorted(users_to_look_at.items(), key=itemgetter(1), reverse=True)
-        cut_off_value = sorted_users[user_cap - 1][1]
-
-        top_n_keys = []
-        keys_to_randomly_select_from = []
-   
-        for tup in sorted_users:
-            if tup[1] > cut_off_value:
-                top_n_keys.append(tup[0])
-            elif tup[1] == cut_off_value:
-                keys_to_randomly_select_from.append(tup[0])
-            else:
-                break
-
-        sample_amount = min(MAX_USER_CAP - len(top_n_keys), len(keys_to_randomly_select_from))
-        if sample_amount == len(keys_to_randomly_select_from):
-            keys_to_add = keys_to_randomly_select_from
-        else:
-            keys_to_add = random.sample(keys_to_randomly_select_from, sample_amount)
-       
-        for key in keys_to_add:
-            top_n_keys.append(key)
-    else:
-        top_n_keys = list(users_to_look_at.keys())
-
-    return (user_id, top_n_keys)
+        To extract the full list of possible nearest neighbors (i.e. no approximation) set user_cap to -1
 
-def _get_relevant_users_batch(user_id):
-    """
-        Actual function called by pool workers to pick out all relevant users when considering which
-        users would have close visitation patterns. This function is called when danny is
-        running in smart, but more comprehensive mode.
+        The candidates are returned as a CSR matrix: row user_id holds, in its indices, the users user_id
+        should be compared to (see candidates_to_matrix). In approximate mode each row also holds the
+        heuristic scores, ordered from the best to the worst, so the candidates a smaller user_cap would have
+        picked are a prefix of the row. When saved, the matrix is written as output_dir/candidates_*.npy
+        (with the user_cap and hub policy in its meta file), which matrix_multiplication_batch memory-maps,
+        so the multiplication can be run again (e.g. with a smaller user_cap or another thresh) without
+        pruning again.
 
         Params:
-            user_id (int) : id of user to grab relevant users for
+            file_names        (arr) : array of the three files mentioned above
+            n_processes       (int) : number of processes danny should use when extracting possible
+                                      nearest neighbors. If left None, danny will use 2 less than the number
+                                      of cores available on your machine.
+            user_cap          (int) : the number of top users that should be extracted in the approximate
+                                      mode, or to get the full list of possible neighbors pass in -1
+            start_method (str|None) : multiprocessing start method ("fork", "spawn" or "forkserver"), None
+                                      uses the platform's default
+            user_ids     (arr|None) : ids of the users whose similar users are desired, takes precedence over
+                                      the third file
+            save             (bool) : whether to write the candidates to output_dir instead of returning them
+            output_dir        (str) : the directory to write the candidates to
+            hub_policy  (dict|None) : policy returned by resolve_hub_policy, None walks every posting
 
         Returns:
-            tup : user_id, list of relevant user_ids
-
-    """
-    users_to_look_at = _strict_prune_space(user_id, USER_ENTITY_DICT, ENTITY_USER_DICT)
-
-    return (user_id, [key for key in users_to_look_at])
-
-def _find_similarities(user_id, matrix, users_to_compare_to, sparse):
+            csr_matrix | bool : the n_users x n_users candidates matrix, or True once saved
     """
-        Function called by pool workers to computes the dot product between user-in-question (user associated
-        with user_id) and the list of user_ids passed in.
-
-        Note: user_ids (which are ints) must equal the row indicies associated with the count vectors for
-              those user_ids. i.e. if a user's id is 0, then that user's count vector must be stored in row
-              zero of the passed in matrix.
-       
-        Params:
-            user_id             (int) : user whose similar users are wanted
-            matrix           (matrix) : matrix where each row contains a user's entity visitation pattern
-                                        encoded as a count vector. Each column contains each entity's user
-                                        vistiation record encoded as a count vector. Can be sparse.
-            users_to_compare_to (arr) : list of user_ids whose entity visitation patterns should be compared
-                                        to the user-in-question's entity visitation pattern
-            sparse             (bool) : is the matrix sparse or not
+    # pylint: disable=too-many-arguments, too-many-locals
+    start_time = time.time()
+    user_entity_dict = read_index_file(file_names[0])
+    entity_user_dict = read_index_file(file_names[1])
 
-        Returns:
-            arr : similarities between user-in-question and passed in user_ids, order is preserved between
-                  the passed in user_ids and the returned dot products
-    """
-    if sparse:
-        row = matrix[user_id].toarray()[0]
-        results = matrix[users_to_compare_to, :].dot(row)
+    if user_ids is not None:
+        users_to_check = np.asarray(user_ids)
+    elif len(file_names) == 3:
+        users_to_check = np.asarray(read_pickle_file(file_names[2]))
     else:
-        row = matrix[user_id]
-        results = dot(matrix[users_to_compare_to, :], row)
+        users_to_check = np.flatnonzero(np.diff(user_entity_dict.indptr))
 
-    return results
+    logging.info("read in dictionary files in %s seconds", time.time() - start_time)
+    start_time = time.time()
+    n_processes = MAX_PROCESSES - 2 if n_processes is None else n_processes
+    users_to_check = np.unique(users_to_check.astype(np.int64))
+    costs = walk_costs(users_to_check, user_entity_dict, walked_degrees(entity_user_dict, hub_policy))
+    chunks = schedule_chunks(users_to_check, costs, n_processes, DEFAULT_BLOCK_SIZE)
 
-def _format_similarities(users_to_compare_to, similarities, thresh=-1.0):
-    """
-        Both for readability and storage purposes it is useful to cap the number of decimal places for the
-        similarities scores (dot products) computed for a user and their closest users. I have chosen 4, this
-        decision is arbirtrary though.
+    logging.info("prepped users to be analyzed in %s seconds", time.time() - start_time)
+    logging.info("pruning with hub policy: %s", describe_hub_policy(hub_policy))
+    start_time = time.time()
 
-        As no additional complexity is added to the process, there is an ability to filter out similarities
-        that are below a certain threshold when preparring similairty scores.
+    with create_pool(n_processes,
+                     {"USER_ENTITY_DICT": (user_entity_dict, file_names[0]),
+                      "ENTITY_USER_DICT": (entity_user_dict, file_names[1])},
+                     start_method) as pool:
+        results, report = run_scheduled(pool, prune_users_batch,
+                                        [(chunk, user_cap, hub_policy) for chunk in chunks], n_processes)
+    candidates = candidates_to_matrix(results, user_entity_dict.shape[0])
+    del results
 
-        This function is also called by pool workers.
+    logging.info("Pruning took %s seconds, %s", time.time() - start_time, describe_utilization(report))
+    start_time = time.time()
 
-        Params:
-            users_to_compare_to (arr) : user_ids asscoiated with the dot scores that are being
-                                        formated. The function assumes that user_id in position i is
-                                        asscoiated with similarity score in position i
-            similarities        (arr) : similarity scores to be formatted
-            thresh            (float) : minimum threshold for scores to be formatted
+    del user_entity_dict
+    del entity_user_dict
+    del chunks
+    gc.collect()
 
-        Returns:
-            dict : key - user_id | value - formatted similarity score
+    logging.info("Deleting dictionaries took %s seconds", time.time() - start_time)
 
-    """
-    results_dict = {}
-    for i, dot_product in enumerate(similarities):
-        if dot_product > thresh:
-            results_dict[users_to_compare_to[i]] = float("{0:.4f}".format(dot_product))
+    if save:
+        write_sparse_arrays(candidates, output_dir + "candidates", meta={"user_cap": user_cap,
+                                                                         "hub_policy": hub_policy})
+        return True
 
-    return results_dict
+    return candidates
 
-def _get_dense_similarities_batch(user_tuple):
+def matrix_multiplication_batch(file_names, candidates=None, n_processes=None, sparse=True, *,
+                                engine="rowwise", block_size=DEFAULT_BLOCK_SIZE, top_k=None, thresh=-1.0,
+                                as_dict=True, start_method=None, candidate_cap=None, symmetric=False,
+                                result_writer=None, user_ids=None):
     """
-        Actual function called by pool workers to calculate the needed dot products per user
-
-        Shoud be used when the created matrix storing each user's entity visitation pattern is a dense matrix
+        Function that sets up the multiprocessing environment and sets off the calculation of dot products
+        for each user.
 
-        Calls _find_similarities and formats similarities via _format_similarities
+        Excpets up to two files names:
+            1. file name for the user_entity matrix (see supporting_functions.read_index_file), which is
+               memory-mapped and so shared by all pool workers
+            2. file name of the candidates saved by prune_space_batch (e.g. output_dir/candidates), which is
+               memory-mapped as well, or a pickle file of a list of (user_id, list of user_ids) tuples
+                * if this isn't provided, the candidates must be passed in
+
+        The pool workers attach to the candidates the same way they attach to the matrix, and are only
+        handed chunks of at most block_size user_ids to work through. The chunks are of about equal
+        estimated cost (the number of candidates, plus the postings walked by the "blocked" engine's
+        product, see scheduler.schedule_chunks), and how busy each worker was is logged.
+
+        Two engines are supported:
+            * rowwise - each user's candidates are sliced out of the matrix and compared with one mat-vec
+            * blocked - users are grouped into blocks of block_size, and each block is compared to its
+                        candidates with one sparse x sparse^T product (see _find_block_similarities). Only
+                        works with a sparse matrix, and is the only engine that honours top_k and thresh
+
+        With exact mode candidates the similarity of each pair of users can be computed only once
+        (symmetric), by the user with the lower id (see upper_candidates), which about halves the dot
+        products and the results sent back by the workers. The similarities are then handed to both users
+        in the parent (see _scatter_symmetric), which is serial work, so this pays off when users have many
+        candidates (the dot products dominate) rather than many users with a handful each. For the
+        "blocked" engine the saving is in masking, selecting and sending back the results, as its block
+        products still cover every user.
 
         Params:
-            user_tuple (tup) : user_id, list of user_ids to compare user to
+            file_names             (arr) : array of the two files mentioned above
+            candidates  (csr_matrix|arr) : candidates matrix returned by prune_space_batch, or a list where
+                                           each element is a tuple (user_id, list of other user_ids)
+            n_processes            (int) : number of processes danny should use when extracting possible
+                                           nearest neighbors. If left None, danny will use 2 less than the
+                                           number of cores available on your machine.
+            sparse                (bool) : indicates whether the user_entity_matrix is sparse or not
+            engine                 (str) : either "rowwise" or "blocked"
+            block_size             (int) : number of users per block for the "blocked" engine, and per chunk
+                                           handed to a worker for the "rowwise" engine
+            top_k             (int|None) : "blocked" engine only, number of most similar users to keep per
+                                           user, None keeps all of them
+            thresh               (float) : "blocked" engine only, minimum similarity for a user to be kept
+            as_dict               (bool) : whether to convert the results into danny's dictionary format, or
+                                           keep them as the arrays the pool workers return
+            start_method      (str|None) : multiprocessing start method ("fork", "spawn" or "forkserver"),
+                                           None uses the platform's default
+            candidate_cap     (int|None) : user_cap to run with, when it differs from the one the candidates
+                                           were pruned with: a smaller positive one keeps the candidates
+                                           pruning with it would have (see _candidate_row), -1 only checks
+                                           that they were pruned in the exact mode. None uses every candidate
+            symmetric             (bool) : compute each pair of users once, only for candidates pruned in the
+                                           exact mode without sampling hub entities (which would make them
+                                           asymmetric)
+            result_writer (ShardedNeighborWriter|None) : writer the results are handed to as they arrive,
+                                           instead of being gathered and returned (see
+                                           neighbor_store.ShardedNeighborWriter), not closed here
+            user_ids          (arr|None) : only compute the users among these that have candidates, e.g. one
+                                           shard's users (see shard_user_ids), None computes every user that
+                                           has candidates
 
         Returns:
-            tup : user_id, dict -- key = user_id | value = dot_product
+            dict | arr | bool : if as_dict, key - user_id | value - dict -- key - user_id, value: dot product
+                                else each element is a tuple (user_id, array of user_ids, array of dot
+                                products). True once every result was handed to result_writer
     """
-    user_id = user_tuple[0]
-    users_to_compare_to = user_tuple[1]
+    #pylint: disable=too-many-arguments, too-many-locals, too-many-branches
+    if engine not in ENGINES:
+        raise ValueError("engine must be one of {}".format(ENGINES))
 
-    results = _find_similarities(user_id, USER_ENTITY_MATRIX, users_to_compare_to, sparse=False)
+    if engine == "blocked" and not sparse:
+        raise ValueError("the \"blocked\" engine needs a sparse user_entity matrix")
 
-    return (user_id, _format_similarities(users_to_compare_to, results))
+    start_time = time.time()
+    user_entity_matrix = read_index_file(file_names[0])
+    if len(file_names) < 2 and candidates is None:
+        raise ValueError("you must either pass in a file name for the output of prune_space_batch, or \
+                          the candidates it outputs")
+
+    candidates_file_name = None
+    if len(file_names) > 1 and file_names[1].endswith(".pickle"):
+        candidates = read_pickle_file(file_names[1])
+    elif len(file_names) > 1:
+        candidates_file_name = file_names[1]
+        candidates = read_index_file(candidates_file_name)
+
+    if not issparse(candidates):
+        candidates = user_tuples_to_candidates(candidates, user_entity_matrix.shape[0])
+
+    if candidate_cap is not None:
+        pruned_user_cap = MAX_USER_CAP if candidates.dtype != np.int8 else -1
+        if candidates_file_name is not None:
+            pruned_user_cap = read_pickle_file(candidates_file_name + "_meta.pickle").get("user_cap", -1)
+        if (candidate_cap > 0) != (pruned_user_cap > 0) or candidate_cap > pruned_user_cap:
+            raise ValueError("the candidates were pruned with a user_cap of {}, they can only be used with \
+                              the same or a smaller user_cap".format(pruned_user_cap))
+        candidate_cap = candidate_cap if candidate_cap > 0 else None
+
+    if symmetric and (result_writer is not None or user_ids is not None):
+        raise ValueError("symmetric results can't be streamed or limited to user_ids, as every user's \
+                          results are only complete once all of them are computed")
+
+    if symmetric:
+        hub_policy = None
+        if candidates_file_name is not None:
+            hub_policy = read_pickle_file(candidates_file_name + "_meta.pickle").get("hub_policy")
+        if candidates.dtype != np.int8 or candidate_cap is not None:
+            raise ValueError("symmetric only works with candidates pruned in the exact mode (user_cap=-1)")
+        if hub_policy is not None and hub_policy["policy"] == "sample":
+            raise ValueError("candidates pruned while sampling hub entities are not symmetric")
+
+    users_to_check = np.flatnonzero(np.diff(candidates.indptr))
+    if user_ids is not None:
+        users_to_check = np.intersect1d(users_to_check, np.asarray(user_ids, dtype=np.int64))
+
+    logging.info("read in matrix and candidates in %s seconds", time.time() - start_time)
+    start_time = time.time()
 
-def _get_sparse_similarities_batch(user_tuple):
-    """
-        Actual function called by pool workers to calculate the needed dot products per user
+    index_parts = {"USER_ENTITY_MATRIX": (user_entity_matrix, file_names[0]),
+                   "CANDIDATES": (candidates, candidates_file_name)}
+    if engine == "blocked":
+        index_parts["USER_ENTITY_MATRIX_T"] = (user_entity_matrix.T.tocsr(), None)
+        logging.info("transposed matrix for the blocked engine in %s seconds", time.time() - start_time)
+        start_time = time.time()
 
-        Shoud be used when the created matrix storing each user's entity visitation pattern is a sparse matrix
+    n_processes = MAX_PROCESSES - 2 if n_processes is None else n_processes
 
-        Calls _find_similarities and formats similarities via _format_similarities
+    if symmetric:
+        costs = symmetric_row_lengths(users_to_check, candidates) + 1
+    else:
+        costs = np.diff(candidates.indptr)[users_to_check] + 1
+    if candidate_cap is not None:
+        costs = np.minimum(costs, candidate_cap + 1)
+    if engine == "blocked":
+        column_degrees = np.bincount(user_entity_matrix.indices, minlength=user_entity_matrix.shape[1])
+        costs = costs + walk_costs(users_to_check, user_entity_matrix, column_degrees)
+    chunks = schedule_chunks(users_to_check, costs, n_processes, block_size)
+
+    consume = result_writer.add if result_writer is not None else None
+    pool_context = create_pool(n_processes, index_parts, start_method)
+    del index_parts
+    with pool_context as pool:
+        if engine == "blocked":
+            results, report = run_scheduled(pool, get_block_similarities_batch,
+                                            [(chunk, candidate_cap, None if symmetric else top_k, thresh,
+                                              symmetric) for chunk in chunks], n_processes, consume)
+        else:
+            results, report = run_scheduled(pool, get_similarities_batch,
+                                            [(chunk, sparse, candidate_cap, symmetric) for chunk in chunks],
+                                            n_processes, consume)
+    result_tuples = sorted([result for chunk_results in results for result in chunk_results],
+                           key=lambda result_tuple: result_tuple[0])
+    del results
+    del chunks
+    if symmetric:
+        result_tuples = _scatter_symmetric(result_tuples, users_to_check, candidates.shape[0],
+                                           top_k if engine == "blocked" else None)
+
+    logging.info("Matrix Multiplications took %s seconds, %s", time.time() - start_time,
+                 describe_utilization(report))
+    start_time = time.time()
 
-        Params:
-            user_tuple (tup) : user_id, list of user_ids to compare user to
+    del user_entity_matrix
+    del candidates
+    gc.collect()
 
-        Returns:
-            tup : user_id, dict -- key = user_id | value = dot_product
-    """
-    user_id = user_tuple[0]
-    users_to_compare_to = user_tuple[1]
+    logging.info("Deleting matrix took %s seconds", time.time() - start_time)
+    start_time = time.time()
 
-    results = _find_similarities(user_id, USER_ENTITY_MATRIX, users_to_compare_to, sparse=True)
+    if result_writer is not None:
+        return True
 
-    return (user_id, _format_similarities(users_to_compare_to, results))
+    if as_dict:
+        similarity_scores = results_to_dict(result_tuples)
+        logging.info("Converted results to dictionaries in %s seconds", time.time() - start_time)
 
-def prune_space_batch(file_names, n_processes=None, user_cap=DEFAULT_USER_CAP):
-    """
-        Function that sets up the mulitprocessing environment and sets off the extraction of either the full
-        list of possible nearest neighbors or the approximate top_n nearest neighbors for each user.
+        return similarity_scores
 
-        Excpets up to three pickle files names:
-            1. file name for the user_entity dictionary
-            2. file name for the entity_user dictionary
-            3. file name for a list of user ids whose similar users are desired
-                * if this isn't provided then all users will be used
+    return result_tuples
 
-        To extract the full list of possible nearest neighbors (i.e. no approximation) set user_cap to -1
+def prune_and_multiply_batch(file_names, n_processes=None, sparse=True, user_cap=DEFAULT_USER_CAP, *,
+                             engine="rowwise", block_size=DEFAULT_BLOCK_SIZE, top_k=None, thresh=-1.0,
+                             as_dict=True, start_method=None, user_ids=None, hub_policy=None,
+                             result_writer=None):
+    """
+        Fused form of prune_space_batch followed by matrix_multiplication_batch. Every worker attaches to
+        the dictionaries and the matrix at once and takes its chunks of users from pruning all the way to
+        their dot products, so only the final results come back to the parent: the candidates are never
+        gathered in the parent, and only one pool is started.
+
+        Users are handed out in chunks of about equal estimated cost, the number of postings pruning walks
+        for them (see walk_costs), which the number of candidates, and so the dot products, grows with.
+
+        Excpets three or four files names:
+            1. file name for the user_entity dictionary (see supporting_functions.read_index_file)
+            2. file name for the entity_user dictionary (see supporting_functions.read_index_file)
+            3. file name for the user_entity matrix (see supporting_functions.read_index_file)
+            4. pickle file name for a list of user ids whose similar users are desired
+                * if this isn't provided then all users will be used
 
         Params:
-            file_names  (arr) : array of the three files mentioned above
-            n_processes (int) : number of processes danny should use when extracting possible
-                                nearest neighbors. If left None, danny will use 2 less than the number
-                                of cores available on your machine.
-            user_cap    (int) : the number of top users that should be extracted in the approximate mode, or
-                                to get the full list of possible neighbors pass in -1
+            file_names        (arr) : array of the files mentioned above
+            n_processes       (int) : number of processes danny should use. If left None, danny will use 2
+                                      less than the number of cores available on your machine.
+            sparse           (bool) : indicates whether the user_entity_matrix is sparse or not
+            user_cap          (int) : the number of top users that should be extracted in the approximate
+                                      mode, or to get the full list of possible neighbors pass in -1
+            engine            (str) : either "rowwise" or "blocked", see matrix_multiplication_batch
+            block_size        (int) : maximum number of users per chunk handed to a worker, and so per block
+                                      for the "blocked" engine
+            top_k        (int|None) : "blocked" engine only, number of most similar users to keep per user,
+                                      None keeps all of them
+            thresh          (float) : "blocked" engine only, minimum similarity for a user to be kept
+            as_dict          (bool) : whether to convert the results into danny's dictionary format, or keep
+                                      them as the arrays the pool workers return
+            start_method (str|None) : multiprocessing start method ("fork", "spawn" or "forkserver"), None
+                                      uses the platform's default
+            user_ids     (arr|None) : ids of the users whose similar users are desired, takes precedence over
+                                      the fourth file
+            hub_policy  (dict|None) : policy returned by resolve_hub_policy, None walks every posting
+            result_writer (ShardedNeighborWriter|None) : writer the results are handed to as they arrive,
+                                      instead of being gathered and returned, not closed here
 
         Returns:
-            (arr) : each element in the array is a tuple of the following form
-                    (user_id, list of relevant user_ids to check for that user)
-
+            dict | arr | bool : if as_dict, key - user_id | value - dict -- key - user_id, value: dot product
+                                else each element is a tuple (user_id, array of user_ids, array of dot
+                                products). True once every result was handed to result_writer
     """
-    # pylint: disable=global-statement, too-many-arguments, too-many-locals
-    global USER_ENTITY_DICT, ENTITY_USER_DICT
-    start_time = time.time()
-    USER_ENTITY_DICT = read_pickle_file(file_names[0])
-    ENTITY_USER_DICT = read_pickle_file(file_names[1])
+    #pylint: disable=too-many-arguments, too-many-locals
+    if engine not in ENGINES:
+        raise ValueError("engine must be one of {}".format(ENGINES))
 
-    if len(file_names) == 3:
-        users_to_check = read_pickle_file(file_names[2])
-    else:
-        users_to_check = list(USER_ENTITY_DICT.keys())
+    if engine == "blocked" and not sparse:
+        raise ValueError("the \"blocked\" engine needs a sparse user_entity matrix")
 
-    logging.info("read in dictionary pickle files in %s seconds", time.time() - start_time)
     start_time = time.time()
-    if user_cap > 0:
-        user_indicies = []
-        for key in users_to_check:
-            user_indicies.append((key, user_cap))
+    user_entity_dict = read_index_file(file_names[0])
+    entity_user_dict = read_index_file(file_names[1])
+    user_entity_matrix = read_index_file(file_names[2])
+
+    if user_ids is not None:
+        users_to_check = np.asarray(user_ids)
+    elif len(file_names) == 4:
+        users_to_check = np.asarray(read_pickle_file(file_names[3]))
     else:
-        user_indicies = users_to_check
+        users_to_check = np.flatnonzero(np.diff(user_entity_dict.indptr))
 
-    logging.info("prepped users to be analyzed in %s seconds", time.time() - start_time)
+    logging.info("read in dictionaries and matrix in %s seconds", time.time() - start_time)
     start_time = time.time()
 
-    n_processes = MAX_PROCESSES - 2 if n_processes is None else n_processes
-
-    pool = Pool(processes=n_processes)
-
-    user_tuples = pool.map(_get_top_n_users_batch, user_indicies) if user_cap > 0 \
-                  else pool.map(_get_relevant_users_batch, user_indicies)
-   
-    logging.info("Pruning took %s seconds", time.time() - start_time)
-    start_time = time.time()
-   
-    pool.close()
-    pool.join()
-    del USER_ENTITY_DICT
-    del ENTITY_USER_DICT
-    del user_indicies
-    del pool
-    gc.collect()
+    index_parts = {"USER_ENTITY_DICT": (user_entity_dict, file_names[0]),
+                   "ENTITY_USER_DICT": (entity_user_dict, file_names[1]),
+                   "USER_ENTITY_MATRIX": (user_entity_matrix, file_names[2])}
+    if engine == "blocked":
+        index_parts["USER_ENTITY_MATRIX_T"] = (user_entity_matrix.T.tocsr(), None)
+        logging.info("transposed matrix for the blocked engine in %s seconds", time.time() - start_time)
+        start_time = time.time()
 
-    logging.info("Deleting dictionaries took %s seconds", time.time() - start_time)
-
-    return user_tuples
-
-def matrix_multiplication_batch(file_names, user_tuples_list=None, n_processes=None, sparse=True):
-    """
-        Function that sets up the multiprocessing environment and sets off the calculation of dot products
-        for each user.
-
-        Excpets up to two pickle files names:
-            1. file name for the user_entity matrix
-            2. file name for the user_tuples list genereated by prune_space_batch (or data of similar format)
-                * if this isn't provided, the actual list must be passed in
-
-        Params:
-            file_names       (arr) : array of the two files mentioned above
-            user_tuples_list (arr) : array where each element is a tuple (user_id, list of other user_ids)
-                                     the format must match that of the output of prune_space_batch
-            n_processes      (int) : number of processes danny should use when extracting possible
-                                     nearest neighbors. If left None, danny will use 2 less than the number
-                                     of cores available on your machine.
-            sparse          (bool) : indicates whether the user_entity_matrix is sparse or not
+    n_processes = MAX_PROCESSES - 2 if n_processes is None else n_processes
+    users_to_check = np.unique(users_to_check.astype(np.int64))
+    costs = walk_costs(users_to_check, user_entity_dict, walked_degrees(entity_user_dict, hub_policy))
+    chunks = schedule_chunks(users_to_check, costs, n_processes, block_size)
+    pool_context = create_pool(n_processes, index_parts, start_method)
+    del index_parts
 
-        Returns:
-            dict : key - user_id | value - dict -- key - user_id, value: dot product
-    """
-    #pylint: disable=global-statement
-    global USER_ENTITY_MATRIX
+    logging.info("prepped users to be analyzed in %s seconds", time.time() - start_time)
+    logging.info("pruning with hub policy: %s", describe_hub_policy(hub_policy))
     start_time = time.time()
-    USER_ENTITY_MATRIX = read_pickle_file(file_names[0])
-    if len(file_names) < 2 and not isinstance(user_tuples_list, list):
-        raise ValueError("you must either pass in a file name for the output of prune_space_batch, or \
-                          the list it outputs")
-   
-    user_tuples = read_pickle_file(file_names[1]) if len(file_names) > 1 else user_tuples_list
 
-    logging.info("read in pickle file in %s seconds", time.time() - start_time)
+    with pool_context as pool:
+        results, report = run_scheduled(pool, prune_and_multiply_users,
+                                        [(chunk, user_cap, hub_policy, sparse, engine, top_k, thresh)
+                                         for chunk in chunks], n_processes,
+                                        result_writer.add if result_writer is not None else None)
+    result_tuples = sorted([result for chunk_results in results for result in chunk_results],
+                           key=lambda result_tuple: result_tuple[0])
+    del results
+    del chunks
+
+    logging.info("Pruning and Matrix Multiplications took %s seconds, %s", time.time() - start_time,
+                 describe_utilization(report))
     start_time = time.time()
 
-    n_processes = MAX_PROCESSES - 2 if n_processes is None else n_processes
-    pool = Pool(processes=n_processes)
+    del user_entity_dict
+    del entity_user_dict
+    del user_entity_matrix
+    gc.collect()
 
-    dictionary_result_tuples = pool.map(_get_sparse_similarities_batch, user_tuples) if sparse \
-                               else pool.map(_get_dense_similarities_batch, user_tuples)
+    logging.info("Deleting index took %s seconds", time.time() - start_time)
 
-    logging.info("Matrix Multiplications took %s seconds", time.time() - start_time)
-    start_time = time.time()
+    if result_writer is not None:
+        return True
 
-    pool.close()
-    pool.join()
-    del USER_ENTITY_MATRIX
-    del user_tuples
-    del pool
-    gc.collect()
+    if as_dict:
+        start_time = time.time()
+        similarity_scores = results_to_dict(result_tuples)
+        logging.info("Converted results to dictionaries in %s seconds", time.time() - start_time)
 
-    logging.info("Deleting matrix took %s seconds", time.time() - start_time)
-    start_time = time.time()
-   
-    similarity_scores = {}
-    for dict_result_tuple in dictionary_result_tuples:
-        user_id = dict_result_tuple[0]
-        dict_result = dict_result_tuple[1]
-        similarity_scores[user_id] = dict_result
+        return similarity_scores
 
-    return similarity_scores
+    return result_tuples
 
 def get_nearest_neighbors_batch(input_type="default", file_names=None, sparse=True, user_cap=DEFAULT_USER_CAP,
-                                n_processes=None, save=True, output_dir=DEFAULT_DIR):
+                                n_processes=None, save=True, output_dir=DEFAULT_DIR, *, engine="rowwise",
+                                block_size=DEFAULT_BLOCK_SIZE, top_k=None, thresh=-1.0, as_dict=True,
+                                output_format="pickle", quantize=False, start_method=None,
+                                changed_users=None, save_candidates=False, candidates_file=None,
+                                hub_policy=None, symmetric=False, fused=False, shard=None,
+                                shard_scheme="range", checkpoint=False, resume=False):
     """
         Function that calls prune_space_batch and matrix_multiplication_batch in order to extract per user
         all users who have a dot product above zero or the approximate top_n closest users.
 
-        Expects three pickle files:
-            1. file name for the user_entity dictionary, key - user_id | value - dict
-                -- key - entity_id, value - number of times user_id visited entity_id
-            2. file name for the entity_user dictionary, key - entity_id | value - dict
-                -- key - user_id, value - number of times user_id visited entity_id
+        After an index update only the users that share an entity with a changed user can have different
+        neighbors. Passing in changed_users recomputes only those users (see find_affected_users) and, when
+        saving, patches their neighbors into the similarity scores already saved in output_dir instead of
+        overwriting them.
+
+        The candidates pruning finds can be kept (save_candidates) as output_dir/candidates_*.npy, and a
+        later run can multiply from them (candidates_file) without pruning again. As approximate candidates
+        are kept ordered from the best heuristic score to the worst, a run with a smaller user_cap than the
+        one they were pruned with just takes a prefix of each user's candidates.
+
+        With fused, pruning and dot products are done by one pool instead (see prune_and_multiply_batch), so
+        the candidates never reach the parent and only one pool is started. They can then not be saved or
+        reused, or computed symmetrically.
+
+        With shard, only one shard's users are computed (see shard_user_ids) and, when saving, they are
+        streamed to their own part of the results, output_dir/similarity_scores_parts/part_<i>_of_<n>/,
+        always in the columnar format (see neighbor_store.ShardedNeighborWriter). Once every shard has run,
+        merge_shard_parts combines the parts.
+
+        A long run can checkpoint its results: with checkpoint, the columnar results are streamed out to
+        output_dir/similarity_scores_checkpoints/ as the users are completed, a shard at least every
+        CHECKPOINT_SECONDS, and only merged into output_dir/similarity_scores/ at the end. If the run dies
+        on the way, running it again with resume keeps the users the checkpoints hold and only computes the
+        rest (pruning included, unless the candidates were saved and are passed back in with
+        candidates_file). The "sharded" format and shards always write their results this way, so they can
+        be resumed as well.
+
+        Expects three index files (see supporting_functions.read_index_file):
+            1. file name for the user_entity dictionary, CSR matrix -- row user_id holds the entity_ids
+               user_id visited and the number of times user_id visited each of them
+            2. file name for the entity_user dictionary, CSC matrix -- column entity_id holds the user_ids
+               who visited entity_id and the number of times each of them visited entity_id
             3. file name for user_entity matrix, rows represent either one hot or count vectors describing
                the visitation pattern for each user
 
         These three file names can either be passed in or if using the default file names selected by danny
         just left blank, as danny will know where to find them
 
+        Every option after output_dir (the engine, output format, hub policy, symmetric, fused, shard and
+        checkpoint options) is keyword only.
+
         Params:
-            input_type  (str) : either "default" or "files" indicating where to find the needed pickle
-                                files
-            file_names  (arr) : array of the three files mentioned above, can be left blank if using
-                                "default" mode
-            user_cap    (int) : the number of top users that should be extracted in the approximate mode, or
-                                to get the full list of possible neighbors pass in -1 (dot product > 0)
-            n_processes (int) : number of processes danny should use when extracting possible
-                                nearest neighbors. If left None, danny will use 2 less than the number
-                                of cores available on your machine
-            save       (bool) : whether to save the output or not
-            output_dir  (str) : the directory to write the nearest neighbors per each user to
+            input_type        (str) : either "default" or "files" indicating where to find the needed index
+                                      files
+            file_names        (arr) : array of the three files mentioned above, can be left blank if using
+                                      "default" mode
+            user_cap          (int) : the number of top users that should be extracted in the approximate
+                                      mode, or to get the full list of possible neighbors pass in -1
+                                      (dot product > 0)
+            n_processes       (int) : number of processes danny should use when extracting possible
+                                      nearest neighbors. If left None, danny will use 2 less than the number
+                                      of cores available on your machine
+            save             (bool) : whether to save the output or not
+            output_dir        (str) : the directory to write the nearest neighbors per each user to
+            engine            (str) : how dot products are computed, "rowwise" (one mat-vec per user) or
+                                      "blocked" (one sparse x sparse^T product per block of users), see
+                                      matrix_multiplication_batch
+            block_size        (int) : number of users per block for the "blocked" engine
+            top_k        (int|None) : "blocked" engine only, number of most similar users to keep per user,
+                                      None keeps all of them
+            thresh          (float) : "blocked" engine only, minimum similarity for a user to be kept
+            as_dict          (bool) : only used when save=False, whether to return the results in the
+                                      dictionary format or as (user_id, array of user_ids, array of dot
+                                      products) tuples
+            output_format     (str) : how results are saved, "pickle" writes the dictionary format to
+                                      output_dir/similarity_scores.pickle, "columnar" writes the compact .npy
+                                      neighbor store described in neighbor_store to
+                                      output_dir/similarity_scores/, "sharded" streams the results, as they
+                                      arrive, to shards of that store in output_dir/similarity_scores_shards/
+                                      (see neighbor_store.ShardedNeighborWriter), so they are never all held
+                                      in memory
+            quantize         (bool) : "columnar" and "sharded" formats only, store scores as uint16 instead of
+                                      float32
+            start_method (str|None) : multiprocessing start method ("fork", "spawn" or "forkserver"), None
+                                      uses the platform's default
+            changed_users (arr|str) : user_ids whose rows of the index changed, or the name of a .npy file
+                                      holding them (e.g. output_dir/updated_users.npy written by
+                                      index_update.update_index). None computes every user
+            save_candidates  (bool) : write the pruned candidates to output_dir/candidates_*.npy and multiply
+                                      from the memory-mapped files
+            candidates_file   (str) : path + prefix of candidates saved by an earlier run (e.g.
+                                      output_dir/candidates), skips pruning. user_cap must be the same or
+                                      smaller than the one they were pruned with
+            hub_policy  (dict|None) : policy returned by resolve_hub_policy for skipping, or sampling, hub
+                                      entities while pruning, None walks every posting
+            symmetric        (bool) : exact mode only (user_cap=-1), compute the similarity of each pair of
+                                      users once and hand it to both (see matrix_multiplication_batch)
+            fused            (bool) : prune and compute dot products in one pool, see prune_and_multiply_batch
+            shard        (tup|None) : (index, count), only compute the index-th of count shards of the users
+                                      (index counting from 1), None computes every user
+            shard_scheme      (str) : how users are split into shards, one of sharding.SHARD_SCHEMES
+            checkpoint       (bool) : stream the results to checkpoints, so an interrupted run can be resumed
+            resume           (bool) : skip the users held by the checkpoints (or shards) of an interrupted run
+                                      with the same settings, and checkpoint the rest
 
         Returns:
-            bool | dict : if save=True then the function returns True if saving was successful, else
-                          it returns the dictionary it would otherwise save. The dictionary is of the
-                          following format: key - user_id | value - dict -- key - user_id, value: dot product
+            bool | dict | arr : if save=True then the function returns True if saving was successful, else
+                                it returns the dictionary it would otherwise save. The dictionary is of the
+                                following format: key - user_id | value - dict -- key - user_id,
+                                value: dot product
     """
-    #pylint: disable=too-many-arguments
+    #pylint: disable=too-many-arguments, too-many-locals, too-many-branches
     input_types = ["default", "files"]
     if input_type not in input_types:
         raise ValueError("input_type must be \"default\" or \"files\"")
@@ -587,37 +742,203 @@ def get_nearest_neighbors_batch(input_type="default", file_names=None, sparse=Tr
             files should be: 1. user_entity_dict, 2. entity_user_dict, 3. user_entity_matrix \
             and if needed 4. users_interested_in_array")
 
+    if engine not in ENGINES:
+        raise ValueError("engine must be one of {}".format(ENGINES))
+
+    if engine == "blocked" and not sparse:
+        raise ValueError("the \"blocked\" engine needs a sparse user_entity matrix")
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("output_format must be one of {}".format(OUTPUT_FORMATS))
+
+    if start_method not in START_METHODS:
+        raise ValueError("start_method must be one of {}".format(START_METHODS))
+
     if n_processes is not None and (not isinstance(n_processes, int) or n_processes > MAX_PROCESSES):
         raise ValueError("n_processes must be an int smaller than {}, as your computer only has {} \
             cores".format(MAX_PROCESSES, MAX_PROCESSES))
 
     user_entity_dict_file_name = file_names[0] if input_type == "files" else \
-                                 output_dir + "user_entity_dict.pickle"
+                                 output_dir + "user_entity_dict"
     entity_user_dict_file_name = file_names[1] if input_type == "files" else \
-                                 output_dir + "entity_user_dict.pickle"
+                                 output_dir + "entity_user_dict"
     user_entity_matrix_file_name = file_names[2] if input_type == "files" else \
-                                   output_dir + "user_entity_matrix.pickle"
+                                   output_dir + "user_entity_matrix"
 
     dict_file_names = [user_entity_dict_file_name, entity_user_dict_file_name]
-  
-    if len(file_names) == 4:
+
+    if input_type == "files" and len(file_names) == 4:
         dict_file_names.append(file_names[3])
 
-    user_tuples = prune_space_batch(dict_file_names, n_processes, user_cap)
+    if symmetric and user_cap != -1:
+        raise ValueError("symmetric only works in the exact mode (user_cap=-1)")
+
+    if symmetric and hub_policy is not None and hub_policy["policy"] == "sample":
+        raise ValueError("sampling hub entities makes the candidates asymmetric, use the skip policy with \
+                          symmetric")
+
+    if fused and (save_candidates or candidates_file is not None or symmetric):
+        raise ValueError("the fused mode keeps the candidates in the workers, so they can't be saved, reused \
+                          or computed symmetrically")
+
+    if candidates_file is not None and changed_users is not None:
+        raise ValueError("saved candidates can't be reused when only recomputing changed_users")
+
+    if save and output_format == "sharded" and (changed_users is not None or symmetric):
+        raise ValueError("sharded results are streamed out from scratch, so they can't be patched with \
+                          changed_users or computed symmetrically")
+
+    if shard is not None and (changed_users is not None or symmetric):
+        raise ValueError("a shard is streamed out to its own part of the results, so it can't be patched \
+                          with changed_users or computed symmetrically")
+
+    if (checkpoint or resume) and (not save or changed_users is not None or symmetric or
+                                   output_format == "pickle"):
+        raise ValueError("checkpoints are the saved columnar results of the users done so far, so they \
+                          can't be taken when not saving, patching changed_users, computing symmetrically \
+                          or saving in the pickle format")
+
+    user_ids = None
+    if shard is not None or resume:
+        start_time = time.time()
+        user_entity_dict = read_index_file(user_entity_dict_file_name)
+        if len(dict_file_names) == 3:
+            user_ids = np.asarray(read_pickle_file(dict_file_names[2]), dtype=np.int64)
+        else:
+            user_ids = np.flatnonzero(np.diff(user_entity_dict.indptr))
+        if shard is not None:
+            user_ids = shard_user_ids(user_ids, shard, user_entity_dict.shape[0], shard_scheme)
+            logging.info("shard %s of %s (%s) holds %s users, picked in %s seconds", shard[0], shard[1],
+                         shard_scheme, len(user_ids), time.time() - start_time)
+        del user_entity_dict
+
+    if changed_users is not None:
+        start_time = time.time()
+        changed_users = np.load(changed_users) if isinstance(changed_users, str) else changed_users
+        user_ids = find_affected_users(changed_users, read_index_file(user_entity_dict_file_name),
+                                       read_index_file(entity_user_dict_file_name))
+        logging.info("found %s users affected by %s changed users in %s seconds", len(user_ids),
+                     len(changed_users), time.time() - start_time)
+
+    result_writer = None
+    checkpoint_dir = None
+    if save and (shard is not None or output_format == "sharded" or checkpoint or resume):
+        if shard is not None:
+            writer_path = shard_part_path(output_dir, shard)
+        elif output_format == "sharded":
+            writer_path = output_dir + "similarity_scores_shards/"
+        else:
+            writer_path = checkpoint_dir = output_dir + CHECKPOINT_DIR
+        meta = {"user_cap": user_cap, "engine": engine, "top_k": top_k, "thresh": thresh,
+                "hub_policy": describe_hub_policy(hub_policy),
+                "shard": list(shard) if shard is not None else None, "shard_scheme": shard_scheme}
+        flush_seconds = CHECKPOINT_SECONDS if checkpoint or resume else None
+        result_writer = ShardedNeighborWriter(writer_path, quantize=quantize, meta=meta,
+                                              flush_seconds=flush_seconds, resume=resume)
+
+    if resume:
+        completed_user_ids = result_writer.completed_user_ids()
+        user_ids = np.setdiff1d(user_ids, completed_user_ids)
+        logging.info("resuming from %s, %s users were completed, %s users are left", writer_path,
+                     len(completed_user_ids), len(user_ids))
+        if not len(user_ids):
+            return _save_similarity_scores(None, save, output_dir, output_format, quantize, changed_users,
+                                           result_writer, checkpoint_dir)
+
+    if fused:
+        dict_file_names.insert(2, user_entity_matrix_file_name)
+        similarity_scores = prune_and_multiply_batch(dict_file_names, n_processes, sparse, user_cap,
+                                                     engine=engine, block_size=block_size, top_k=top_k,
+                                                     thresh=thresh,
+                                                     as_dict=output_format == "pickle" if save else as_dict,
+                                                     start_method=start_method, user_ids=user_ids,
+                                                     hub_policy=hub_policy, result_writer=result_writer)
+        return _save_similarity_scores(similarity_scores, save, output_dir, output_format, quantize,
+                                       changed_users, result_writer, checkpoint_dir)
+
+    candidates = None
+    candidate_cap = None
+    if candidates_file is not None:
+        candidate_cap = user_cap
+    elif save_candidates:
+        prune_space_batch(dict_file_names, n_processes, user_cap, start_method=start_method,
+                          user_ids=user_ids, save=True, output_dir=output_dir, hub_policy=hub_policy)
+        candidates_file = output_dir + "candidates"
+    else:
+        candidates = prune_space_batch(dict_file_names, n_processes, user_cap, start_method=start_method,
+                                       user_ids=user_ids, hub_policy=hub_policy)
     gc.collect()
 
-    similarity_scores = matrix_multiplication_batch(user_entity_matrix_file_name,
-                                                    user_tuples,
+    matrix_file_names = [user_entity_matrix_file_name]
+    if candidates_file is not None:
+        matrix_file_names.append(candidates_file)
+
+    similarity_scores = matrix_multiplication_batch(matrix_file_names,
+                                                    candidates,
                                                     n_processes,
-                                                    sparse)
-    del user_tuples
+                                                    sparse,
+                                                    engine=engine,
+                                                    block_size=block_size,
+                                                    top_k=top_k,
+                                                    thresh=thresh,
+                                                    as_dict=output_format == "pickle" if save else as_dict,
+                                                    start_method=start_method,
+                                                    candidate_cap=candidate_cap,
+                                                    symmetric=symmetric,
+                                                    result_writer=result_writer,
+                                                    user_ids=user_ids)
+    del candidates
     gc.collect()
 
-    if save:
+    return _save_similarity_scores(similarity_scores, save, output_dir, output_format, quantize,
+                                   changed_users, result_writer, checkpoint_dir)
+
+def _save_similarity_scores(similarity_scores, save, output_dir, output_format, quantize, changed_users,
+                            result_writer=None, checkpoint_dir=None):
+    """
+        Saves the similarity scores computed by get_nearest_neighbors_batch in the requested format, or
+        hands them back when they should not be saved
+
+        Params:
+            similarity_scores (dict|arr) : dictionary format for "pickle", result tuples otherwise
+            save                 (bool) : whether to save the similarity scores or not
+            output_dir            (str) : the directory to write the similarity scores to
+            output_format         (str) : "columnar", "pickle" or "sharded"
+            quantize             (bool) : "columnar" format only, store scores as uint16 instead of float32
+            changed_users     (arr|None) : when only changed users were computed, their scores are patched
+                                          into the ones already saved in output_dir
+            result_writer (ShardedNeighborWriter|None) : writer the scores were streamed to, closed here
+            checkpoint_dir   (str|None) : when the writer only wrote checkpoints, the directory they are in,
+                                          they are merged into output_dir/similarity_scores/ and removed
+
+        Returns:
+            bool | dict | arr : True once saved, else the similarity scores
+    """
+    #pylint: disable=too-many-arguments
+    if not save:
+        return similarity_scores
+
+    if result_writer is not None:
+        manifest = result_writer.close()
+        logging.info("wrote the neighbors of %s users to %s shards in %s", manifest["n_users"],
+                     len(manifest["shards"]), result_writer.output_path)
+        if checkpoint_dir is not None:
+            merge_shards([checkpoint_dir], output_dir + "similarity_scores/", quantize)
+            shutil.rmtree(checkpoint_dir)
+        return True
+
+    if output_format == "pickle":
         similarity_scores_file_name = output_dir + "similarity_scores.pickle"
+        if changed_users is not None and os.path.exists(similarity_scores_file_name):
+            stored_similarity_scores = read_pickle_file(similarity_scores_file_name)
+            stored_similarity_scores.update(similarity_scores)
+            similarity_scores = stored_similarity_scores
         write_pickle_file(similarity_scores, similarity_scores_file_name)
+    elif changed_users is not None:
+        patch_neighbor_store(output_dir + "similarity_scores/", results_to_columns(similarity_scores),
+                             quantize=quantize or None)
+    else:
+        write_neighbor_store(results_to_columns(similarity_scores), output_dir + "similarity_scores/",
+                             quantize=quantize)
 
-        del similarity_scores
-        return True
-  
-    return similarity_scores
+    return True
@@ -0,0 +1,407 @@
+"""
+    Reading danny's log files and building the partitions of its dictionaries from them. A log is either a
+    csv of user_id,entity_id lines, or a binary edge log: a .npy file with one row per edge (user_id,
+    entity_id and optionally the number of visits), see convert_log_file.
+
+    Logs are never read whole. They are split into ranges of about equal size (split_log_ranges) that the pool
+    workers read on their own, parsing the lines of csv ranges with numpy (_parse_log_block) or slicing the
+    memory-mapped edge log. create_dictionaries (in supporting_functions) then builds the dictionaries as a
+    map and a reduce over these ranges:
+        1. map: the edges of each range are spilled to disk split into partitions, once by user and once by
+           entity (partition_log_range)
+        2. reduce: each partition is read back and its rows are built with the counts of repeated edges
+           summed (build_partition), no other partition holds any of these rows
+        3. the rows of all partitions are stitched into one set of compressed arrays (stitch_partitions)
+
+    Important functions:
+        1. convert_log_file
+        2. read_edge_log
+"""
+import logging
+from multiprocessing import Pool, cpu_count
+import os
+import tempfile
+import time
+import numpy as np
+from scipy.sparse import coo_matrix
+
+DEFAULT_DIR = "output_data/"
+MAX_PROCESSES = cpu_count()
+MAX_LOG_CHUNK_BYTES = 8 * 2 ** 20
+POWERS_OF_TEN = 10 ** np.arange(19, dtype=np.int64)
+
+def is_edge_log(file_name):
+    """
+        Whether a log file is a binary edge log (see convert_log_file) rather than a text csv log
+
+        Params:
+            file_name (str) : name of the log file
+
+        Returns:
+            bool : True for binary edge logs
+    """
+    return file_name.endswith(".npy")
+
+def read_edge_log(file_name, mmap=True):
+    """
+        Opens a binary edge log written by convert_log_file, memory-mapped by default. An edge log is a .npy
+        file holding an int32 or int64 array with one row per edge: user_id, entity_id and optionally the
+        number of times the user visited the entity (when there is no third column the count is 1).
+
+        Params:
+            file_name (str) : name of the .npy edge log
+            mmap     (bool) : memory-map the array instead of reading it into memory
+
+        Returns:
+            arr : array of shape (number of edges, 2 or 3)
+    """
+    edge_log = np.load(file_name, mmap_mode="r" if mmap else None)
+    if edge_log.ndim != 2 or edge_log.shape[1] not in (2, 3) or edge_log.dtype not in (np.int32, np.int64):
+        raise ValueError("an edge log must be an int32 or int64 array of shape (n, 2) or (n, 3)")
+
+    return edge_log
+
+def split_log_ranges(log_file, n_ranges):
+    """
+        Splits a log file into ranges of roughly equal size, without reading it. For text logs the
+        boundaries are raw byte offsets, it is up to _read_log_range to align them to whole lines. For binary
+        edge logs they are row numbers.
+
+        Params:
+            log_file (str) : name of the log file, a csv or a binary edge log
+            n_ranges (int) : minimum number of ranges wanted, more are used if the ranges would otherwise be
+                             larger than MAX_LOG_CHUNK_BYTES
+
+        Returns:
+            arr : each element is a tuple (log_file, start, end), bytes or rows [start, end) of the file
+    """
+    if is_edge_log(log_file):
+        edge_log = read_edge_log(log_file)
+        file_size = edge_log.nbytes
+        n_items = edge_log.shape[0]
+    else:
+        file_size = os.path.getsize(log_file)
+        n_items = file_size
+
+    n_ranges = max(n_ranges, -(-file_size // MAX_LOG_CHUNK_BYTES), 1)
+    boundaries = np.linspace(0, n_items, n_ranges + 1).astype(np.int64).tolist()
+
+    return [(log_file, start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+def _read_log_range(raw_log_file, start, end):
+    """
+        Reads the lines of a log file that start within the byte range [start, end) as one block of bytes.
+        A range that begins in the middle of a line skips that line, as it belongs to the previous range, and
+        the last line read may run past end. This way every line is read by exactly one range, no matter
+        where the boundaries fall.
+
+        Params:
+            raw_log_file (str) : name of the log file
+            start        (int) : first byte of the range
+            end          (int) : byte after the last byte of the range
+
+        Returns:
+            bytes : the whole lines of the range
+    """
+    with open(raw_log_file, "rb") as logs:
+        if start > 0:
+            logs.seek(start - 1)
+            logs.readline()
+        block_start = logs.tell()
+        if block_start >= end:
+            return b""
+
+        logs.seek(end - 1)
+        logs.readline()
+        block_end = logs.tell()
+
+        logs.seek(block_start)
+        return logs.read(block_end - block_start)
+
+def _parse_log_block(block):
+    """
+        Parses a block of log lines of the format user_id,entity_id into two int arrays, without creating
+        a Python object per line. The bytes are viewed as a uint8 array, every run of digits between two
+        separators (a comma or a newline) becomes one field, whose value is the sum of its digits times the
+        matching powers of ten. Any other bytes (spaces, carriage returns) are ignored, and lines that do not
+        have a user_id and an entity_id (blank lines, a header) are skipped.
+
+        Params:
+            block (bytes) : whole lines of the log file, see _read_log_range
+
+        Returns:
+            tup : (array of user_ids, array of entity_ids), both int64, one element per line
+    """
+    chars = np.frombuffer(block, dtype=np.uint8)
+    is_newline = chars == ord("\n")
+    is_separator = is_newline | (chars == ord(","))
+    separators = np.flatnonzero(is_separator)
+    n_fields = len(separators) + 1
+
+    digit_positions = np.flatnonzero((chars >= ord("0")) & (chars <= ord("9")))
+    digit_fields = np.cumsum(is_separator, dtype=np.int64)[digit_positions]
+    digits_per_field = np.bincount(digit_fields, minlength=n_fields)
+    field_ends = np.cumsum(digits_per_field)
+    exponents = field_ends[digit_fields] - 1 - np.arange(len(digit_positions))
+    terms = (chars[digit_positions] - ord("0")) * POWERS_OF_TEN[exponents]
+
+    has_digits = digits_per_field > 0
+    values = np.zeros(n_fields, dtype=np.int64)
+    values[has_digits] = np.add.reduceat(terms, (field_ends - digits_per_field)[has_digits])
+
+    starts_line = np.ones(n_fields, dtype=bool)
+    starts_line[1:] = is_newline[separators]
+    line_of_field = np.cumsum(starts_line) - 1
+    column = np.arange(n_fields) - np.flatnonzero(starts_line)[line_of_field]
+
+    n_lines = line_of_field[-1] + 1
+    user_ids = np.full(n_lines, -1, dtype=np.int64)
+    entity_ids = np.full(n_lines, -1, dtype=np.int64)
+    user_fields = (column == 0) & has_digits
+    entity_fields = (column == 1) & has_digits
+    user_ids[line_of_field[user_fields]] = values[user_fields]
+    entity_ids[line_of_field[entity_fields]] = values[entity_fields]
+
+    complete = (user_ids >= 0) & (entity_ids >= 0)
+
+    return (user_ids[complete], entity_ids[complete])
+
+def read_log_edges(log_range):
+    """
+        Reads the edges of one range of a log file, parsing it when it is a text log (see _parse_log_block)
+        or slicing the memory-mapped array when it is a binary edge log
+
+        Params:
+            log_range (tup) : (log file name, start, end), see split_log_ranges
+
+        Returns:
+            tup : (array of user_ids, array of entity_ids, array of counts or None when every count is 1)
+    """
+    log_file, start, end = log_range
+    if not is_edge_log(log_file):
+        return _parse_log_block(_read_log_range(log_file, start, end)) + (None,)
+
+    edges = np.asarray(read_edge_log(log_file)[start:end], dtype=np.int64)
+    counts = edges[:, 2] if edges.shape[1] == 3 else None
+
+    return (edges[:, 0], edges[:, 1], counts)
+
+def _create_edges(log_range, one_hot):
+    """
+        Function called by pool workers to parralelize the process of turning the expected log file format
+        into edges of the user-entity count matrix. The range is read with read_log_edges into COO
+        coordinates, and converting those to CSR sums the counts of repeated (user_id, entity_id) pairs,
+        which are clipped to 1 for one hot encoding.
+
+        The original log file is split into ranges, each for a pool worker to read and consume, the edges are
+        then spilled to disk partitioned by user and entity (see partition_log_range)
+
+        Params:
+            log_range (tup) : (log file name, start, end), see split_log_ranges. Lines of text logs are of the
+                              following format: user_id, entity_id
+            one_hot  (bool) : use 1 instead of the true count
+
+        Returns:
+            arr : int64 array of shape (number of edges, 3), each row is user_id, entity_id, count
+    """
+    user_ids, entity_ids, counts = read_log_edges(log_range)
+    if len(user_ids) == 0:
+        return np.empty((0, 3), dtype=np.int64)
+
+    counts = np.ones(len(user_ids), dtype=np.int64) if counts is None else counts
+    range_user_ids, rows = np.unique(user_ids, return_inverse=True)
+    counts = coo_matrix((counts, (rows, entity_ids)),
+                        shape=(len(range_user_ids), int(entity_ids.max()) + 1)).tocsr()
+    del user_ids, entity_ids, rows
+    if one_hot:
+        np.minimum(counts.data, 1, out=counts.data)
+
+    edges = np.empty((counts.nnz, 3), dtype=np.int64)
+    edges[:, 0] = np.repeat(range_user_ids, np.diff(counts.indptr))
+    edges[:, 1] = counts.indices
+    edges[:, 2] = counts.data
+
+    return edges
+
+def partition_log_range(args):
+    """
+        Map phase of create_dictionaries, called by pool workers. Builds the edges of one range of the
+        log file (see _create_edges), and spills them to disk split into n_partitions partitions twice:
+        once by user_id % n_partitions (for the user-entity side) and once by entity_id % n_partitions (for
+        the entity-user side). Partition p of a side is written to <spill_dir>/<side>_<p>_<range number>.npy
+
+        Params:
+            args (tup) : (log_range, range number, one_hot, n_partitions, spill_dir), see split_log_ranges for
+                         log_range
+
+        Returns:
+            bool : True on completion
+    """
+    log_range, range_number, one_hot, n_partitions, spill_dir = args
+    edges = _create_edges(log_range, one_hot)
+
+    for side, column in (("user", 0), ("entity", 1)):
+        partition_ids = edges[:, column] % n_partitions
+        for partition in range(n_partitions):
+            np.save(os.path.join(spill_dir, "{}_{}_{}.npy".format(side, partition, range_number)),
+                    edges[partition_ids == partition])
+
+    return True
+
+def build_partition(args):
+    """
+        Reduce phase of create_dictionaries, called by pool workers. Loads every spilled edge of one
+        partition and builds the rows that partition owns: the users (or entities) in it, their number of
+        entries, and the entries themselves with the counts of duplicate edges summed. As a user (or entity)
+        only lives in one partition, no other worker ever touches its row, so nothing has to be merged.
+
+        Params:
+            args (tup) : (side, partition, number of log ranges, one_hot, spill_dir), side is "user" for the
+                         user-entity dict (rows - users) or "entity" for the entity-user dict
+                         (rows - entities)
+
+        Returns:
+            tup : (row ids, row lengths, column ids, counts), row ids sorted ascending and the column ids of
+                  each row sorted ascending
+    """
+    side, partition, n_ranges, one_hot, spill_dir = args
+    edges = np.concatenate([np.load(os.path.join(spill_dir, "{}_{}_{}.npy".format(side, partition, i)))
+                            for i in range(n_ranges)])
+    major, minor = (edges[:, 0], edges[:, 1]) if side == "user" else (edges[:, 1], edges[:, 0])
+
+    keys = major * (int(minor.max()) + 1 if len(minor) > 0 else 1) + minor
+    order = np.argsort(keys)
+    keys = keys[order]
+    counts = edges[order, 2]
+    del edges
+
+    new_entry = np.ones(len(keys), dtype=bool)
+    np.not_equal(keys[1:], keys[:-1], out=new_entry[1:])
+    entry_starts = np.flatnonzero(new_entry)
+    major = major[order[entry_starts]]
+    minor = minor[order[entry_starts]]
+
+    if one_hot:
+        counts = np.ones(len(entry_starts), dtype=np.int32)
+    else:
+        counts = np.add.reduceat(counts, entry_starts).astype(np.int32)
+
+    row_ids, row_lengths = np.unique(major, return_counts=True)
+
+    return (row_ids, row_lengths, minor.astype(np.int32), counts)
+
+def stitch_partitions(partitions, n_rows):
+    """
+        Places the rows built by the build_partition workers into one set of compressed arrays with a
+        vectorized scatter, no row is copied more than once. Rows missing from every partition are empty.
+
+        Params:
+            partitions (arr) : each element is a tuple (row ids, row lengths, column ids, values), as returned
+                               by build_partition
+            n_rows     (int) : number of rows (users or entities) of the full dictionary
+
+        Returns:
+            tup : (data, indices, indptr) arrays, as taken by the csr_matrix / csc_matrix constructors
+    """
+    row_lengths = np.zeros(n_rows, dtype=np.int64)
+    for row_ids, lengths, _, _ in partitions:
+        row_lengths[row_ids] = lengths
+
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(row_lengths, out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    data = np.empty(indptr[-1], dtype=np.result_type(*[counts.dtype for _, _, _, counts in partitions]))
+
+    for row_ids, lengths, columns, counts in partitions:
+        local_starts = np.cumsum(lengths) - lengths
+        positions = np.arange(len(columns)) + np.repeat(indptr[row_ids] - local_starts, lengths)
+        indices[positions] = columns
+        data[positions] = counts
+
+    return (data, indices, indptr)
+
+def _convert_log_range(args):
+    """
+        Function called by pool workers to convert one range of a log file into edges, written to
+        <parts_dir>/<range number>.npy. Without counts the edges keep the order of the log (an edge with a
+        count above 1 in a binary edge log is repeated), with counts repeated pairs of the range are summed.
+
+        Params:
+            args (tup) : (log_range, range number, with_counts, parts_dir), see split_log_ranges for log_range
+
+        Returns:
+            tup : (number of edges written, largest user_id or entity_id written)
+    """
+    log_range, range_number, with_counts, parts_dir = args
+    if with_counts:
+        edges = _create_edges(log_range, one_hot=False)
+    else:
+        user_ids, entity_ids, counts = read_log_edges(log_range)
+        if counts is not None:
+            user_ids = np.repeat(user_ids, counts)
+            entity_ids = np.repeat(entity_ids, counts)
+        edges = np.column_stack((user_ids, entity_ids))
+
+    np.save(os.path.join(parts_dir, "{}.npy".format(range_number)), edges)
+
+    return (edges.shape[0], int(edges[:, :2].max()) if edges.shape[0] > 0 else 0)
+
+def convert_log_file(raw_log_file, output_file=None, with_counts=False, n_processes=None,
+                     output_dir=DEFAULT_DIR):
+    """
+        Converts a csv log file (user_id, entity_id) into a binary edge log: a .npy file holding one row per
+        edge, user_id, entity_id and, with_counts, the number of times user_id visited entity_id. The ids are
+        stored as int32, or int64 if they do not fit. Every build step (reindex_log_file,
+        create_dictionaries) accepts edge logs in place of the csv and memory-maps them, so logs that get
+        rebuilt often only need to be parsed once.
+
+        The log is converted in parallel ranges (see split_log_ranges) that are then copied into the edge log
+        in order.
+
+        Params:
+            raw_log_file     (str) : name of the csv log file to convert
+            output_file (str|None) : name of the edge log to write, if None it is written to output_dir with
+                                     the name of the log file and a .npy extension
+            with_counts     (bool) : add a count column, summing repeated (user_id, entity_id) pairs. Pairs
+                                     are only summed within a range, so a pair can still appear more than
+                                     once, which every build step handles
+            n_processes      (int) : number of processes to use, if left None, danny will use 2 less than the
+                                     number of cores available on your machine
+            output_dir       (str) : the directory to write the edge log to if output_file is None
+
+        Returns:
+            bool : True on completion
+    """
+    n_processes = MAX_PROCESSES - 2 if n_processes is None else n_processes
+    if output_file is None:
+        output_file = output_dir + os.path.splitext(os.path.basename(raw_log_file))[0] + ".npy"
+    if not is_edge_log(output_file):
+        raise ValueError("the edge log must be written to a .npy file")
+
+    start_time = time.time()
+    log_ranges = split_log_ranges(raw_log_file, n_processes)
+    pool = Pool(processes=n_processes)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(output_file) or None) as parts_dir:
+        parts = pool.map(_convert_log_range, [(log_range, i, with_counts, parts_dir)
+                                              for i, log_range in enumerate(log_ranges)])
+        pool.close()
+        pool.join()
+        logging.info("converted %s ranges in %s seconds", len(log_ranges), time.time() - start_time)
+        start_time = time.time()
+
+        n_edges = sum(part[0] for part in parts)
+        dtype = np.int32 if max(part[1] for part in parts) <= np.iinfo(np.int32).max else np.int64
+        edge_log = np.lib.format.open_memmap(output_file, mode="w+", dtype=dtype,
+                                             shape=(n_edges, 3 if with_counts else 2))
+        position = 0
+        for i, part in enumerate(parts):
+            edge_log[position:position + part[0]] = np.load(os.path.join(parts_dir, "{}.npy".format(i)))
+            position += part[0]
+
+        edge_log.flush()
+        del edge_log
+
+    logging.info("wrote out edge log in %s seconds", time.time() - start_time)
+
+    return True
@@ -0,0 +1,228 @@
+"""
+    Updating an index danny already built with new logs (a delta log), instead of rebuilding it from every
+    log. New users and entities are appended to the index, the delta's counts are added to the rows of the
+    users and entities it holds, and only those users' rows of the user_entity_matrix are renormalized. The
+    changed rows are appended to the index files as segments (see supporting_functions.append_index_segment),
+    so an update reads and writes the rows it touches rather than the whole index (see update_index).
+
+    Important Functions:
+        1. update_index
+"""
+import logging
+import os
+import tempfile
+import time
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.preprocessing import normalize
+from supporting_functions import bump_index_version, save_array, create_dictionaries, entity_hub_stats
+from supporting_functions import append_index_segment, old_to_new_ids, read_index_file, read_index_meta
+from supporting_functions import read_index_rows, reindex_log_file, replace_index_rows, write_index_file
+
+DEFAULT_DIR = "output_data/"
+COMPACT_RATIO = 0.5
+
+def _pad_rows(matrix, shape):
+    """
+        Grows a CSR matrix to a larger shape, the new rows are empty. Only indptr is extended, the indices
+        and data arrays are not copied
+
+        Params:
+            matrix (csr_matrix) : the matrix to pad
+            shape         (tup) : the new (number of rows, number of columns), at least matrix.shape
+
+        Returns:
+            csr_matrix : the padded matrix
+    """
+    indptr = np.concatenate([matrix.indptr, np.full(shape[0] - matrix.shape[0], matrix.indptr[-1],
+                                                    dtype=matrix.indptr.dtype)])
+
+    return csr_matrix((matrix.data, matrix.indices, indptr), shape=shape, copy=False)
+
+def _map_delta_ids(delta_log, n_processes, output_dir, parts_dir):
+    """
+        Maps the ids of a delta log to the ids of the index in output_dir, if the index was built from a log
+        reindexed by reindex_log_file. Ids found in the reverse indexes it saved get the new id they were
+        handed (see old_to_new_ids), ids the index has never seen get the next free ids, in the order they
+        first appear in the delta, as reindexing the full log would have. Without reverse indexes in
+        output_dir the ids of the delta are taken as they are.
+
+        Params:
+            delta_log   (str) : name of the log file with the new logs, a csv or a binary edge log (.npy)
+            n_processes (int) : number of processes used to reindex the delta log
+            output_dir  (str) : the directory the index was written to
+            parts_dir   (str) : directory to write the mapped delta log to
+
+        Returns:
+            tup : (name of the log file with the ids of the index, list of the user and entity reverse
+                   indexes with the new ids appended or None if output_dir has no reverse indexes)
+    """
+    # pylint: disable=too-many-locals
+    reverse_index_files = [output_dir + "user_reverse_index.npy", output_dir + "entity_reverse_index.npy"]
+    if not all(os.path.exists(file_name) for file_name in reverse_index_files):
+        return (delta_log, None)
+
+    delta_edges, delta_user_ids, delta_entity_ids = reindex_log_file(delta_log, save=False,
+                                                                     n_processes=n_processes)
+    reverse_indexes = []
+    for column, file_name, delta_ids in ((0, reverse_index_files[0], delta_user_ids),
+                                         (1, reverse_index_files[1], delta_entity_ids)):
+        reverse_index = np.load(file_name)
+        known = np.isin(delta_ids, reverse_index)
+        index_ids = np.empty(len(delta_ids), dtype=np.int64)
+        index_ids[known] = old_to_new_ids(reverse_index, delta_ids[known])
+        index_ids[~known] = len(reverse_index) + np.arange(np.count_nonzero(~known))
+        delta_edges[:, column] = index_ids[delta_edges[:, column]]
+
+        reverse_index = np.concatenate([reverse_index, delta_ids[~known]])
+        dtype = np.int32 if len(reverse_index) == 0 or reverse_index.max() <= np.iinfo(np.int32).max \
+                else np.int64
+        reverse_indexes.append(reverse_index.astype(dtype))
+
+    mapped_log = os.path.join(parts_dir, "delta.npy")
+    np.save(mapped_log, delta_edges)
+
+    return (mapped_log, reverse_indexes)
+
+def _add_delta_rows(file_name, delta, one_hot):
+    """
+        Adds the non empty rows of delta to the same rows of one of the dictionaries, reading only those rows
+        of the dictionary (see read_index_rows)
+
+        Params:
+            file_name    (str) : path + prefix of the dictionary
+            delta (csr_matrix) : the counts to add, rows along the compressed axis of the dictionary, padded
+                                 to the shape of the updated index
+            one_hot     (bool) : clip the summed counts to 1
+
+        Returns:
+            tup : (sorted ids of the rows that changed, CSR matrix of the summed rows)
+    """
+    row_ids = np.flatnonzero(np.diff(delta.indptr))
+    rows = read_index_rows(file_name, row_ids)
+    rows = csr_matrix((rows.data, rows.indices, rows.indptr), shape=(len(row_ids), delta.shape[1]))
+    rows = (rows + delta[row_ids]).tocsr()
+    rows.sort_indices()
+    if one_hot:
+        np.minimum(rows.data, 1, out=rows.data)
+
+    return (row_ids, rows)
+
+def _append_rows(file_name, row_ids, rows, shape):
+    """
+        Appends the changed rows of one part of the index as a segment (see append_index_segment), and
+        writes the part in full again once its segments hold more than COMPACT_RATIO times the values of its
+        own files, so reading the part never costs much more than reading it without segments
+
+        Params:
+            file_name    (str) : path + prefix of the part
+            row_ids      (arr) : sorted ids of the changed rows
+            rows  (csr_matrix) : the changed rows
+            shape        (tup) : shape of the updated part
+
+        Returns:
+            bool : True if the part was written in full
+    """
+    segment_entries, part_entries = append_index_segment(rows, row_ids, shape, file_name)
+    if segment_entries <= COMPACT_RATIO * part_entries:
+        return False
+
+    start_time = time.time()
+    write_index_file(read_index_file(file_name, mmap=False), file_name)
+    logging.info("compacted %s in %s seconds", file_name, time.time() - start_time)
+
+    return True
+
+def update_index(delta_log, one_hot=None, n_processes=None, save=True, output_dir=DEFAULT_DIR):
+    """
+        Updates danny's index in output_dir with new logs, instead of rebuilding it from every log. The
+        delta log is turned into small dictionaries (see create_dictionaries), then:
+            1. if the index was built from a log reindexed by reindex_log_file, the delta is expected in the
+               same ids as that log and is mapped through the saved reverse indexes (see _map_delta_ids).
+               Otherwise its ids are taken as they are, new users and entities must then follow on from the
+               ids already in the index
+            2. users and entities that are new to the index are appended
+            3. the delta counts are added to the rows of the users (user_entity_dict) and entities
+               (entity_user_dict) in the delta, clipped to 1 for one hot indicies
+            4. only the rows of the user_entity_matrix of the users in the delta are renormalized
+
+        Only the rows in the delta are read (see read_index_rows), summed and renormalized, and they are
+        appended to the index files as segments (see append_index_segment) instead of writing every file
+        again, so the index files are updated in place at a cost proportional to the size of the delta. The
+        degree arrays, and the reverse indexes if there are any, hold one value per user or entity and are
+        written in full. Reading the index back (see read_index_file) applies the segments, and once a
+        part's segments hold more than COMPACT_RATIO times the values of the part itself it is written in
+        full again, so the cost of that stays proportional to the deltas it folds in. The index version (see
+        read_index_meta) is bumped, and the users whose rows changed are written to
+        output_dir/updated_users.npy, which is the input get_nearest_neighbors_batch needs to refresh only
+        the affected neighbors.
+
+        Params:
+            delta_log   (str) : name of the log file with the new logs, a csv or a binary edge log (.npy)
+            one_hot    (bool) : whether the index is one hot encoded, if None the setting the index was built
+                                with is used
+            n_processes (int) : number of processes used to read in the delta log, if left None, danny will
+                                use 2 less than the number of cores available on your machine
+            save       (bool) : whether to save the updated index or not
+            output_dir  (str) : the directory the index was written to
+
+        Returns:
+            tup | bool : if the results are not to be saved the function returns:
+                         (user_entity_dict, entity_user_dict, user_entity_matrix, updated user_ids)
+                         else it returns True to indicate the index was updated
+    """
+    # pylint: disable=too-many-locals
+    one_hot = read_index_meta(output_dir)["one_hot"] if one_hot is None else one_hot
+    with tempfile.TemporaryDirectory(dir=output_dir if save else None) as parts_dir:
+        mapped_log, reverse_indexes = _map_delta_ids(delta_log, n_processes, output_dir, parts_dir)
+        delta_user_entity_dict, delta_entity_user_dict = create_dictionaries(mapped_log, one_hot=one_hot,
+                                                                             n_processes=n_processes,
+                                                                             save=False)
+    start_time = time.time()
+    user_degrees = read_index_file(output_dir + "user_degrees")
+    entity_degrees = read_index_file(output_dir + "entity_degrees")
+    shape = (max(len(user_degrees), delta_user_entity_dict.shape[0]),
+             max(len(entity_degrees), delta_user_entity_dict.shape[1]))
+
+    updated_users, user_rows = _add_delta_rows(output_dir + "user_entity_dict",
+                                               _pad_rows(delta_user_entity_dict, shape), one_hot)
+    updated_entities, entity_rows = _add_delta_rows(output_dir + "entity_user_dict",
+                                                    _pad_rows(delta_entity_user_dict.T, shape[::-1]), one_hot)
+    del delta_user_entity_dict, delta_entity_user_dict
+    logging.info("added the delta to %s users in %s seconds", len(updated_users), time.time() - start_time)
+    start_time = time.time()
+
+    matrix_rows = normalize(user_rows.astype(np.float64))
+    logging.info("renormalized %s rows of the matrix in %s seconds", len(updated_users),
+                 time.time() - start_time)
+
+    if not save:
+        return (replace_index_rows(read_index_file(output_dir + "user_entity_dict"), updated_users, user_rows,
+                                   shape),
+                replace_index_rows(read_index_file(output_dir + "entity_user_dict"), updated_entities,
+                                   entity_rows, shape),
+                replace_index_rows(read_index_file(output_dir + "user_entity_matrix"), updated_users,
+                                   matrix_rows, shape),
+                updated_users)
+
+    start_time = time.time()
+    _append_rows(output_dir + "user_entity_dict", updated_users, user_rows, shape)
+    _append_rows(output_dir + "entity_user_dict", updated_entities, entity_rows, shape)
+    _append_rows(output_dir + "user_entity_matrix", updated_users, matrix_rows, shape)
+
+    user_degrees = np.concatenate([user_degrees, np.zeros(shape[0] - len(user_degrees), dtype=np.int32)])
+    user_degrees[updated_users] = np.diff(user_rows.indptr)
+    entity_degrees = np.concatenate([entity_degrees, np.zeros(shape[1] - len(entity_degrees),
+                                                              dtype=np.int32)])
+    entity_degrees[updated_entities] = np.diff(entity_rows.indptr)
+    write_index_file(user_degrees, output_dir + "user_degrees")
+    write_index_file(entity_degrees, output_dir + "entity_degrees")
+    if reverse_indexes is not None:
+        save_array(reverse_indexes[0], output_dir + "user_reverse_index.npy")
+        save_array(reverse_indexes[1], output_dir + "entity_reverse_index.npy")
+
+    save_array(updated_users.astype(np.int32), output_dir + "updated_users.npy")
+    version = bump_index_version(one_hot, output_dir, entity_hub_stats(entity_degrees))
+    logging.info("updated index saved as version %s in %s seconds", version, time.time() - start_time)
+
+    return True
@@ -0,0 +1,461 @@
+"""
+    Compact, columnar storage for danny's nearest neighbor results. Instead of pickling a dictionary of
+    dictionaries (key - user_id | value - dict -- key - user_id, value: dot product), the results are stored
+    the same way a CSR matrix is, as a directory of .npy files:
+        1. user_ids.npy     : int32, the users whose neighbors are stored, sorted ascending
+        2. indptr.npy       : int64, neighbors of user_ids[i] live in positions indptr[i]:indptr[i + 1]
+        3. neighbor_ids.npy : int32, user_ids of the neighbors
+        4. scores.npy       : float32 dot products, or uint16 dot products * 10000 when quantized
+
+    Within a user the neighbors are ordered from the most to the least similar, so the first n entries of a
+    user are their top-n neighbors.
+
+    As every file is a plain .npy file they can be memory-mapped (numpy.load(..., mmap_mode="r")), so a
+    single user's neighbors can be looked up without reading the whole result set into memory.
+
+    Results can also be streamed out while they are computed (see ShardedNeighborWriter): they are buffered
+    until a shard's worth of neighbors has arrived, and each shard is written as a store of its own in a
+    shard_<n> sub directory. A manifest.json next to the shards lists them (with their number of users and
+    neighbors and their range of user_ids), and is rewritten after every shard, so it always describes the
+    shards that are complete on disk. merge_shards turns the shards into a single store.
+
+    As the manifest only ever lists shards that were completely written, the shards double as checkpoints of
+    a long run: a writer opened with resume keeps the shards an interrupted run left behind (when they were
+    written by the same kind of run, see meta), reports the users they hold (completed_user_ids), and appends
+    the rest of the results after them.
+
+    Important Functions:
+        1. write_neighbor_store
+        2. read_neighbor_store
+        3. get_neighbors
+        4. patch_neighbor_store
+        5. read_shard_manifest
+        6. merge_shards
+
+    Important Classes:
+        1. ShardedNeighborWriter
+"""
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+STORE_FILES = ["user_ids", "indptr", "neighbor_ids", "scores"]
+QUANTIZATION_SCALE = 10000
+DEFAULT_SHARD_NEIGHBORS = 2 ** 22
+MANIFEST_FILE = "manifest.json"
+
+def results_to_columns(result_tuples):
+    """
+        Converts the (user_id, array of user_ids, array of similarities) tuples produced by danny's pool
+        workers into the columnar layout described above. Users are sorted by id, and each user's neighbors
+        are sorted from the most to the least similar.
+
+        Params:
+            result_tuples (arr) : each element is a tuple (user_id, array of user_ids, array of similarities)
+
+        Returns:
+            dict : key - one of STORE_FILES | value - the matching array
+    """
+    result_tuples = sorted(result_tuples, key=lambda result_tuple: result_tuple[0])
+    user_ids = np.array([result_tuple[0] for result_tuple in result_tuples], dtype=np.int32)
+    lengths = np.array([len(result_tuple[1]) for result_tuple in result_tuples], dtype=np.int64)
+
+    indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+
+    if result_tuples:
+        neighbor_ids = np.concatenate([result_tuple[1] for result_tuple in result_tuples]).astype(np.int32)
+        scores = np.concatenate([result_tuple[2] for result_tuple in result_tuples]).astype(np.float32)
+    else:
+        neighbor_ids = np.empty(0, dtype=np.int32)
+        scores = np.empty(0, dtype=np.float32)
+
+    rows = np.repeat(np.arange(len(user_ids)), lengths)
+    order = np.lexsort((-scores, rows))
+
+    return {"user_ids": user_ids, "indptr": indptr, "neighbor_ids": neighbor_ids[order],
+            "scores": scores[order]}
+
+def write_neighbor_store(store, output_path, quantize=False):
+    """
+        Writes the columnar neighbor results out as a directory of .npy files. Each file is written under a
+        temporary name and then renamed, so a process that has the store memory-mapped keeps reading the old
+        version of the file rather than a truncated one
+
+        Params:
+            store      (dict) : key - one of STORE_FILES | value - the matching array, as returned by
+                                results_to_columns
+            output_path (str) : directory to write the .npy files to, created if missing
+            quantize   (bool) : store scores as uint16 (score * 10000) instead of float32, which is
+                                lossless for danny's 4 decimal scores in [0, 1]
+
+        Returns:
+            bool : True on completion
+    """
+    scores = np.asarray(store["scores"], dtype=np.float32)
+    if quantize:
+        if scores.size and (scores.min() < 0 or scores.max() > 1):
+            raise ValueError("only scores between 0 and 1 can be quantized")
+        scores = np.round(scores * QUANTIZATION_SCALE).astype(np.uint16)
+
+    arrays = {"user_ids": np.asarray(store["user_ids"], dtype=np.int32),
+              "indptr": np.asarray(store["indptr"], dtype=np.int64),
+              "neighbor_ids": np.asarray(store["neighbor_ids"], dtype=np.int32),
+              "scores": scores}
+
+    os.makedirs(output_path, exist_ok=True)
+    for name in STORE_FILES:
+        file_name = os.path.join(output_path, name + ".npy")
+        with open(file_name + ".tmp", "wb") as store_file:
+            np.save(store_file, arrays[name])
+        os.replace(file_name + ".tmp", file_name)
+
+    return True
+
+def read_neighbor_store(output_path, mmap=True):
+    """
+        Opens a neighbor store written by write_neighbor_store. By default the arrays are memory-mapped, so
+        only the pages that are actually looked at get read from disk.
+
+        Params:
+            output_path (str) : directory the store was written to
+            mmap       (bool) : memory-map the arrays instead of reading them into memory
+
+        Returns:
+            dict : key - one of STORE_FILES | value - the matching array
+    """
+    mmap_mode = "r" if mmap else None
+
+    return {name: np.load(os.path.join(output_path, name + ".npy"), mmap_mode=mmap_mode)
+            for name in STORE_FILES}
+
+def patch_neighbor_store(output_path, patch, quantize=None):
+    """
+        Replaces the neighbors of some users in a store written by write_neighbor_store, e.g. after only the
+        users affected by an index update were recomputed. Users in the patch that are not in the store yet
+        are added, every other user keeps their stored neighbors. If there is no store at output_path yet the
+        patch is written as the store.
+
+        Params:
+            output_path     (str) : directory the store was written to
+            patch          (dict) : key - one of STORE_FILES | value - the matching array, as returned by
+                                    results_to_columns
+            quantize  (bool|None) : store scores as uint16, None keeps the quantization of the existing store
+
+        Returns:
+            bool : True on completion
+    """
+    if not os.path.exists(os.path.join(output_path, "user_ids.npy")):
+        return write_neighbor_store(patch, output_path, quantize=bool(quantize))
+
+    store = read_neighbor_store(output_path, mmap=False)
+    quantize = store["scores"].dtype == np.uint16 if quantize is None else quantize
+
+    kept = ~np.isin(store["user_ids"], patch["user_ids"])
+    lengths = np.diff(store["indptr"])
+    kept_entries = np.repeat(kept, lengths)
+    user_ids = np.concatenate([store["user_ids"][kept], patch["user_ids"]])
+    lengths = np.concatenate([lengths[kept], np.diff(patch["indptr"])])
+    neighbor_ids = np.concatenate([store["neighbor_ids"][kept_entries], patch["neighbor_ids"]])
+    scores = np.concatenate([_decode_scores(store["scores"][kept_entries]),
+                             np.asarray(patch["scores"], dtype=np.float64)])
+
+    order = np.argsort(user_ids, kind="stable")
+    starts = np.cumsum(lengths) - lengths
+    entries = np.repeat(starts[order] - np.cumsum(lengths[order]) + lengths[order], lengths[order])
+    entries += np.arange(len(entries))
+
+    indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+    np.cumsum(lengths[order], out=indptr[1:])
+
+    return write_neighbor_store({"user_ids": user_ids[order], "indptr": indptr,
+                                 "neighbor_ids": neighbor_ids[entries], "scores": scores[entries]},
+                                output_path, quantize=quantize)
+
+def _decode_scores(scores):
+    """
+        Turns stored scores back into floats, undoing the quantization if it was used
+
+        Params:
+            scores (arr) : float32 or quantized uint16 scores
+
+        Returns:
+            arr : float scores
+    """
+    if scores.dtype == np.uint16:
+        return scores.astype(np.float64) / QUANTIZATION_SCALE
+
+    return scores.astype(np.float64)
+
+def get_neighbors(store, user_id, n_neighbors=None):
+    """
+        Looks up a single user's neighbors, only touching that user's slice of the store
+
+        Params:
+            store           (dict) : store returned by read_neighbor_store
+            user_id          (int) : id of user whose nearest neighbors are wanted
+            n_neighbors (int|None) : number of neighbors wanted, None returns all stored neighbors
+
+        Returns:
+            tup : (array of user_ids, array of dot products), from the most to the least similar
+    """
+    position = np.searchsorted(store["user_ids"], user_id)
+    if position == len(store["user_ids"]) or store["user_ids"][position] != user_id:
+        raise ValueError("The user_id passed in is not found in the neighbor store")
+
+    start = store["indptr"][position]
+    end = store["indptr"][position + 1]
+    if n_neighbors is not None:
+        end = min(end, start + n_neighbors)
+
+    return (np.array(store["neighbor_ids"][start:end]), _decode_scores(store["scores"][start:end]))
+
+def neighbor_store_to_dict(store):
+    """
+        Converts a neighbor store into danny's dictionary format
+
+        Params:
+            store (dict) : store returned by read_neighbor_store
+
+        Returns:
+            dict : key - user_id | value - dict -- key - user_id, value: dot product
+    """
+    similarity_scores = {}
+    scores = _decode_scores(np.asarray(store["scores"]))
+    indptr = np.asarray(store["indptr"])
+    for i, user_id in enumerate(np.asarray(store["user_ids"]).tolist()):
+        start = indptr[i]
+        end = indptr[i + 1]
+        similarity_scores[user_id] = dict(zip(store["neighbor_ids"][start:end].tolist(),
+                                              np.round(scores[start:end], 4).tolist()))
+
+    return similarity_scores
+
+class ShardedNeighborWriter:
+    """
+        Writes danny's results out as they arrive, in shards of about shard_neighbors neighbors each, so only
+        one shard's worth of results is ever held in memory. Hand it every batch of result tuples with add,
+        and call close once the last one was added, e.g.
+            writer = ShardedNeighborWriter("output_data/similarity_scores_shards/")
+            for result_tuples in results:
+                writer.add(result_tuples)
+            manifest = writer.close()
+
+        Shards left over from an earlier run in output_path (the ones its manifest lists) are removed, unless
+        resume is set: then they are kept, and only the users missing from completed_user_ids need to be
+        added. A run can only be resumed with the same meta and quantize it was started with.
+
+        Params:
+            output_path      (str) : directory to write the shards and the manifest to, created if missing
+            shard_neighbors  (int) : number of neighbors (plus users) buffered before a shard is written
+            quantize        (bool) : store scores as uint16 instead of float32, see write_neighbor_store
+            meta       (dict|None) : json serializable description of the results kept in the manifest, e.g.
+                                     which slice of the users they cover
+            flush_seconds (float|None) : also write a shard once this many seconds passed since the last one,
+                                     so a slow run still checkpoints its results regularly
+            resume          (bool) : keep the shards of an earlier run with the same meta in output_path
+    """
+    # pylint: disable=too-many-arguments, too-many-instance-attributes
+    def __init__(self, output_path, shard_neighbors=DEFAULT_SHARD_NEIGHBORS, quantize=False, meta=None,
+                 flush_seconds=None, resume=False):
+        if shard_neighbors < 1:
+            raise ValueError("shard_neighbors must be positive")
+
+        self.output_path = output_path
+        self.shard_neighbors = shard_neighbors
+        self.quantize = quantize
+        self.flush_seconds = flush_seconds
+        self.manifest = {"quantize": quantize, "complete": False, "n_users": 0, "n_neighbors": 0,
+                         "meta": json.loads(json.dumps(meta if meta is not None else {})), "shards": []}
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.time()
+
+        os.makedirs(output_path, exist_ok=True)
+        if os.path.exists(os.path.join(output_path, MANIFEST_FILE)):
+            manifest = read_shard_manifest(output_path)
+            if resume and (manifest.get("meta", {}) != self.manifest["meta"] or
+                           manifest["quantize"] != quantize):
+                raise ValueError("the shards in {} were written by a different run ({}), they can't be \
+                                  resumed".format(output_path, manifest.get("meta", {})))
+            if resume:
+                manifest["complete"] = False
+                self.manifest = manifest
+            else:
+                for shard in manifest["shards"]:
+                    shutil.rmtree(os.path.join(output_path, shard["name"]), ignore_errors=True)
+        self._write_manifest()
+
+    def completed_user_ids(self):
+        """
+            Reads which users the shards written so far hold, e.g. to skip them when resuming a run
+
+            Returns:
+                arr : sorted user_ids
+        """
+        user_ids = [np.load(os.path.join(self.output_path, shard["name"], "user_ids.npy"))
+                    for shard in self.manifest["shards"]]
+
+        return np.unique(np.concatenate(user_ids + [np.empty(0, dtype=np.int32)]))
+
+    def add(self, result_tuples):
+        """
+            Buffers a batch of results, and writes a shard once enough of them have been buffered
+
+            Params:
+                result_tuples (arr) : each element is a tuple (user_id, array of user_ids, array of
+                                      similarities)
+
+            Returns:
+                None
+        """
+        self._buffer.extend(result_tuples)
+        self._buffered += sum(len(result_tuple[1]) + 1 for result_tuple in result_tuples)
+        if self._buffered >= self.shard_neighbors or \
+           (self.flush_seconds is not None and time.time() - self._last_flush >= self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        """
+            Writes whatever is buffered out as a new shard, and adds it to the manifest
+
+            Returns:
+                None
+        """
+        if not self._buffer:
+            return
+
+        store = results_to_columns(self._buffer)
+        name = "shard_{:05d}".format(len(self.manifest["shards"]))
+        write_neighbor_store(store, os.path.join(self.output_path, name), quantize=self.quantize)
+        self.manifest["shards"].append({"name": name,
+                                        "n_users": len(store["user_ids"]),
+                                        "n_neighbors": len(store["neighbor_ids"]),
+                                        "min_user_id": int(store["user_ids"][0]),
+                                        "max_user_id": int(store["user_ids"][-1])})
+        self.manifest["n_users"] += len(store["user_ids"])
+        self.manifest["n_neighbors"] += len(store["neighbor_ids"])
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.time()
+        self._write_manifest()
+
+    def close(self):
+        """
+            Writes out the last shard and marks the manifest complete
+
+            Returns:
+                dict : the manifest, see read_shard_manifest
+        """
+        self.flush()
+        self.manifest["complete"] = True
+        self._write_manifest()
+
+        return self.manifest
+
+    def _write_manifest(self):
+        """
+            Writes the manifest under a temporary name and renames it, so a reader never sees half of it
+
+            Returns:
+                None
+        """
+        file_name = os.path.join(self.output_path, MANIFEST_FILE)
+        with open(file_name + ".tmp", "w", encoding="utf-8") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=1)
+        os.replace(file_name + ".tmp", file_name)
+
+def read_shard_manifest(output_path):
+    """
+        Reads the manifest of shards written by ShardedNeighborWriter
+
+        Params:
+            output_path (str) : directory the shards were written to
+
+        Returns:
+            dict : quantize, complete (whether the writer was closed), n_users, n_neighbors, meta and
+                   shards, a list of dicts holding the name, n_users, n_neighbors, min_user_id and
+                   max_user_id of each shard
+    """
+    with open(os.path.join(output_path, MANIFEST_FILE), encoding="utf-8") as manifest_file:
+        return json.load(manifest_file)
+
+def merge_shards(shard_paths, output_path, quantize=None):
+    """
+        Merges shards written by ShardedNeighborWriter into a single store, as written by
+        write_neighbor_store. The merged arrays are filled in one shard at a time through memory-mapped
+        files, so only one shard is ever held in memory. A user found in more than one shard keeps the
+        neighbors of the last shard holding it.
+
+        Params:
+            shard_paths     (arr) : directories the shards were written to, each with its own manifest
+            output_path     (str) : directory to write the merged store to, created if missing
+            quantize  (bool|None) : store scores as uint16, None keeps the quantization of the shards
+
+        Returns:
+            dict : key - one of STORE_FILES | value - the merged (memory-mapped) array
+    """
+    # pylint: disable=too-many-locals
+    shards = []
+    for shard_path in shard_paths:
+        manifest = read_shard_manifest(shard_path)
+        quantize = manifest["quantize"] if quantize is None else quantize
+        shards.extend(os.path.join(shard_path, shard["name"]) for shard in manifest["shards"])
+
+    shard_user_ids = [np.load(os.path.join(shard, "user_ids.npy")) for shard in shards]
+    shard_lengths = [np.diff(np.load(os.path.join(shard, "indptr.npy"))) for shard in shards]
+    all_user_ids = np.concatenate(shard_user_ids + [np.empty(0, dtype=np.int32)])
+    owners = np.concatenate([np.full(len(user_ids), i) for i, user_ids in enumerate(shard_user_ids)] +
+                            [np.empty(0, dtype=np.int64)])
+    order = np.lexsort((-owners, all_user_ids))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = all_user_ids[order][1:] != all_user_ids[order][:-1]
+    kept = np.zeros(len(order), dtype=bool)
+    kept[order[first]] = True
+
+    user_ids = all_user_ids[order[first]]
+    lengths = np.concatenate(shard_lengths + [np.empty(0, dtype=np.int64)])
+    indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+    np.cumsum(lengths[order[first]], out=indptr[1:])
+    positions = np.empty(len(all_user_ids), dtype=np.int64)
+    positions[order[first]] = np.arange(len(user_ids))
+
+    os.makedirs(output_path, exist_ok=True)
+    score_type = np.uint16 if quantize else np.float32
+    arrays = {"user_ids": user_ids.astype(np.int32), "indptr": indptr}
+    for name, dtype in (("neighbor_ids", np.int32), ("scores", score_type)):
+        if indptr[-1]:
+            arrays[name] = np.lib.format.open_memmap(os.path.join(output_path, name + ".npy.tmp"),
+                                                     mode="w+", dtype=dtype, shape=(int(indptr[-1]),))
+        else:
+            arrays[name] = np.empty(0, dtype=dtype)
+
+    start = 0
+    for shard, user_ids_in_shard, lengths_in_shard in zip(shards, shard_user_ids, shard_lengths):
+        shard_kept = kept[start:start + len(user_ids_in_shard)]
+        shard_positions = positions[start:start + len(user_ids_in_shard)][shard_kept]
+        start += len(user_ids_in_shard)
+        store = read_neighbor_store(shard)
+        entries = np.repeat(shard_kept, lengths_in_shard)
+        targets = np.repeat(indptr[shard_positions] - np.cumsum(lengths_in_shard[shard_kept]) +
+                            lengths_in_shard[shard_kept], lengths_in_shard[shard_kept])
+        targets += np.arange(len(targets))
+        arrays["neighbor_ids"][targets] = store["neighbor_ids"][entries]
+        scores = _decode_scores(np.asarray(store["scores"])[entries])
+        if quantize and scores.size and (scores.min() < 0 or scores.max() > 1):
+            raise ValueError("only scores between 0 and 1 can be quantized")
+        arrays["scores"][targets] = np.round(scores * QUANTIZATION_SCALE) if quantize else scores
+
+    for name in STORE_FILES:
+        file_name = os.path.join(output_path, name + ".npy")
+        if isinstance(arrays[name], np.memmap):
+            arrays[name].flush()
+        else:
+            with open(file_name + ".tmp", "wb") as store_file:
+                np.save(store_file, arrays[name])
+        del arrays[name]
+        os.replace(file_name + ".tmp", file_name)
+
+    return read_neighbor_store(output_path)
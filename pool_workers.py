@@ -0,0 +1,596 @@
+"""
+    The pool danny's batch functions run on, and the functions its workers run. Each worker attaches to the
+    parts of the index it is handed once, when it starts (see _init_worker and shared_index), and keeps them
+    in module globals, so the tasks sent to it only hold user_ids:
+        * pruning: prune_users_batch finds the candidates of a chunk of users (see candidate_pruning)
+        * dot products: get_similarities_batch does one mat-vec per user of a chunk, and
+          get_block_similarities_batch one sparse product per block of users (see _find_block_similarities)
+        * both at once: prune_and_multiply_users prunes a chunk of users and computes their dot products
+          without sending the candidates back to the parent
+
+    The batch functions driving the pool are in dictionary_based_nn.
+"""
+from contextlib import contextmanager
+from multiprocessing import get_context
+import random
+import numpy as np
+from numpy import dot
+from scipy.sparse import csr_matrix
+from shared_index import attach_index_part, release_shared_blocks, share_index_part
+from candidate_pruning import MAX_USER_CAP, approx_prune_space, cut_off_score, strict_prune_space
+from candidate_pruning import upper_candidates
+
+USER_ENTITY_DICT = None
+ENTITY_USER_DICT = None
+USER_ENTITY_MATRIX = None
+USER_ENTITY_MATRIX_T = None
+CANDIDATES = None
+
+def _init_worker(worker_specs):
+    """
+        Pool initializer, attaches the worker to the parts of the index it needs from the specs built by
+        shared_index.share_index_part. As the workers never rely on inheriting these globals from the parent,
+        the pools work the same under the fork, spawn and forkserver start methods.
+
+        Params:
+            worker_specs (dict) : key - name of the global (e.g. "USER_ENTITY_DICT") | value - spec
+
+        Returns:
+            None
+    """
+    # pylint: disable=global-statement
+    global USER_ENTITY_DICT, ENTITY_USER_DICT, USER_ENTITY_MATRIX, USER_ENTITY_MATRIX_T, CANDIDATES
+    USER_ENTITY_DICT = attach_index_part(worker_specs.get("USER_ENTITY_DICT"))
+    ENTITY_USER_DICT = attach_index_part(worker_specs.get("ENTITY_USER_DICT"))
+    USER_ENTITY_MATRIX = attach_index_part(worker_specs.get("USER_ENTITY_MATRIX"))
+    USER_ENTITY_MATRIX_T = attach_index_part(worker_specs.get("USER_ENTITY_MATRIX_T"))
+    CANDIDATES = attach_index_part(worker_specs.get("CANDIDATES"))
+
+@contextmanager
+def create_pool(n_processes, index_parts, start_method=None):
+    """
+        Shares the passed in parts of the index with shared_index.share_index_part and starts a pool whose
+        workers attach to them in _init_worker. Used as a context manager, which closes and joins the pool
+        when the block is done with it, or terminates it when the block raises (e.g. a worker failed), and
+        either way releases the shared memory blocks, so they never outlive the run in /dev/shm.
+            with create_pool(n_processes, index_parts) as pool:
+                results, report = run_scheduled(pool, ...)
+
+        Params:
+            n_processes       (int) : number of processes in the pool
+            index_parts      (dict) : key - name of the global | value - tuple (data, file name it was read
+                                      from or None)
+            start_method (str|None) : multiprocessing start method, None uses the platform's default
+
+        Returns:
+            Pool : the pool, for the duration of the with block
+    """
+    worker_specs = {}
+    blocks = []
+    pool = None
+    try:
+        for name, (data, file_name) in index_parts.items():
+            worker_specs[name], part_blocks = share_index_part(data, file_name)
+            blocks.extend(part_blocks)
+        # the index parts only living in the parent were copied to shared memory, don't keep them alive
+        del index_parts, data
+
+        pool = get_context(start_method).Pool(processes=n_processes, initializer=_init_worker,
+                                              initargs=(worker_specs,))
+        yield pool
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        if pool is not None:
+            pool.join()
+        release_shared_blocks(blocks)
+
+def _get_top_n_users_batch(user_id_user_cap):
+    """
+        Actual function called by pool workers to pick out the top n most likely users similar to a given
+        user (user-in-question) for the final vector comparison. This function is called when danny is
+        running in approximate mode.
+
+        Function first calls approx_prune_space, which assings a scores (via a heuristic) to every relevant
+        user. This score is a measure of how likely each relevant user's visitation patterns are to the
+        user-in-question's visitation pattern.
+            * A relevant user is a user whose visitation pattern shares at least one entity with the
+              user-in-question's visitation pattern.
+
+        Next the function finds the score of the n-th best user with a partial selection (no full sort of
+        the relevant users), and then selects the top n users, where n is passed in (user_cap). Only the
+        users strictly above that cut off score get sorted. If there is a tie in scores that causes the list
+        to expand past n users, the function randomly samples from the tied users and ensures the list is
+        below the max number of associated users per each user-in-question. The max number is 1000 and this
+        is done for storage purposes. The scores are rounded to float32 before the cut off (see
+        approx_prune_space), so which users tie does not depend on the order their terms were summed in.
+
+        The users are returned from the best score to the worst, along with their scores, so a smaller
+        user_cap m would have picked the users scoring at least as much as the m-th user of the list.
+
+        Params:
+            user_id_user_cap (tup) : user_id, number of similar users desired (max is 1000), and optionally
+                                     the hub policy returned by resolve_hub_policy
+
+        Returns:
+            tup : user_id, int32 array of the n most similar users, best first, array of their scores
+
+    """
+    user_id = user_id_user_cap[0]
+    user_cap = min(user_id_user_cap[1], MAX_USER_CAP)
+    hub_policy = user_id_user_cap[2] if len(user_id_user_cap) > 2 else None
+
+    users_to_look_at, scores = approx_prune_space(user_id, USER_ENTITY_DICT, ENTITY_USER_DICT, hub_policy)
+
+    if len(users_to_look_at) > user_cap:
+        cut_off_value = cut_off_score(scores, user_cap)
+
+        above_cut_off = np.flatnonzero(scores > cut_off_value)
+        above_cut_off = above_cut_off[np.argsort(-scores[above_cut_off], kind="stable")]
+        top_n_keys = users_to_look_at[above_cut_off].tolist()
+        top_n_scores = scores[above_cut_off].tolist()
+        keys_to_randomly_select_from = users_to_look_at[scores == cut_off_value].tolist()
+
+        sample_amount = min(MAX_USER_CAP - len(top_n_keys), len(keys_to_randomly_select_from))
+        if sample_amount == len(keys_to_randomly_select_from):
+            keys_to_add = keys_to_randomly_select_from
+        else:
+            keys_to_add = random.sample(keys_to_randomly_select_from, sample_amount)
+
+        top_n_keys.extend(keys_to_add)
+        top_n_scores.extend([cut_off_value] * len(keys_to_add))
+    else:
+        order = np.argsort(-scores, kind="stable")
+        top_n_keys = users_to_look_at[order]
+        top_n_scores = scores[order]
+
+    return (user_id, np.asarray(top_n_keys, dtype=np.int32), np.asarray(top_n_scores, dtype=np.float64))
+
+def _get_relevant_users_batch(user_id, hub_policy=None):
+    """
+        Actual function called by pool workers to pick out all relevant users when considering which
+        users would have close visitation patterns. This function is called when danny is
+        running in smart, but more comprehensive mode.
+
+        Params:
+            user_id            (int) : id of user to grab relevant users for
+            hub_policy   (dict|None) : policy returned by resolve_hub_policy, None walks every posting
+
+        Returns:
+            tup : user_id, int32 array of relevant user_ids
+
+    """
+    users_to_look_at = strict_prune_space(user_id, USER_ENTITY_DICT, ENTITY_USER_DICT, hub_policy)
+
+    return (user_id, users_to_look_at.astype(np.int32))
+
+def prune_users_batch(users_user_cap):
+    """
+        Actual function called by pool workers to prune the user space of a chunk of users. The candidates of
+        the whole chunk are sent back to the parent as arrays instead of a list per user, so they can be
+        stitched straight into the candidates CSR matrix (see candidates_to_matrix).
+
+        Params:
+            users_user_cap (tup) : array of user_ids, user_cap (-1 for the full list of relevant users), hub
+                                   policy returned by resolve_hub_policy (or None)
+
+        Returns:
+            tup : (array of user_ids, array of the number of candidates per user, int32 array of the
+                   candidates of every user, one user after the other, array of their heuristic scores or
+                   None when user_cap is -1)
+    """
+    user_ids, user_cap, hub_policy = users_user_cap
+    candidates, scores = _prune_users(user_ids, user_cap, hub_policy)
+    if scores is not None:
+        scores = np.concatenate(scores) if scores else np.empty(0)
+
+    lengths = np.array([len(user_candidates) for user_candidates in candidates], dtype=np.int64)
+    candidates = np.concatenate(candidates) if candidates else np.empty(0, dtype=np.int32)
+
+    return (user_ids, lengths, candidates, scores)
+
+def _prune_users(user_ids, user_cap, hub_policy=None):
+    """
+        Prunes the user space of a chunk of users with the dictionaries the pool worker is attached to
+
+        Params:
+            user_ids         (arr) : array of user_ids
+            user_cap         (int) : number of candidates per user, -1 for the full list of relevant users
+            hub_policy (dict|None) : policy returned by resolve_hub_policy, None walks every posting
+
+        Returns:
+            tup : (list of the int32 arrays of candidates of each user, list of the arrays of their heuristic
+                   scores or None when user_cap is -1)
+    """
+    if user_cap > 0:
+        results = [_get_top_n_users_batch((user_id, user_cap, hub_policy)) for user_id in user_ids.tolist()]
+        return ([result[1] for result in results], [result[2] for result in results])
+
+    return ([_get_relevant_users_batch(user_id, hub_policy)[1] for user_id in user_ids.tolist()], None)
+
+def _candidate_row(user_id, candidate_cap=None, symmetric=False):
+    """
+        Looks up the candidates of a user in the candidates matrix the pool worker is attached to. A
+        candidate_cap keeps the same candidates pruning with a user_cap of candidate_cap would have: the ones
+        scoring at least as much as the candidate_cap-th best one (so ties are kept), at most MAX_USER_CAP.
+
+        In symmetric mode only the candidates user_id is responsible for are kept (see upper_candidates).
+
+        Params:
+            user_id             (int) : id of the user whose candidates are wanted
+            candidate_cap  (int|None) : user_cap to cut the approximate candidates down to, None keeps all
+            symmetric          (bool) : only keep the candidates user_id computes the similarity of
+
+        Returns:
+            arr : user_ids user_id should be compared to
+    """
+    start = CANDIDATES.indptr[user_id]
+    end = CANDIDATES.indptr[user_id + 1]
+    if candidate_cap is not None and end - start > candidate_cap:
+        scores = CANDIDATES.data[start:end]
+        end = start + min(np.count_nonzero(scores >= scores[candidate_cap - 1]), MAX_USER_CAP)
+
+    candidates = np.asarray(CANDIDATES.indices[start:end])
+    if symmetric:
+        candidates = candidates[upper_candidates(np.full(len(candidates), user_id), candidates, CANDIDATES)]
+
+    return candidates
+
+def find_similarities(user_id, matrix, users_to_compare_to, sparse):
+    """
+        Function called by pool workers to computes the dot product between user-in-question (user associated
+        with user_id) and the list of user_ids passed in.
+
+        Note: user_ids (which are ints) must equal the row indicies associated with the count vectors for
+              those user_ids. i.e. if a user's id is 0, then that user's count vector must be stored in row
+              zero of the passed in matrix.
+
+        Params:
+            user_id             (int) : user whose similar users are wanted
+            matrix           (matrix) : matrix where each row contains a user's entity visitation pattern
+                                        encoded as a count vector. Each column contains each entity's user
+                                        vistiation record encoded as a count vector. Can be sparse.
+            users_to_compare_to (arr) : list of user_ids whose entity visitation patterns should be compared
+                                        to the user-in-question's entity visitation pattern
+            sparse             (bool) : is the matrix sparse or not
+
+        Returns:
+            arr : similarities between user-in-question and passed in user_ids, order is preserved between
+                  the passed in user_ids and the returned dot products
+    """
+    if sparse:
+        row = matrix[user_id].toarray()[0]
+        results = matrix[users_to_compare_to, :].dot(row)
+    else:
+        row = matrix[user_id]
+        results = dot(matrix[users_to_compare_to, :], row)
+
+    return results
+
+def select_similarities(users_to_compare_to, similarities, thresh=-1.0):
+    """
+        Both for readability and storage purposes it is useful to cap the number of decimal places for the
+        similarities scores (dot products) computed for a user and their closest users. I have chosen 4, this
+        decision is arbirtrary though.
+
+        As no additional complexity is added to the process, there is an ability to filter out similarities
+        that are below a certain threshold when preparring similairty scores.
+
+        The threshold and the rounding are applied with numpy masks over the whole array at once, and the
+        result is kept as a pair of arrays, which is also what the pool workers send back to the parent.
+
+        Params:
+            users_to_compare_to (arr) : user_ids asscoiated with the dot scores that are being
+                                        formated. The function assumes that user_id in position i is
+                                        asscoiated with similarity score in position i
+            similarities        (arr) : similarity scores to be formatted
+            thresh            (float) : minimum threshold for scores to be formatted
+
+        Returns:
+            tup : (int32 array of user_ids, array of rounded similarity scores)
+    """
+    similarities = np.asarray(similarities, dtype=np.float64)
+    keep = similarities > thresh
+
+    return (np.asarray(users_to_compare_to, dtype=np.int32)[keep], np.round(similarities[keep], 4))
+
+def _format_similarities(users_to_compare_to, similarities, thresh=-1.0):
+    """
+        Dictionary form of select_similarities, only built when a caller asks for it.
+
+        Params:
+            users_to_compare_to (arr) : user_ids asscoiated with the dot scores that are being
+                                        formated. The function assumes that user_id in position i is
+                                        asscoiated with similarity score in position i
+            similarities        (arr) : similarity scores to be formatted
+            thresh            (float) : minimum threshold for scores to be formatted
+
+        Returns:
+            dict : key - user_id | value - formatted similarity score
+
+    """
+    similar_users, similarities = select_similarities(users_to_compare_to, similarities, thresh)
+
+    return dict(zip(similar_users.tolist(), similarities.tolist()))
+
+def results_to_dict(result_tuples):
+    """
+        Converts the (user_id, array of user_ids, array of similarities) tuples produced by the pool workers
+        into danny's dictionary format
+
+        Params:
+            result_tuples (arr) : each element is a tuple (user_id, array of user_ids, array of similarities)
+
+        Returns:
+            dict : key - user_id | value - dict -- key - user_id, value: dot product
+    """
+    similarity_scores = {}
+    for user_id, similar_users, similarities in result_tuples:
+        similarity_scores[user_id] = dict(zip(similar_users.tolist(), similarities.tolist()))
+
+    return similarity_scores
+
+def _get_dense_similarities_batch(user_tuple):
+    """
+        Actual function called by pool workers to calculate the needed dot products per user
+
+        Shoud be used when the created matrix storing each user's entity visitation pattern is a dense matrix
+
+        Calls find_similarities and formats similarities via select_similarities
+
+        Params:
+            user_tuple (tup) : user_id, list of user_ids to compare user to
+
+        Returns:
+            tup : user_id, array of user_ids, array of dot_products
+    """
+    user_id = user_tuple[0]
+    users_to_compare_to = user_tuple[1]
+
+    results = find_similarities(user_id, USER_ENTITY_MATRIX, users_to_compare_to, sparse=False)
+
+    return (user_id,) + select_similarities(users_to_compare_to, results)
+
+def _get_sparse_similarities_batch(user_tuple):
+    """
+        Actual function called by pool workers to calculate the needed dot products per user
+
+        Shoud be used when the created matrix storing each user's entity visitation pattern is a sparse matrix
+
+        Calls find_similarities and formats similarities via select_similarities
+
+        Params:
+            user_tuple (tup) : user_id, list of user_ids to compare user to
+
+        Returns:
+            tup : user_id, array of user_ids, array of dot_products
+    """
+    user_id = user_tuple[0]
+    users_to_compare_to = user_tuple[1]
+
+    results = find_similarities(user_id, USER_ENTITY_MATRIX, users_to_compare_to, sparse=True)
+
+    return (user_id,) + select_similarities(users_to_compare_to, results)
+
+def get_similarities_batch(chunk_tuple):
+    """
+        Actual function called by pool workers to calculate the needed dot products for a chunk of users
+        with the "rowwise" engine. Each user's candidates are read from the candidates matrix the worker is
+        attached to, so only the user_ids travel to the worker.
+
+        Params:
+            chunk_tuple (tup) : array of user_ids, whether the matrix is sparse, candidate_cap (None uses
+                                every candidate), symmetric (only compute each pair of users once)
+
+        Returns:
+            arr : each element is a tuple, user_id, array of user_ids, array of dot_products
+    """
+    user_ids, sparse, candidate_cap, symmetric = chunk_tuple
+    get_similarities = _get_sparse_similarities_batch if sparse else _get_dense_similarities_batch
+
+    return [get_similarities((user_id, _candidate_row(user_id, candidate_cap, symmetric)))
+            for user_id in user_ids.tolist()]
+
+def top_k_positions(scores, top_k):
+    """
+        Picks the positions of the top_k largest scores with a partial selection (np.argpartition), so only
+        the selected positions get sorted. Positions are returned from the largest score to the smallest.
+
+        Params:
+            scores (arr) : scores to select from
+            top_k  (int) : number of positions wanted
+
+        Returns:
+            arr : positions of the top_k largest scores, in descending score order
+    """
+    if top_k < len(scores):
+        positions = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        positions = np.arange(len(scores))
+
+    return positions[np.argsort(-scores[positions], kind="stable")]
+
+def _find_block_similarities(user_ids, matrix, matrix_t, users_to_compare_to, top_k=None, thresh=-1.0):
+    """
+        Computes the similarities for a whole block of users with one sparse x sparse^T product, instead of
+        slicing the matrix and doing a separate mat-vec per user as find_similarities does.
+
+        The product of the block's rows with the transposed matrix only has entries for users that share an
+        entity with a user in the block, so it never becomes dense. Each row of the product is then masked
+        down to the candidates of that user, filtered by thresh and cut down to top_k entries with a partial
+        selection on the row's non zero values.
+
+        Params:
+            user_ids            (arr) : block of users whose similar users are wanted
+            matrix       (csr_matrix) : row normalized user_entity matrix
+            matrix_t     (csr_matrix) : transpose of matrix, in CSR form
+            users_to_compare_to (arr) : per user in the block, the list of user_ids it should be compared to
+            top_k          (int|None) : number of most similar users to keep per user, None keeps all
+            thresh            (float) : minimum similarity for a user to be kept
+
+        Returns:
+            arr : per user in the block, a tuple (array of user_ids, array of similarities), the order of
+                  the tuples matches the order of user_ids
+    """
+    #pylint: disable=too-many-arguments, too-many-locals
+    products = matrix[user_ids].dot(matrix_t).tocsr()
+
+    lengths = [len(users) for users in users_to_compare_to]
+    mask_rows = np.repeat(np.arange(len(user_ids)), lengths)
+    mask_columns = np.concatenate([np.asarray(users, dtype=np.int64) for users in users_to_compare_to]) \
+                   if mask_rows.size else np.empty(0, dtype=np.int64)
+    mask = csr_matrix((np.ones(len(mask_rows)), (mask_rows, mask_columns)), shape=products.shape)
+    products = products.multiply(mask).tocsr()
+
+    results = []
+    for i in range(len(user_ids)):
+        start = products.indptr[i]
+        end = products.indptr[i + 1]
+        similar_users = products.indices[start:end]
+        similarities = products.data[start:end]
+
+        keep = similarities > thresh
+        similar_users = similar_users[keep]
+        similarities = similarities[keep]
+
+        if top_k is not None:
+            positions = top_k_positions(similarities, top_k)
+            similar_users = similar_users[positions]
+            similarities = similarities[positions]
+
+        results.append((similar_users, similarities))
+
+    return results
+
+def get_block_similarities_batch(block_tuple):
+    """
+        Actual function called by pool workers to calculate the needed dot products for a block of users when
+        danny is running with the "blocked" engine.
+
+        Calls _find_block_similarities and formats similarities via select_similarities
+
+        Params:
+            block_tuple (tup) : array of user_ids, candidate_cap (None uses every candidate), top_k, thresh,
+                                symmetric (only compute each pair of users once)
+
+        Returns:
+            arr : each element is a tuple, user_id, array of user_ids, array of dot_products
+    """
+    user_ids, candidate_cap, top_k, thresh, symmetric = block_tuple
+    user_ids = user_ids.tolist()
+    users_to_compare_to = [_candidate_row(user_id, candidate_cap, symmetric) for user_id in user_ids]
+
+    results = _find_block_similarities(user_ids, USER_ENTITY_MATRIX, USER_ENTITY_MATRIX_T,
+                                       users_to_compare_to, top_k, thresh)
+
+    return [(user_id,) + select_similarities(similar_users, similarities)
+            for user_id, (similar_users, similarities) in zip(user_ids, results)]
+
+def prune_and_multiply_users(chunk_tuple):
+    """
+        Actual function called by pool workers when pruning and dot products are fused into one pool: a
+        chunk of users is pruned with the dictionaries and compared to its candidates with the matrix the
+        worker is attached to, so the candidates never leave the worker.
+
+        Params:
+            chunk_tuple (tup) : array of user_ids, user_cap, hub policy returned by resolve_hub_policy (or
+                                None), whether the matrix is sparse, engine, top_k, thresh
+
+        Returns:
+            arr : each element is a tuple, user_id, array of user_ids, array of dot_products
+    """
+    user_ids, user_cap, hub_policy, sparse, engine, top_k, thresh = chunk_tuple
+    users_to_compare_to = _prune_users(user_ids, user_cap, hub_policy)[0]
+    user_ids = user_ids.tolist()
+
+    if engine == "blocked":
+        results = _find_block_similarities(user_ids, USER_ENTITY_MATRIX, USER_ENTITY_MATRIX_T,
+                                           users_to_compare_to, top_k, thresh)
+        return [(user_id,) + select_similarities(similar_users, similarities)
+                for user_id, (similar_users, similarities) in zip(user_ids, results)]
+
+    get_similarities = _get_sparse_similarities_batch if sparse else _get_dense_similarities_batch
+
+    return [get_similarities(user_tuple) for user_tuple in zip(user_ids, users_to_compare_to)]
+
+def block_products(user_ids, matrix, matrix_t, sparse):
+    """
+        Computes the dot products between a block of users and every user in one product. As the matrix only
+        holds positive values, the non zero entries of a row are exactly the users sharing an entity with
+        that row's user, i.e. the users strict_prune_space would return.
+
+        Params:
+            user_ids    (arr) : block of users whose similarities are wanted
+            matrix   (matrix) : row normalized user_entity matrix, can be sparse
+            matrix_t (matrix) : transpose of matrix in CSR form when sparse, not used for a dense matrix
+            sparse     (bool) : is the matrix sparse or not
+
+        Returns:
+            csr_matrix : row i holds the similarities of user_ids[i] to every user it shares an entity with
+    """
+    if sparse:
+        return matrix[user_ids].dot(matrix_t).tocsr()
+
+    return csr_matrix(dot(matrix[user_ids], matrix.T))
+
+def top_n_per_row(products, n_neighbors=None, thresh=-1.0):
+    """
+        Vectorized form of select_similarities followed by top_k_positions for every row of a block of
+        similarities at once: entries not above thresh are dropped, the rest are rounded, and each row is
+        sorted from the most to the least similar (ties by user_id) and cut to n_neighbors entries.
+
+        As the similarities are rounded to 4 decimals there are only so many distinct values, so when a
+        block holds more similarities than it has (row, value) pairs, a histogram of the values per row finds
+        each row's n_neighbors-th best value before sorting, and everything below it is dropped. Only about
+        n_neighbors entries per row are then left to sort, with one argsort on a (row, value, user_id) key.
+
+        Params:
+            products  (csr_matrix) : row i holds the similarities of the i-th user of a block
+            n_neighbors (int|None) : number of neighbors kept per row, None keeps all
+            thresh         (float) : minimum similarity for a user to be kept
+
+        Returns:
+            tup : (indptr, array of user_ids, array of rounded similarities), the neighbors of row i are in
+                  positions indptr[i]:indptr[i + 1]
+    """
+    n_rows = products.shape[0]
+    rows = np.repeat(np.arange(n_rows), np.diff(products.indptr))
+    keep = products.data > thresh
+    rows = rows[keep]
+    similar_users = products.indices[keep].astype(np.int32)
+    similarities = np.round(products.data[keep], 4)
+
+    levels = np.rint(similarities * 10 ** 4).astype(np.int64)
+    levels -= levels.min() if len(levels) else 0
+    n_levels = levels.max() + 1 if len(levels) else 1
+    if n_neighbors is not None and len(levels) > n_rows * n_levels:
+        level_counts = np.bincount(rows * n_levels + levels, minlength=n_rows * n_levels)
+        at_least = np.cumsum(level_counts.reshape(n_rows, n_levels)[:, ::-1], axis=1)[:, ::-1]
+        cut_off_levels = (at_least >= n_neighbors).sum(axis=1) - 1
+        keep = levels >= cut_off_levels[rows]
+        rows = rows[keep]
+        similar_users = similar_users[keep]
+        similarities = similarities[keep]
+        levels = levels[keep]
+
+    order = np.argsort((rows * n_levels + n_levels - 1 - levels) * products.shape[1] + similar_users)
+    rows = rows[order]
+    similar_users = similar_users[order]
+    similarities = similarities[order]
+
+    lengths = np.bincount(rows, minlength=n_rows)
+    if n_neighbors is not None:
+        starts = np.cumsum(lengths) - lengths
+        keep = np.arange(len(rows)) - starts[rows] < n_neighbors
+        similar_users = similar_users[keep]
+        similarities = similarities[keep]
+        lengths = np.minimum(lengths, n_neighbors)
+
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+
+    return (indptr, similar_users, similarities)
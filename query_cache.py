@@ -0,0 +1,254 @@
+"""
+    A bounded cache for the results of danny's single user queries (user_functions and query_server).
+    Analysts tend to ask for the same popular users over and over, and without a cache every one of those
+    queries prunes the search space and computes the dot products from scratch.
+
+    Results are keyed by (index version, user_id, mode, n_neighbors or thresh). The index version is the one
+    in index_meta.pickle (see supporting_functions.read_index_meta), which is bumped every time the index is
+    rebuilt or updated. As soon as the cache sees a new version every cached result is dropped, so a result
+    computed from an older index is never returned.
+
+    The cache is bounded both by the number of results and by an estimate of the bytes they take, and evicts
+    either the least recently used (lru) or the least frequently used (lfu) result once a bound is hit. Hits,
+    misses and evictions are counted so the hit rate can be checked with NeighborCache.stats.
+
+    Important Classes:
+        1. NeighborCache
+"""
+from collections import OrderedDict
+import os
+import sys
+import threading
+from supporting_functions import read_index_meta
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 64 * 2 ** 20
+CACHE_POLICIES = ["lru", "lfu"]
+NEIGHBOR_BYTES = sys.getsizeof((0, 0.0)) + sys.getsizeof(2 ** 20) + sys.getsizeof(0.0)
+
+def _result_bytes(result):
+    """
+        Estimates how much memory a query result takes
+
+        Params:
+            result (arr) : each element is a tuple (user_id, dot_product)
+
+        Returns:
+            int : estimated size in bytes
+    """
+    return sys.getsizeof(result) + len(result) * NEIGHBOR_BYTES
+
+class NeighborCache:
+    """
+        Thread safe, bounded cache of single user query results. Pass it to the user_functions through their
+        cache argument, e.g.
+            cache = NeighborCache(output_dir="output_data/")
+            get_user_neighbors_approx(user_id, *read_index("output_data/"), cache=cache)
+
+        Params:
+            max_entries      (int) : maximum number of results kept
+            max_bytes        (int) : maximum estimated size of the results kept, in bytes
+            policy           (str) : one of CACHE_POLICIES, which result is evicted once a bound is hit
+            output_dir  (str|None) : directory of the index the results come from, its index version is
+                                     checked on every lookup. None leaves the version to set_version
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, policy="lru",
+                 output_dir=None):
+        if policy not in CACHE_POLICIES:
+            raise ValueError("policy must be one of {}".format(CACHE_POLICIES))
+        if max_entries < 1 or max_bytes < 1:
+            raise ValueError("max_entries and max_bytes must be positive")
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.output_dir = output_dir
+        self.version = None
+        self._meta_mtime = None
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._recency = OrderedDict()
+        self._frequencies = {}
+        self._min_frequency = 0
+        self._bytes = 0
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def set_version(self, version):
+        """
+            Tells the cache which index version results are now computed from. Every cached result is
+            dropped if the version changed.
+
+            Params:
+                version (int) : index version, see supporting_functions.read_index_meta
+        """
+        with self._lock:
+            self._set_version(version)
+
+    def get(self, key):
+        """
+            Looks up a cached result
+
+            Params:
+                key (tup) : (user_id, mode, n_neighbors or thresh, ...) identifying the query
+
+            Returns:
+                arr | None : copy of the cached result, None on a miss
+        """
+        with self._lock:
+            self._check_version()
+            key = (self.version,) + tuple(key)
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+
+            self._counters["hits"] += 1
+            self._touch(key, entry)
+
+            return list(entry[0])
+
+    def put(self, key, result):
+        """
+            Caches a result, evicting others if needed. Results larger than max_bytes are not cached.
+
+            Params:
+                key    (tup) : (user_id, mode, n_neighbors or thresh, ...) identifying the query
+                result (arr) : each element is a tuple (user_id, dot_product)
+        """
+        n_bytes = _result_bytes(result)
+        if n_bytes > self.max_bytes:
+            return
+
+        with self._lock:
+            self._check_version()
+            key = (self.version,) + tuple(key)
+            if key in self._entries:
+                self._remove(key)
+
+            while self._entries and (len(self._entries) >= self.max_entries
+                                     or self._bytes + n_bytes > self.max_bytes):
+                self._remove(self._victim())
+                self._counters["evictions"] += 1
+
+            entry = [list(result), n_bytes, 1]
+            self._entries[key] = entry
+            self._bytes += n_bytes
+            if self.policy == "lru":
+                self._recency[key] = None
+            else:
+                self._frequencies.setdefault(1, OrderedDict())[key] = None
+                self._min_frequency = 1
+
+    def clear(self):
+        """
+            Drops every cached result, the counters are kept
+        """
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        """
+            Returns:
+                dict : hits, misses, evictions, invalidations (times the cache was dropped for a new index
+                       version), hit_rate, entries, bytes and version
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["version"] = self.version
+
+            return stats
+
+    def _set_version(self, version):
+        """
+            set_version without taking the lock
+        """
+        if version != self.version:
+            if self.version is not None:
+                self._counters["invalidations"] += 1
+            self._clear()
+            self.version = version
+
+    def _check_version(self):
+        """
+            Re-reads the index version when index_meta.pickle in output_dir has changed. Only the file's
+            modification time is checked on a lookup, the pickle is only read when it changed.
+        """
+        if self.output_dir is None:
+            return
+
+        try:
+            mtime = os.stat(os.path.join(self.output_dir, "index_meta.pickle")).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        if mtime != self._meta_mtime or self.version is None:
+            self._meta_mtime = mtime
+            self._set_version(read_index_meta(self.output_dir)["version"])
+
+    def _clear(self):
+        """
+            clear without taking the lock
+        """
+        self._entries.clear()
+        self._recency.clear()
+        self._frequencies.clear()
+        self._min_frequency = 0
+        self._bytes = 0
+
+    def _touch(self, key, entry):
+        """
+            Records a hit on a cached result for the eviction policy
+
+            Params:
+                key   (tup) : key of the result
+                entry (arr) : [result, n_bytes, frequency]
+        """
+        if self.policy == "lru":
+            self._recency.move_to_end(key)
+            return
+
+        frequency = entry[2]
+        keys = self._frequencies[frequency]
+        del keys[key]
+        if not keys:
+            del self._frequencies[frequency]
+            if self._min_frequency == frequency:
+                self._min_frequency = frequency + 1
+
+        entry[2] = frequency + 1
+        self._frequencies.setdefault(frequency + 1, OrderedDict())[key] = None
+
+    def _victim(self):
+        """
+            Returns:
+                tup : key of the result to evict, the least recently used one for lru, and the least
+                      recently used of the least frequently used ones for lfu
+        """
+        if self.policy == "lru":
+            return next(iter(self._recency))
+
+        return next(iter(self._frequencies[self._min_frequency]))
+
+    def _remove(self, key):
+        """
+            Removes a cached result
+
+            Params:
+                key (tup) : key of the result
+        """
+        _, n_bytes, frequency = self._entries.pop(key)
+        self._bytes -= n_bytes
+        if self.policy == "lru":
+            del self._recency[key]
+            return
+
+        keys = self._frequencies[frequency]
+        del keys[key]
+        if not keys:
+            del self._frequencies[frequency]
+            if self._frequencies and self._min_frequency == frequency:
+                self._min_frequency = min(self._frequencies)
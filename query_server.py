@@ -0,0 +1,304 @@
+"""
+    A long lived HTTP server answering nearest neighbor queries over danny's index. The index (and the saved
+    similarity scores, if there are any) is memory-mapped once when the server starts, so a query only
+    costs the work for the user asked about, instead of every notebook or service loading the index itself.
+
+    Queries are answered by a fixed pool of n_workers threads (see PooledHTTPServer), all sharing the same
+    memory-mapped index. Once every worker is busy, up to MAX_QUEUED_REQUESTS more connections wait for one,
+    after which the server stops accepting and further connections wait in the listen backlog, so a burst
+    of queries can't start an unbounded number of threads:
+        GET  /neighbors?user_id=<id>&mode=<mode>&n=<n>&thresh=<thresh>
+                mode is one of:
+                    stored       - the neighbors saved by get_nearest_neighbors_batch, the fastest lookup
+                    exact        - user_functions.get_user_neighbors_exact
+                    approx       - user_functions.get_user_neighbors_approx
+                    above_thresh - user_functions.get_user_neighbors_above_thresh, sorted
+        GET  /status
+        POST /reload
+
+    Results of the exact, approx and above_thresh modes are kept in a query_cache.NeighborCache that belongs
+    to the loaded index, /status reports its hit rate.
+
+    A reload (POST /reload, or sending the process SIGHUP) memory-maps the index in output_dir again and
+    swaps it in, along with a new, empty cache, with a single assignment. Requests already running finish on
+    the index they started with, and as danny renames index files into place rather than overwriting them,
+    the old arrays stay readable until the last request using them is done. So a newly built or updated index
+    can be served without downtime, by reloading once the build has finished. If the new index can't be
+    loaded (e.g. it is half written), the failure is logged and the server keeps answering from the index it
+    already had, POST /reload responds with a 500 and the error.
+
+    Important Functions:
+        1. serve
+        2. load_index
+        3. query_neighbors
+
+    Important Classes:
+        1. PooledHTTPServer
+"""
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from scipy.sparse import issparse
+from supporting_functions import read_index, read_index_meta
+from neighbor_store import get_neighbors, read_neighbor_store
+from query_cache import NeighborCache
+from user_functions import get_user_neighbors_exact, get_user_neighbors_approx
+from user_functions import get_user_neighbors_above_thresh
+
+DEFAULT_DIR = "output_data/"
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8700
+DEFAULT_WORKERS = 8
+MAX_QUEUED_REQUESTS = 64
+QUERY_MODES = ["stored", "exact", "approx", "above_thresh"]
+
+CURRENT_INDEX = None
+
+def load_index(output_dir=DEFAULT_DIR):
+    """
+        Memory-maps everything the server needs from output_dir
+
+        Params:
+            output_dir (str) : directory danny's index was written to
+
+        Returns:
+            dict : user_entity_dict, entity_user_dict, user_entity_matrix, sparse (whether the matrix is
+                   sparse), store (the saved neighbor store or None), version (see
+                   supporting_functions.read_index_meta), cache (the NeighborCache of query results) and
+                   output_dir
+    """
+    start_time = time.time()
+    user_entity_dict, entity_user_dict, user_entity_matrix = read_index(output_dir)
+    store_path = output_dir + "similarity_scores/"
+    store = read_neighbor_store(store_path) if os.path.exists(store_path + "user_ids.npy") else None
+
+    index = {"user_entity_dict": user_entity_dict,
+             "entity_user_dict": entity_user_dict,
+             "user_entity_matrix": user_entity_matrix,
+             "sparse": issparse(user_entity_matrix),
+             "store": store,
+             "version": read_index_meta(output_dir)["version"],
+             "cache": NeighborCache(),
+             "output_dir": output_dir}
+    index["cache"].set_version(index["version"])
+    logging.info("loaded index version %s in %s seconds", index["version"], time.time() - start_time)
+
+    return index
+
+def reload_index(output_dir=DEFAULT_DIR):
+    """
+        Loads the index in output_dir and swaps it in as the index the server answers from. The index is
+        only swapped in once it is completely loaded, so if loading raises the old index keeps being served.
+
+        Params:
+            output_dir (str) : directory danny's index was written to
+
+        Returns:
+            int : version of the index now being served
+    """
+    global CURRENT_INDEX # pylint: disable=global-statement
+    CURRENT_INDEX = load_index(output_dir)
+
+    return CURRENT_INDEX["version"]
+
+def _reload_on_signal(output_dir):
+    """
+        Reloads the index when the process is sent SIGHUP. The handler runs on the thread serving
+        connections, so a failed reload is logged instead of raised, which would stop the server.
+
+        Params:
+            output_dir (str) : directory danny's index was written to
+
+        Returns:
+            None
+    """
+    try:
+        reload_index(output_dir)
+    except Exception: # pylint: disable=broad-except
+        logging.exception("reloading the index in %s failed, still serving version %s", output_dir,
+                          CURRENT_INDEX["version"])
+
+def query_neighbors(index, user_id, mode="stored", n_neighbors=20, thresh=0.9):
+    """
+        Answers one neighbor query from a loaded index
+
+        Params:
+            index       (dict) : index returned by load_index
+            user_id      (int) : id of user whose nearest neighbors are wanted
+            mode         (str) : one of QUERY_MODES
+            n_neighbors  (int) : number of neighbors requested, not used by "above_thresh"
+            thresh     (float) : minimum dot product, only used by "above_thresh"
+
+        Returns:
+            arr : each element is a tuple (user_id, dot_product), from the closest to the furthest
+    """
+    if mode not in QUERY_MODES:
+        raise ValueError("mode must be one of {}".format(QUERY_MODES))
+
+    if mode == "stored":
+        if index["store"] is None:
+            raise ValueError("no similarity scores have been saved for this index")
+        neighbor_ids, scores = get_neighbors(index["store"], user_id, n_neighbors)
+        return list(zip(neighbor_ids.tolist(), np.round(scores, 4).tolist()))
+
+    index_parts = (index["user_entity_dict"], index["entity_user_dict"], index["user_entity_matrix"])
+    if mode == "exact":
+        return get_user_neighbors_exact(user_id, *index_parts, n_neighbors=n_neighbors,
+                                        sparse=index["sparse"], cache=index["cache"])
+
+    if mode == "approx":
+        return get_user_neighbors_approx(user_id, *index_parts, n_neighbors=n_neighbors,
+                                         sparse=index["sparse"], cache=index["cache"])
+
+    return get_user_neighbors_above_thresh(user_id, *index_parts, thresh=thresh, sparse=index["sparse"],
+                                           sort=True, cache=index["cache"])
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+        Handles the requests described at the top of this module. Every request reads CURRENT_INDEX once, so
+        it is answered from one index even if a reload happens while it runs.
+    """
+    def _respond(self, status, body):
+        """
+            Sends a JSON response
+
+            Params:
+                status  (int) : HTTP status code
+                body   (dict) : JSON serializable response body
+        """
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        # pylint: disable=invalid-name, missing-docstring
+        url = urlparse(self.path)
+        index = CURRENT_INDEX
+        if url.path == "/status":
+            self._respond(200, {"version": index["version"], "n_users": index["user_entity_dict"].shape[0],
+                                "n_entities": index["user_entity_dict"].shape[1],
+                                "stored_neighbors": index["store"] is not None,
+                                "cache": index["cache"].stats()})
+            return
+
+        if url.path != "/neighbors":
+            self._respond(404, {"error": "unknown path {}".format(url.path)})
+            return
+
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        start_time = time.time()
+        try:
+            if "user_id" not in query:
+                raise ValueError("user_id is required")
+            neighbors = query_neighbors(index, int(query["user_id"]), query.get("mode", "stored"),
+                                        int(query.get("n", 20)), float(query.get("thresh", 0.9)))
+        except (ValueError, IndexError) as error:
+            self._respond(400, {"error": str(error)})
+            return
+
+        self._respond(200, {"user_id": int(query["user_id"]), "version": index["version"],
+                            "neighbors": neighbors, "seconds": time.time() - start_time})
+
+    def do_POST(self):
+        # pylint: disable=invalid-name, missing-docstring
+        if urlparse(self.path).path != "/reload":
+            self._respond(404, {"error": "unknown path {}".format(self.path)})
+            return
+
+        output_dir = CURRENT_INDEX["output_dir"]
+        try:
+            version = reload_index(output_dir)
+        except Exception as error: # pylint: disable=broad-except
+            logging.exception("reloading the index in %s failed, still serving version %s", output_dir,
+                              CURRENT_INDEX["version"])
+            self._respond(500, {"error": "reload failed: {}".format(error),
+                                "version": CURRENT_INDEX["version"]})
+            return
+
+        self._respond(200, {"version": version})
+
+    def log_message(self, format, *args):
+        # pylint: disable=redefined-builtin
+        logging.info(format, *args)
+
+class PooledHTTPServer(HTTPServer):
+    """
+        HTTPServer that answers its requests on a fixed pool of n_workers threads instead of a thread per
+        connection. At most MAX_QUEUED_REQUESTS accepted connections wait for a free worker, beyond that the
+        accept loop waits for a slot, and new connections queue up in the listen backlog.
+
+        Params:
+            server_address (tup) : (host, port) to listen on
+            handler_class (type) : request handler class, e.g. QueryHandler
+            n_workers      (int) : number of threads answering requests
+    """
+    def __init__(self, server_address, handler_class, n_workers=DEFAULT_WORKERS):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="danny-query")
+        self.slots = threading.BoundedSemaphore(n_workers + MAX_QUEUED_REQUESTS)
+
+    def process_request(self, request, client_address):
+        """
+            Hands an accepted connection to the worker pool, once a slot is free
+        """
+        self.slots.acquire()
+        self.executor.submit(self._process_in_worker, request, client_address)
+
+    def _process_in_worker(self, request, client_address):
+        """
+            Answers a connection on a worker thread, the same way HTTPServer would on its own thread
+        """
+        try:
+            self.finish_request(request, client_address)
+        except Exception: # pylint: disable=broad-except
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        """
+            Stops listening, and lets the requests already handed to the workers finish
+        """
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+def serve(output_dir=DEFAULT_DIR, host=DEFAULT_HOST, port=DEFAULT_PORT, n_workers=DEFAULT_WORKERS):
+    """
+        Loads the index in output_dir and answers neighbor queries over HTTP until interrupted. Sending the
+        process SIGHUP reloads the index, the same as POST /reload.
+
+        Params:
+            output_dir (str) : directory danny's index was written to
+            host       (str) : address to listen on, only local connections by default
+            port       (int) : port to listen on
+            n_workers  (int) : number of threads answering queries
+
+        Returns:
+            bool : True once the server has been shut down
+    """
+    reload_index(output_dir)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: _reload_on_signal(output_dir))
+
+    server = PooledHTTPServer((host, port), QueryHandler, n_workers)
+    logging.info("serving index version %s on %s:%s with %s workers", CURRENT_INDEX["version"], host, port,
+                 n_workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return True
@@ -0,0 +1,188 @@
+"""
+    Hands danny's per user work to a worker pool in a load balanced way. The cost of a user varies by orders
+    of magnitude with its degree (pruning walks the postings of every entity the user visited), so cutting
+    the users into equally sized chunks in user order leaves most workers idle while a few work through the
+    chunks that happen to hold the heavy users.
+
+    Instead, each user gets a cost estimate (see candidate_pruning.walk_costs for the estimates), and the
+    users are cut into chunks by cost rather than by count, following guided self-scheduling:
+        * users are taken from the most to the least expensive, so the heavy users are started first and
+          the light users are left to fill in around them as workers free up
+        * every chunk gets a share of the cost still left to hand out, so chunks start out large and shrink
+          towards the end, which keeps the work left when the first worker runs dry small
+    The chunks are dispatched one at a time with imap_unordered, so a worker picks up the next chunk as soon
+    as it is done with the previous one. When the results are consumed as they arrive (e.g. written out to
+    disk) instead of gathered, only a few chunks per worker are dispatched ahead of the consumer, so results
+    can't pile up in the parent when it falls behind the workers.
+
+    Each chunk is timed inside the worker, which gives a per worker utilization report: how much of the
+    wall time each worker spent working, and how long the pool waited on its last worker (the tail).
+
+    Important Functions:
+        1. schedule_chunks
+        2. run_scheduled
+        3. describe_utilization
+"""
+import os
+import threading
+import time
+import numpy as np
+
+GUIDED_FACTOR = 2
+MAX_CHUNKS_PER_PROCESS = 64
+IN_FLIGHT_PER_PROCESS = 2
+DISPATCH_POLL_SECONDS = 0.1
+
+def schedule_chunks(user_ids, costs, n_processes, max_chunk_size):
+    """
+        Cuts users into chunks of about equal cost, from the most to the least expensive users. Each chunk
+        gets 1 / (GUIDED_FACTOR * n_processes) of the cost that is left, but no less than
+        1 / (MAX_CHUNKS_PER_PROCESS * n_processes) of the total cost, and no more than max_chunk_size users.
+
+        Params:
+            user_ids       (arr) : users to work on
+            costs          (arr) : estimated cost of each user
+            n_processes    (int) : number of workers in the pool
+            max_chunk_size (int) : maximum number of users per chunk
+
+        Returns:
+            arr : chunks, most expensive first, each an array of user_ids sorted by id
+    """
+    user_ids = np.asarray(user_ids)
+    costs = np.asarray(costs, dtype=np.float64)
+    order = np.argsort(-costs, kind="stable")
+    user_ids = user_ids[order]
+    cumulative_costs = np.cumsum(costs[order])
+    total_cost = cumulative_costs[-1] if len(cumulative_costs) else 0.0
+    min_chunk_cost = total_cost / (MAX_CHUNKS_PER_PROCESS * n_processes)
+
+    chunks = []
+    start = 0
+    while start < len(user_ids):
+        cost_before = cumulative_costs[start - 1] if start else 0.0
+        chunk_cost = max((total_cost - cost_before) / (GUIDED_FACTOR * n_processes), min_chunk_cost)
+        end = np.searchsorted(cumulative_costs, cost_before + chunk_cost, "right")
+        end = min(max(end, start + 1), start + max_chunk_size)
+        chunks.append(np.sort(user_ids[start:end]))
+        start = end
+
+    return chunks
+
+def _timed_task(function_task):
+    """
+        Runs a task in a pool worker and times it
+
+        Params:
+            function_task (tup) : module level function to call, its argument
+
+        Returns:
+            tup : (result of the function, process id of the worker, start time, end time)
+    """
+    function, task = function_task
+    start_time = time.time()
+    result = function(task)
+
+    return (result, os.getpid(), start_time, time.time())
+
+def run_scheduled(pool, function, tasks, n_processes, consume=None):
+    """
+        Dispatches the tasks to the pool one at a time with imap_unordered, in the order given (see
+        schedule_chunks), and reports how busy each worker was.
+
+        With consume, each result is handed to consume as soon as it arrives instead of being gathered, and
+        at most IN_FLIGHT_PER_PROCESS tasks per worker are dispatched but not yet consumed: the pool only
+        pulls the next task once a result has been consumed, so the parent holds a bounded number of results
+        however many tasks there are. The tasks are pulled by the pool's task handler thread, which waits for
+        a slot in DISPATCH_POLL_SECONDS steps and gives up once run_scheduled stops early (e.g. consume or a
+        worker raised), so the pool can still be terminated and joined.
+
+        Params:
+            pool          (Pool) : pool of workers to run the tasks on
+            function      (func) : module level function each task is passed to
+            tasks          (arr) : arguments for function, one per task
+            n_processes    (int) : number of workers in the pool
+            consume  (func|None) : called with each result as it arrives, None gathers the results
+
+        Returns:
+            tup : (results of the tasks in the order they finished, empty with consume, utilization report,
+                   see utilization_report)
+    """
+    start_time = time.time()
+    results = []
+    timings = []
+    in_flight = threading.BoundedSemaphore(IN_FLIGHT_PER_PROCESS * n_processes) if consume else None
+    stopped = threading.Event()
+
+    def _dispatch():
+        for task in tasks:
+            while in_flight is not None and not in_flight.acquire(timeout=DISPATCH_POLL_SECONDS):
+                if stopped.is_set():
+                    return
+            if stopped.is_set():
+                return
+            yield (function, task)
+
+    try:
+        for result, pid, task_start, task_end in pool.imap_unordered(_timed_task, _dispatch()):
+            timings.append((pid, task_start, task_end))
+            if consume is None:
+                results.append(result)
+                continue
+            try:
+                consume(result)
+            finally:
+                in_flight.release()
+    finally:
+        stopped.set()
+
+    return (results, utilization_report(timings, start_time, time.time(), n_processes))
+
+def utilization_report(timings, start_time, end_time, n_processes):
+    """
+        Summarizes how busy each worker of a pool was while running a batch of tasks
+
+        Params:
+            timings     (arr) : each element is a tuple (process id, task start time, task end time)
+            start_time (float) : when the tasks were dispatched
+            end_time   (float) : when the last result came back
+            n_processes  (int) : number of workers in the pool, workers that got no task count as idle
+
+        Returns:
+            dict : wall_time, tasks, utilization (process id -> share of the wall time spent on tasks),
+                   mean_utilization, min_utilization and tail (seconds between the first and the last
+                   worker finishing their last task)
+    """
+    wall_time = max(end_time - start_time, 1e-9)
+    busy = {}
+    last_end = {}
+    for pid, task_start, task_end in timings:
+        busy[pid] = busy.get(pid, 0.0) + task_end - task_start
+        last_end[pid] = max(last_end.get(pid, task_end), task_end)
+
+    utilization = {pid: busy_time / wall_time for pid, busy_time in busy.items()}
+    all_utilization = list(utilization.values()) + [0.0] * max(n_processes - len(utilization), 0)
+    ends = list(last_end.values()) + [start_time] * max(n_processes - len(last_end), 0)
+
+    return {"wall_time": wall_time,
+            "tasks": len(timings),
+            "utilization": utilization,
+            "mean_utilization": float(np.mean(all_utilization)) if all_utilization else 0.0,
+            "min_utilization": float(min(all_utilization)) if all_utilization else 0.0,
+            "tail": max(ends) - min(ends) if ends else 0.0}
+
+def describe_utilization(report):
+    """
+        Describes a utilization report in one line, for logging
+
+        Params:
+            report (dict) : report returned by utilization_report
+
+        Returns:
+            str : description of the report
+    """
+    per_worker = ", ".join("{:.0%}".format(utilization)
+                           for utilization in sorted(report["utilization"].values(), reverse=True))
+
+    return "{} tasks in {:.2f} seconds, worker utilization {} (mean {:.0%}, min {:.0%}), tail of {:.2f} " \
+           "seconds".format(report["tasks"], report["wall_time"], per_worker or "-",
+                            report["mean_utilization"], report["min_utilization"], report["tail"])
@@ -0,0 +1,114 @@
+"""
+    Splitting a nearest neighbor job across machines. Every user's neighbors only depend on the (read only)
+    index, so a job can be split into shards of users that run on different machines against copies of the
+    same index (see shard_user_ids). Each shard writes its own part of the results, and merge_shard_parts
+    combines the parts once they are gathered in one directory. With the .npy index the pool workers
+    memory-map the index files, so a machine only reads the pages its users touch: under the "range" scheme
+    that is one contiguous slice of the user-entity dictionary, plus the postings and matrix rows its users
+    reach. A pickled index is read whole on every machine.
+
+    Important functions:
+        shard_user_ids
+        merge_shard_parts
+"""
+import logging
+import os
+import time
+import numpy as np
+from neighbor_store import MANIFEST_FILE, merge_shards, read_shard_manifest
+
+DEFAULT_DIR = "output_data/"
+SHARD_SCHEMES = ["range", "hash"]
+SHARD_PARTS_DIR = "similarity_scores_parts/"
+
+def shard_user_ids(user_ids, shard, n_users, scheme="range"):
+    """
+        Picks the users one shard of a job split across machines computes (see the top of the module).
+        Every user lands in exactly one of the shards, and which one only depends on its id, the number of
+        shards and the scheme, so every machine agrees on it:
+            * "range" cuts the ids 0..n_users - 1 into shard count contiguous ranges, so a shard only reads
+              its own slice of the user-entity dictionary
+            * "hash" scatters the ids over the shards with a 64 bit mixing function, which evens the work out
+              when the expensive users are bunched together in id order (e.g. the oldest users)
+
+        Params:
+            user_ids   (arr) : users of the whole job
+            shard      (tup) : (index, count), the index-th of count shards, index counting from 1
+            n_users    (int) : number of users in the index
+            scheme     (str) : one of SHARD_SCHEMES
+
+        Returns:
+            arr : the user_ids of the shard, sorted
+    """
+    if scheme not in SHARD_SCHEMES:
+        raise ValueError("shard scheme must be one of {}".format(SHARD_SCHEMES))
+
+    index, count = shard
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError("shard must be (index, count) with 1 <= index <= count")
+
+    user_ids = np.unique(np.asarray(user_ids, dtype=np.int64))
+    if scheme == "range":
+        start = n_users * (index - 1) // count
+        end = n_users * index // count
+        return user_ids[(user_ids >= start) & (user_ids < end)]
+
+    hashes = user_ids.astype(np.uint64)
+    hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    hashes ^= hashes >> np.uint64(31)
+
+    return user_ids[hashes % np.uint64(count) == index - 1]
+
+def shard_part_path(output_dir, shard):
+    """
+        Directory the part of the similarity scores computed by one shard is written to
+
+        Params:
+            output_dir (str) : the directory the similarity scores are written to
+            shard      (tup) : (index, count), see shard_user_ids
+
+        Returns:
+            str : output_dir/similarity_scores_parts/part_<index>_of_<count>/
+    """
+    return output_dir + SHARD_PARTS_DIR + "part_{:05d}_of_{:05d}/".format(*shard)
+
+def merge_shard_parts(output_dir=DEFAULT_DIR, quantize=None):
+    """
+        Merges the parts of the similarity scores written by the shards of a job split across machines (see
+        get_nearest_neighbors_batch's shard) into output_dir/similarity_scores/, the same store a run on a
+        single machine writes. The parts must first be gathered in output_dir/similarity_scores_parts/, and
+        every shard of the job must have completed its part.
+
+        Params:
+            output_dir       (str) : the directory holding similarity_scores_parts/
+            quantize   (bool|None) : store scores as uint16, None keeps the quantization of the parts
+
+        Returns:
+            bool : True once merged
+    """
+    start_time = time.time()
+    parts_dir = output_dir + SHARD_PARTS_DIR
+    part_paths = []
+    if os.path.isdir(parts_dir):
+        part_paths = [os.path.join(parts_dir, name) for name in sorted(os.listdir(parts_dir))
+                      if os.path.exists(os.path.join(parts_dir, name, MANIFEST_FILE))]
+    manifests = [read_shard_manifest(part_path) for part_path in part_paths]
+    shardings = set()
+    for manifest in manifests:
+        shard = manifest["meta"].get("shard")
+        shardings.add((shard[1], manifest["meta"]["shard_scheme"]) if shard else None)
+    if len(shardings) != 1 or None in shardings:
+        raise ValueError("{} should hold the parts of one sharded job".format(parts_dir))
+
+    count, scheme = shardings.pop()
+    completed = {manifest["meta"]["shard"][0] for manifest in manifests if manifest["complete"]}
+    missing = sorted(set(range(1, count + 1)) - completed)
+    if missing:
+        raise ValueError("parts {} of the {} shards are missing or incomplete".format(missing, count))
+
+    store = merge_shards(part_paths, output_dir + "similarity_scores/", quantize)
+    logging.info("merged %s parts (%s sharding) holding %s users in %s seconds", count, scheme,
+                 len(store["user_ids"]), time.time() - start_time)
+
+    return True
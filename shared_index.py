@@ -0,0 +1,129 @@
+"""
+    Lets pool workers attach to danny's index without relying on Linux forking after the module globals have
+    been assigned. With the spawn or forkserver start methods a worker starts from a fresh interpreter, so
+    instead of inheriting the index it is handed a small spec per part of the index, and attaches to it in
+    the pool initializer:
+        1. ("file", file_name)  : the part was read from danny's .npy index files, the worker memory-maps the
+                                  same files (see supporting_functions.read_index_file)
+        2. ("shm", layout)      : the part only lives in the parent's memory (or its files have segments
+                                  appended by index_update, which read_index_file applies in memory), so its
+                                  arrays are copied once into multiprocessing.shared_memory blocks and the
+                                  worker maps those blocks
+
+    Either way nothing is pickled to the workers and every worker reads the same physical pages, no matter
+    which start method is used.
+
+    Important Functions:
+        1. share_index_part
+        2. attach_index_part
+        3. release_shared_blocks
+"""
+from multiprocessing import shared_memory
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix, issparse
+from supporting_functions import has_index_segments, read_index_file
+
+ATTACHED_BLOCKS = []
+
+def _share_array(array, blocks):
+    """
+        Copies an array into a new shared memory block
+
+        Params:
+            array  (arr) : array to share
+            blocks (arr) : list the created SharedMemory block is appended to, so the parent can release it
+
+        Returns:
+            tup : (block name, dtype string, shape) needed to attach to the block
+    """
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    blocks.append(block)
+
+    return (block.name, array.dtype.str, array.shape)
+
+def _attach_array(layout):
+    """
+        Maps a shared memory block created by _share_array as a numpy array, without copying it. The block
+        is kept referenced in ATTACHED_BLOCKS for the life of the worker, the parent is the one that frees it
+
+        Params:
+            layout (tup) : (block name, dtype string, shape)
+
+        Returns:
+            arr : array backed by the shared memory block
+    """
+    name, dtype, shape = layout
+    block = shared_memory.SharedMemory(name=name)
+    ATTACHED_BLOCKS.append(block)
+
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+def share_index_part(data, file_name=None):
+    """
+        Builds the spec a pool worker needs to attach to one part of danny's index (a dictionary, the matrix
+        or any other array). Parts read from .npy index files are shared by file name, unless segments were
+        appended to them (see supporting_functions.append_index_segment), everything else is copied into
+        shared memory.
+
+        Params:
+            data (csr_matrix|csc_matrix|arr) : the part of the index
+            file_name             (str|None) : index file the part was read from, if any
+
+        Returns:
+            tup : (spec, list of SharedMemory blocks created that must be released once the pool is done)
+    """
+    blocks = []
+    if file_name is not None and not file_name.endswith(".pickle") and not has_index_segments(file_name):
+        return (("file", file_name), blocks)
+
+    if issparse(data):
+        layout = {"format": data.format, "shape": data.shape,
+                  "arrays": [_share_array(array, blocks) for array in (data.data, data.indices, data.indptr)]}
+    else:
+        layout = {"format": "dense", "array": _share_array(data, blocks)}
+
+    return (("shm", layout), blocks)
+
+def attach_index_part(spec):
+    """
+        Attaches to a part of danny's index from the spec built by share_index_part. Called from the pool
+        initializers.
+
+        Params:
+            spec (tup|None) : spec built by share_index_part
+
+        Returns:
+            csr_matrix | csc_matrix | arr | None : the part of the index
+    """
+    if spec is None:
+        return None
+
+    kind, location = spec
+    if kind == "file":
+        return read_index_file(location)
+
+    if location["format"] == "dense":
+        return _attach_array(location["array"])
+
+    matrix_type = csr_matrix if location["format"] == "csr" else csc_matrix
+    arrays = tuple(_attach_array(layout) for layout in location["arrays"])
+
+    return matrix_type(arrays, shape=location["shape"], copy=False)
+
+def release_shared_blocks(blocks):
+    """
+        Closes and frees the shared memory blocks created by share_index_part, once no worker needs them
+
+        Params:
+            blocks (arr) : SharedMemory blocks
+
+        Returns:
+            bool : True on completion
+    """
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+    return True
@@ -1,17 +1,33 @@
 """
     Functions that support the actual finding of nearest neighbors per user. The functions can be grouped
     by the following:
-        1. Interacting with pickle files
+        1. Interacting with pickle files and danny's raw array (.npy) index files
         2. Ensuring the user_ids and entity_ids passed in are consecutive integers starting from 0
         3. Building count or one_hot dictionaries describing user visitation patterns / entity visitation
            patterns
         4. Building a user_entity_matrix
 
+    Reading the log files (and the binary edge logs they can be converted to) and the partitions the
+    dictionaries are built from live in edge_log, and updating an index that was already built with new logs
+    lives in index_update.
+
     These functions ensure the data being fed into danny is as expected, and then creates the three needed
     data structures danny needs to operate:
-        1. user_entity_dict: does so in a parrallel way
-        2. entity_user_dict: does so in a parrallel way
-        3. user_entity_dict: uses scikit learn
+        1. user_entity_dict: does so in a parrallel way (partitioned by user), stored as a CSR matrix
+        2. entity_user_dict: does so in a parrallel way (partitioned by entity), stored as a CSC matrix
+        3. user_entity_matrix: row normalized version of the user_entity_dict
+
+    The two "dictionaries" are kept as int32 indptr/indices/data arrays (scipy's CSR and CSC layouts) rather
+    than as nested Python dicts:
+        * user_entity_dict.indices[indptr[user_id]:indptr[user_id + 1]] are the entities user_id visited
+        * entity_user_dict.indices[indptr[entity_id]:indptr[entity_id + 1]] are the users who visited
+          entity_id
+        * the matching slice of .data holds the visit counts (or 1 for one hot encoding)
+    Both are the same count matrix (rows - users, columns - entities), just compressed along different axes.
+
+    When saved, every part of the index (both dictionaries, the matrix and the user/entity degree arrays) is
+    written out as raw .npy arrays rather than pickled. Reading them back memory-maps the arrays, so every
+    pool worker shares the same pages of the OS page cache instead of holding its own copy of the index.
 
     You can think of these functions as building danny's index so that danny can later query who the close
     users are for each user.
@@ -21,17 +37,23 @@
         2. create_dictionaries
         3. create_matrix
 """
+import glob
 import logging
 from multiprocessing import Pool, cpu_count
-from operator import itemgetter
+import os
 import pickle
+import shutil
+import tempfile
 import time
-from sklearn.feature_extraction import DictVectorizer
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix, issparse
 from sklearn.preprocessing import normalize
+from edge_log import POWERS_OF_TEN, is_edge_log, read_edge_log, split_log_ranges, read_log_edges
+from edge_log import build_partition, partition_log_range, stitch_partitions
 
 DEFAULT_DIR = "output_data/"
 MAX_PROCESSES = cpu_count()
-MAX_LOG_CHUNK = 500000
+HUB_PERCENTILES = [50, 90, 99, 99.9, 99.99]
 
 def read_pickle_file(file_name):
     """
@@ -46,12 +68,13 @@ def read_pickle_file(file_name):
     # pylint: disable=invalid-name
     with open(file_name, "rb") as f:
         data = pickle.load(f)
-    
+
     return data
 
 def write_pickle_file(data, file_name):
     """
-        Writes a pickle file
+        Writes a pickle file. The data is written to a temporary file that then replaces file_name, so a
+        reader never sees a half written file
 
         Params:
             data   (Object) : the data that needs to be pickled
@@ -61,348 +84,746 @@ def write_pickle_file(data, file_name):
             bool : True on completion
     """
     # pylint: disable=invalid-name
-    with open(file_name, "wb") as f:
+    with open(file_name + ".tmp", "wb") as f:
         pickle.dump(data, f)
+    os.replace(file_name + ".tmp", file_name)
 
     return True
 
-def reindex_log_file(raw_log_file, save=True, output_dir=DEFAULT_DIR):
+def save_array(array, file_name):
     """
-        Function reads a log file of the expected format of: user_id, entity_id and reindexes users and
-        entities to ensure that user_ids and entity_ids start from zero and are consecutive. The result
-        of the conversion and the mapping between the old indicies and the new ones can either be returned
-        or written out. The log file will be writeen out in the expected log format, while the mappings will
-        be written out as pickle files.
+        Saves an array as a .npy file. Like write_pickle_file it writes a temporary file that then replaces
+        file_name, so arrays that are memory-mapped by a running process (or by the caller, while it builds
+        the new version of the index) keep their old contents instead of being truncated
 
-        In order to preserve links between a user and their entity visitation pattern, or an entity and its
-        user visitation pattern, user and entity ids must start at 0 and be consecutive. For more on this you
-        can read the readme.
+        Params:
+            array     (arr) : the array to save
+            file_name (str) : name of the .npy file
+
+        Returns:
+            bool : True on completion
+    """
+    # pylint: disable=invalid-name
+    with open(file_name + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(file_name + ".tmp", file_name)
+
+    return True
+
+def write_sparse_arrays(matrix, file_name, meta=None):
+    """
+        Writes a CSR or CSC matrix out as raw .npy arrays, so that it can later be memory-mapped:
+            file_name_indptr.npy, file_name_indices.npy, file_name_data.npy
+            file_name_meta.pickle : the format ("csr" or "csc") and shape of the matrix, plus anything in meta
 
         Params:
-            raw_log_file (str) : name of log file to reindex
-            save        (bool) : boolean to indicate whether to save the results of reindexing
-            output_dir   (str) : directory to write out to
+            matrix (csr_matrix|csc_matrix) : the matrix to write out
+            file_name                (str) : path + prefix of the files to write
+            meta               (dict|None) : extra information to keep in the meta file
 
         Returns:
-            tup | bool : if the results are not to be saved the function returns:
-                         (array of reindexed logs, user index mapping, entity index mapping)
-                         else it returns True to indicate the results were saved
+            bool : True on completion
     """
-    #pylint: disable=too-many-locals, invalid-name
-    user_index = {}
-    entity_index = {}
-    user_count = 0
-    entity_count = 0
-    new_logs = []
-    start_time = time.time()
-    with open(raw_log_file) as logs:
-        for line in logs:
-            parts = line.split(",")
-            user_id = int(parts[0])
-            entity_id = int(parts[1])
-
-            if user_id not in user_index:
-                user_index[user_id] = user_count
-                user_count += 1
-            
-            if entity_id not in entity_index:
-                entity_index[entity_id] = entity_count
-                entity_count += 1
-
-            new_logs.append(str(user_index[user_id]) + "," + str(entity_index[entity_id]))
-
-    logging.info("read in and converted logs in %s seconds", time.time() - start_time)
-    start_time = time.time()
+    save_array(matrix.indptr, file_name + "_indptr.npy")
+    save_array(matrix.indices, file_name + "_indices.npy")
+    save_array(matrix.data, file_name + "_data.npy")
+    matrix_meta = dict(meta) if meta else {}
+    matrix_meta.update({"format": matrix.format, "shape": matrix.shape})
+    write_pickle_file(matrix_meta, file_name + "_meta.pickle")
 
-    if save:
-        converted_log_file_name = output_dir + "converted_logs.csv"
-        with open(converted_log_file_name, "w") as f:
-            for i, line in enumerate(new_logs):
-                if i < len(new_logs) -1:
-                    f.write(line+"\n")
-                else:
-                    f.write(line)
-        
-        logging.info("wrote out converted logs in %s seconds", time.time() - start_time)
-        start_time = time.time()
+    return True
 
-        user_index_file = output_dir + "user_index.pickle"
-        entity_index_file = output_dir + "entity_index.pickle"
-        write_pickle_file(user_index, user_index_file)
-        write_pickle_file(entity_index, entity_index_file)
+def read_sparse_arrays(file_name, mmap=True):
+    """
+        Reads a matrix written by write_sparse_arrays. With mmap the indptr/indices/data arrays are opened
+        read-only with numpy's memmap, and the returned matrix is a view over them, nothing is copied into
+        memory.
 
-        logging.info("wrote out mappings in %s seconds", time.time() - start_time)
-        start_time = time.time()
+        Params:
+            file_name (str) : path + prefix the matrix was written with
+            mmap     (bool) : memory-map the arrays instead of reading them into memory
 
-        del user_index
-        del entity_index
-        del new_logs
-        return True
-    
-    return (new_logs, user_index, entity_index)
+        Returns:
+            csr_matrix | csc_matrix : the matrix
+    """
+    meta = read_pickle_file(file_name + "_meta.pickle")
+    mmap_mode = "r" if mmap else None
+    arrays = (np.load(file_name + "_data.npy", mmap_mode=mmap_mode),
+              np.load(file_name + "_indices.npy", mmap_mode=mmap_mode),
+              np.load(file_name + "_indptr.npy", mmap_mode=mmap_mode))
+    matrix_type = csr_matrix if meta["format"] == "csr" else csc_matrix
 
-def reverse_index(input_type, data_source, index_type=None, save=True, output_dir=DEFAULT_DIR):
+    return matrix_type(arrays, shape=meta["shape"], copy=False)
+
+def write_index_file(data, file_name):
     """
-        Function swithces around key value pairs of a dictionary to allow for both forward and backward
-        switching between new and old indicies for users and entities.
+        Writes one part of danny's index (a dictionary, the matrix or a degree array) as raw .npy arrays.
+        Sparse matrices go through write_sparse_arrays, dense arrays are written to file_name.npy. Any
+        segments appended to the part (see append_index_segment) are dropped, data replaces them.
 
-        When inspecting the results of the nearest neighbors it is useful to have the reverse index to see
-        which original user_ids are close to each other.
+        Params:
+            data (csr_matrix|csc_matrix|arr) : the part of the index to write out
+            file_name                  (str) : path + prefix to write to (no extension)
+
+        Returns:
+            bool : True on completion
+    """
+    if issparse(data):
+        if os.path.exists(file_name + ".npy"):
+            os.remove(file_name + ".npy")
+        write_sparse_arrays(data, file_name)
+    else:
+        if os.path.exists(file_name + "_meta.pickle"):
+            os.remove(file_name + "_meta.pickle")
+        save_array(np.asarray(data), file_name + ".npy")
+
+    if os.path.exists(file_name + "_segments.pickle"):
+        os.remove(file_name + "_segments.pickle")
+    for segment_file_name in glob.glob(glob.escape(file_name) + "_segment_*"):
+        os.remove(segment_file_name)
+
+    return True
+
+def _read_part_files(file_name, mmap=True):
+    """
+        Reads the files write_index_file wrote for one part of danny's index, without its segments
 
         Params:
-            input_type  (str) : indicates whether a file or dict is being passed into the function
-            data_source (str) : the source of data, so either the file or dict
-            index_type  (str) : indicating what type of index is being saved, i.e. user_index
-                                can be left None if output is not being saved
-            save       (bool) : whether to save the output of the function
-            output_dir  (str) : directory to write out to
+            file_name (str) : path + prefix the part was written with
+            mmap     (bool) : memory-map the arrays instead of reading them into memory
 
         Returns:
-            tup | bool : if the results are not to be saved the function returns the reversed_index
-                         else it returns True to indicate the results were saved
+            csr_matrix | csc_matrix | arr : the part of the index as it was last written in full
     """
-    input_types = ["file", "dict"]
-    if input_type not in input_types:
-        raise ValueError("input_type must be one of \"file\" or \"dict\"")
+    if os.path.exists(file_name + ".npy"):
+        return np.load(file_name + ".npy", mmap_mode="r" if mmap else None)
 
-    if input_type == "file" and not isinstance(data_source, str):
-        raise ValueError("data_source must indicated the pickle file you would like to be read in to \
-            to reverse your index")
+    return read_sparse_arrays(file_name, mmap)
 
-    if input_type == "dict" and not isinstance(data_source, dict):
-        raise ValueError("data_source must be the needed dictionary/index")
+def _read_segment_manifest(file_name):
+    """
+        Reads the list of segments appended to one part of danny's index (see append_index_segment)
 
-    if save and index_type is None:
-        raise ValueError("index_type cannot be null if the reveresed index is going to be saved. Common \
-            options are: entity, user, site, song, video")
+        Params:
+            file_name (str) : path + prefix the part was written with
 
-    reversed_index = {}
+        Returns:
+            dict | None : segments (number of segments), entries (number of values they hold), part_entries
+                          (number of values in the part's own files), shape (of the part with the segments
+                          applied) and dense, or None if the part has no segments
+    """
+    manifest_file_name = file_name + "_segments.pickle"
+    if not os.path.exists(manifest_file_name):
+        return None
 
-    if input_type == "file":
-        index = read_pickle_file(data_source)
-    else:
-        index = data_source
+    return read_pickle_file(manifest_file_name)
 
-    for key in index:
-        reversed_index[index[key]] = key
+def has_index_segments(file_name):
+    """
+        Whether rows were appended to one part of danny's index as segments (see append_index_segment), in
+        which case its files alone are out of date
 
-    if save:
-        reversed_index_file_name = output_dir + index_type + "_reverse_index.pickle"
-        write_pickle_file(reversed_index, reversed_index_file_name)
+        Params:
+            file_name (str) : path + prefix the part was written with
 
-        del reversed_index
-        return True
+        Returns:
+            bool : True if the part has segments
+    """
+    return _read_segment_manifest(file_name) is not None
 
-    return reversed_index
+def _major_rows(matrix):
+    """
+        Views a sparse part of the index as a CSR matrix over its compressed axis, without copying it
+
+        Params:
+            matrix (csr_matrix|csc_matrix) : the part of the index
 
-def _create_count_mini_dictionaries(logs):
+        Returns:
+            csr_matrix : the matrix itself for CSR, its transpose (rows - entities) for CSC
+    """
+    return matrix if matrix.format == "csr" else matrix.T
+
+def _gather_rows(file_name, manifest, row_ids):
     """
-        Function called by pool workers to parralelize the process of creating two count dictionaries from
-        the expected log file format. The two dictionaries are the user-entity dictionary and the entity-user
-        dictionary, and are of following format:
-        
-        user-entity dict:
-            key - user_id
-            value - dict :
-                           key - entity_id
-                           value - count of the number time user_id visited entity_id
+        Gathers the latest version of some rows of one part of danny's index. Every row is taken from the
+        last segment that holds it, or from the part's own files if no segment does, and only the requested
+        rows are read from the memory-mapped arrays.
 
-        entity-user dict:
-            key - entity_id
-            value - dict :
-                           key - user_id
-                           value - count of the number time user_id visited entity_id
+        Params:
+            file_name (str) : path + prefix the part was written with
+            manifest (dict) : the part's segment manifest (see _read_segment_manifest)
+            row_ids   (arr) : sorted ids of the rows (along the compressed axis of sparse parts)
 
-        The original log file is split into mulitple parts, each for a pool worker to consume, create their
-        version of these dictionaries that will then be merged at the end to create the comprehensive
-        dictionaries
+        Returns:
+            csr_matrix | arr : the rows, a CSR matrix for sparse parts and a dense array for dense ones
+    """
+    # pylint: disable=too-many-locals
+    row_ids = np.asarray(row_ids, dtype=np.int64)
+    sources = [_read_part_files(file_name)]
+    source_ids = np.zeros(len(row_ids), dtype=np.int64)
+    positions = row_ids.copy()
+    for segment in range(manifest["segments"]):
+        segment_name = "{}_segment_{}".format(file_name, segment)
+        segment_row_ids = np.load(segment_name + "_row_ids.npy", mmap_mode="r")
+        sources.append(_read_part_files(segment_name))
+        if len(segment_row_ids) == 0:
+            continue
+        found = np.minimum(np.searchsorted(segment_row_ids, row_ids), len(segment_row_ids) - 1)
+        held = segment_row_ids[found] == row_ids
+        source_ids[held] = segment + 1
+        positions[held] = found[held]
+
+    if manifest["dense"]:
+        rows = np.zeros((len(row_ids), manifest["shape"][1]), dtype=sources[0].dtype)
+        for source_id, source in enumerate(sources):
+            picked = np.flatnonzero((source_ids == source_id) & (positions < source.shape[0]))
+            rows[picked, :source.shape[1]] = source[positions[picked]]
+        return rows
+
+    partitions = []
+    for source_id, source in enumerate(sources):
+        source_rows = _major_rows(source)
+        picked = np.flatnonzero((source_ids == source_id) & (positions < source_rows.shape[0]))
+        picked_rows = source_rows[positions[picked]]
+        partitions.append((picked, np.diff(picked_rows.indptr), picked_rows.indices, picked_rows.data))
+    n_columns = manifest["shape"][1] if sources[0].format == "csr" else manifest["shape"][0]
+
+    return csr_matrix(stitch_partitions(partitions, len(row_ids)), shape=(len(row_ids), n_columns))
+
+def replace_index_rows(data, row_ids, rows, shape):
+    """
+        Builds a copy of one part of danny's index with some of its rows replaced, grown to a larger shape
+        first if needed (new rows and columns are empty). For sparse parts the rows that are kept are moved
+        over in bulk with stitch_partitions, only the replaced rows have to be computed by the caller.
 
         Params:
-            logs (arr) : array of strings of the following format: user_id, entity_id
+            data (csr_matrix|csc_matrix|arr) : the part of the index
+            row_ids                    (arr) : sorted ids of the rows to replace, along the compressed axis
+            rows            (csr_matrix|arr) : the new rows, row i replaces row row_ids[i], a CSR matrix over
+                                               the compressed axis for sparse parts
+            shape                      (tup) : shape of the new part, at least the shape of data
 
         Returns:
-            tup : user_entity_dict, entity_user_dict
+            csr_matrix | csc_matrix | arr : the part with the rows replaced
+    """
+    if not issparse(data):
+        replaced = np.zeros(shape, dtype=data.dtype)
+        replaced[:data.shape[0], :data.shape[1]] = data
+        replaced[row_ids] = rows.toarray() if issparse(rows) else rows
+        return replaced
+
+    major_rows = _major_rows(data)
+    n_rows = shape[0] if data.format == "csr" else shape[1]
+    lengths = np.zeros(n_rows, dtype=np.int64)
+    lengths[:major_rows.shape[0]] = np.diff(major_rows.indptr)
+    keep = np.ones(n_rows, dtype=bool)
+    keep[row_ids] = False
+    kept_entries = np.repeat(keep[:major_rows.shape[0]], lengths[:major_rows.shape[0]])
+
+    partitions = [(np.flatnonzero(keep), lengths[keep], np.asarray(major_rows.indices)[kept_entries],
+                   np.asarray(major_rows.data)[kept_entries]),
+                  (row_ids, np.diff(rows.indptr), rows.indices, rows.data.astype(major_rows.data.dtype))]
+    matrix_type = csr_matrix if data.format == "csr" else csc_matrix
+
+    return matrix_type(stitch_partitions(partitions, n_rows), shape=shape)
+
+def append_index_segment(rows, row_ids, shape, file_name):
     """
-    user_entity_dict = {}
-    entity_user_dict = {}
+        Stores new versions of some rows of one part of danny's index (a dictionary or the matrix) as a
+        segment next to its files, instead of writing the whole part again. Only the rows passed in are
+        written. read_index_file and read_index_rows apply the segments in the order they were appended,
+        a row in a later segment replaces the same row of the part and of earlier segments. Rows are taken
+        along the compressed axis: users for the user_entity_dict and the matrix, entities for the
+        entity_user_dict. Writing the part in full (see write_index_file) drops its segments.
 
-    for line in logs:
-        parts = line.rstrip().split(",")
-        user_id = int(parts[0])
-        entity_id = int(parts[1])
+        Params:
+            rows (csr_matrix) : the new rows, dense parts store them as a dense array
+            row_ids    (arr) : sorted ids of the rows, row i of rows replaces row row_ids[i]
+            shape      (tup) : shape of the part once the segment is applied, at least its current shape
+            file_name  (str) : path + prefix the part was written with
+
+        Returns:
+            tup : (number of values held by the part's segments, number of values in the part's own files),
+                  to tell when the part is better written in full again
+    """
+    manifest = _read_segment_manifest(file_name)
+    if manifest is None:
+        data = _read_part_files(file_name)
+        manifest = {"segments": 0, "entries": 0, "dense": not issparse(data),
+                    "part_entries": data.size if not issparse(data) else data.nnz}
+
+    rows = rows.toarray() if manifest["dense"] else rows
+    segment_name = "{}_segment_{}".format(file_name, manifest["segments"])
+    save_array(np.asarray(row_ids, dtype=np.int64), segment_name + "_row_ids.npy")
+    write_index_file(rows, segment_name)
+    manifest.update({"segments": manifest["segments"] + 1, "shape": tuple(shape),
+                     "entries": manifest["entries"] + (rows.size if manifest["dense"] else rows.nnz)})
+    write_pickle_file(manifest, file_name + "_segments.pickle")
+
+    return (manifest["entries"], manifest["part_entries"])
+
+def read_index_rows(file_name, row_ids):
+    """
+        Reads some rows of one part of danny's index, with its segments applied, without reading the rest
+        of the part
 
-        if user_id not in user_entity_dict:
-            user_entity_dict[user_id] = {}
+        Params:
+            file_name (str) : path + prefix the part was written with
+            row_ids   (arr) : sorted ids of the rows, along the compressed axis (users for the
+                              user_entity_dict and the matrix, entities for the entity_user_dict), ids past
+                              the end of the part give empty rows
 
-        if entity_id in user_entity_dict[user_id]:
-            user_entity_dict[user_id][entity_id] += 1
-        else:
-            user_entity_dict[user_id][entity_id] = 1
+        Returns:
+            csr_matrix | arr : the rows, a CSR matrix over the compressed axis for sparse parts and a dense
+                               array for dense ones
+    """
+    manifest = _read_segment_manifest(file_name)
+    if manifest is None:
+        data = _read_part_files(file_name)
+        manifest = {"segments": 0, "dense": not issparse(data), "shape": data.shape}
 
-        if entity_id not in entity_user_dict:
-            entity_user_dict[entity_id] = {}
+    return _gather_rows(file_name, manifest, row_ids)
 
-        if user_id in entity_user_dict[entity_id]:
-            entity_user_dict[entity_id][user_id] += 1
-        else:
-            entity_user_dict[entity_id][user_id] = 1
+def read_index_file(file_name, mmap=True):
+    """
+        Reads one part of danny's index written by write_index_file, memory-mapped by default. For backwards
+        compatibility, file names ending in ".pickle" are unpickled instead. If segments were appended to the
+        part (see append_index_segment), they are applied and the part is returned in memory, whatever mmap
+        is.
 
-    return (user_entity_dict, entity_user_dict)
+        Params:
+            file_name (str) : path + prefix the part was written with, or a pickle file
+            mmap     (bool) : memory-map the arrays instead of reading them into memory
+
+        Returns:
+            csr_matrix | csc_matrix | arr : the part of the index
+    """
+    if file_name.endswith(".pickle"):
+        return read_pickle_file(file_name)
 
-def _create_one_hot_mini_dictionaries(logs):
+    data = _read_part_files(file_name, mmap)
+    manifest = _read_segment_manifest(file_name)
+    if manifest is None:
+        return data
+
+    row_ids = np.unique(np.concatenate([np.load("{}_segment_{}_row_ids.npy".format(file_name, segment))
+                                        for segment in range(manifest["segments"])]))
+
+    return replace_index_rows(data, row_ids, _gather_rows(file_name, manifest, row_ids), manifest["shape"])
+
+def read_index(output_dir=DEFAULT_DIR, mmap=True):
     """
-        Function called by pool workers to parralelize the process of creating two one hot dictionaries from
-        the expected log file format. The two dictionaries are the user-entity dictionary and the entity-user
-        dictionary, and are of following format:
-        
-        user-entity dict:
-            key - user_id
-            value - dict :
-                           key - entity_id
-                           value - 1
+        Reads the three data structures that make up danny's index from the default locations in output_dir,
+        which is useful when working with user_functions
+
+        Params:
+            output_dir (str) : directory the index was written to
+            mmap      (bool) : memory-map the arrays instead of reading them into memory
 
-        entity-user dict:
-            key - entity_id
-            value - dict :
-                           key - user_id
-                           value - 1
+        Returns:
+            tup : (user_entity_dict, entity_user_dict, user_entity_matrix)
+    """
+    return (read_index_file(output_dir + "user_entity_dict", mmap),
+            read_index_file(output_dir + "entity_user_dict", mmap),
+            read_index_file(output_dir + "user_entity_matrix", mmap))
 
-        The original log file is split into mulitple parts, each for a pool worker to consume, create their
-        version of these dictionaries that will then be merged at the end to create the comprehensive
-        dictionaries
+def read_index_meta(output_dir=DEFAULT_DIR):
+    """
+        Reads the metadata danny keeps next to its index in output_dir/index_meta.pickle:
+            version   : bumped every time the dictionaries are built or updated, anything derived from the
+                        index (saved neighbors, cached results) can compare it to know if it is stale
+            one_hot   : whether the dictionaries hold one hot encodings or counts
+            hub_stats : summary of the entity degrees (see entity_hub_stats), to pick a hub policy with
+                        (see candidate_pruning.resolve_hub_policy), not written by older versions of danny
 
         Params:
-            logs (arr) : array of strings of the following format: user_id, entity_id
+            output_dir (str) : directory the index was written to
 
         Returns:
-            tup : user_entity_dict, entity_user_dict
+            dict : the metadata, {"version": 0, "one_hot": False} if none was written yet
     """
+    meta_file_name = output_dir + "index_meta.pickle"
+    if not os.path.exists(meta_file_name):
+        return {"version": 0, "one_hot": False}
 
-    user_entity_dict = {}
-    entity_user_dict = {}
+    return read_pickle_file(meta_file_name)
 
-    for line in logs:
-        parts = line.rstrip().split(",")
-        user_id = int(parts[0])
-        entity_id = int(parts[1])
+def bump_index_version(one_hot, output_dir=DEFAULT_DIR, hub_stats=None):
+    """
+        Writes the index metadata (see read_index_meta) for a newly built or updated index
+
+        Params:
+            one_hot     (bool) : whether the dictionaries hold one hot encodings or counts
+            output_dir   (str) : directory the index was written to
+            hub_stats   (dict) : summary of the entity degrees returned by entity_hub_stats
 
-        if user_id not in user_entity_dict:
-            user_entity_dict[user_id] = {}
+        Returns:
+            int : the new index version
+    """
+    version = read_index_meta(output_dir)["version"] + 1
+    write_pickle_file({"version": version, "one_hot": one_hot, "hub_stats": hub_stats},
+                      output_dir + "index_meta.pickle")
 
-        if entity_id not in user_entity_dict[user_id]:
-            user_entity_dict[user_id][entity_id] = 1
+    return version
 
-        if entity_id not in entity_user_dict:
-            entity_user_dict[entity_id] = {}
+def entity_hub_stats(entity_degrees):
+    """
+        Summarizes how the users are spread over the entities, to spot hub entities (visited by most users)
+        before they make pruning quadratic. Pruning a user walks the postings of every entity they visited,
+        so over all users an entity of degree d costs d * d, and work_share tells how much of that the
+        entities above each percentile account for.
 
-        if user_id not in entity_user_dict[entity_id]:
-            entity_user_dict[entity_id][user_id] = 1
+        Params:
+            entity_degrees (arr) : number of users per entity
 
-    return (user_entity_dict, entity_user_dict)
+        Returns:
+            dict : n_entities, max_degree, mean_degree, degree_percentiles (percentile -> degree, for every
+                   percentile in HUB_PERCENTILES) and work_share (percentile -> share of the pruning work
+                   spent on entities with a larger degree)
+    """
+    entity_degrees = np.asarray(entity_degrees, dtype=np.int64)
+    if len(entity_degrees) == 0:
+        return {"n_entities": 0, "max_degree": 0, "mean_degree": 0.0, "degree_percentiles": {},
+                "work_share": {}}
+
+    work = entity_degrees ** 2
+    total_work = max(work.sum(), 1)
+    degree_percentiles = {}
+    work_share = {}
+    for percentile in HUB_PERCENTILES:
+        degree = int(np.percentile(entity_degrees, percentile))
+        degree_percentiles[percentile] = degree
+        work_share[percentile] = float(work[entity_degrees > degree].sum() / total_work)
+
+    return {"n_entities": len(entity_degrees),
+            "max_degree": int(entity_degrees.max()),
+            "mean_degree": float(entity_degrees.mean()),
+            "degree_percentiles": degree_percentiles,
+            "work_share": work_share}
+
+def _format_log_block(user_ids, entity_ids):
+    """
+        Formats edges as csv log lines (user_id,entity_id\n) without creating a Python object per line. Every
+        id is written out as a row of digits in a uint8 array, right aligned, and the unused leading columns
+        are masked out.
+
+        Params:
+            user_ids   (arr) : non negative user_ids
+            entity_ids (arr) : non negative entity_ids, same length as user_ids
 
-def _combine_count_mini_dictionaries(mini_dicionaries):
+        Returns:
+            bytes : the log lines
+    """
+    columns = []
+    keep = []
+    for ids, separator in ((user_ids, ord(",")), (entity_ids, ord("\n"))):
+        ids = np.asarray(ids, dtype=np.int64)
+        n_digits = np.maximum(np.searchsorted(POWERS_OF_TEN, ids, side="right"), 1)
+        width = int(n_digits.max()) if len(ids) > 0 else 1
+        digits = np.empty((len(ids), width + 1), dtype=np.uint8)
+        for power in range(width):
+            digits[:, width - 1 - power] = ord("0") + (ids // POWERS_OF_TEN[power]) % 10
+        digits[:, width] = separator
+
+        columns.append(digits)
+        keep.append(np.arange(width + 1) >= (width - n_digits)[:, None])
+
+    return np.hstack(columns)[np.hstack(keep)].tobytes()
+
+def _first_appearances(ids):
     """
-        Combines the partially completed count dictionaries created by the pool workers in order to have
-        two comprehensive dictionaries, the user_entity_dict and entity_user_dict.
+        Finds the distinct ids of an array and where each first appears
 
         Params:
-            mini_dicionaries (arr) : each element is a tuple containing:
-                                     (user_entity_mini_dict, entity_user_mini_dict)
+            ids (arr) : ids in log order
 
         Returns:
-            tup : comprehensive_user_entity_dict, comprehensive_entity_user_dict
+            tup : (sorted array of distinct ids, array of the position of their first appearance)
     """
-    user_entity_dict = {}
-    entity_user_dict = {}
+    return np.unique(ids, return_index=True)
 
-    for pair in mini_dicionaries:
-        user_mini_dict = pair[0]
-        entity_mini_dict = pair[1]
-        
-        for user in user_mini_dict:
-            if user not in user_entity_dict:
-                user_entity_dict[user] = {}
+def _scan_log_range(args):
+    """
+        First pass of reindex_log_file, called by pool workers. Reads the edges of one range of the log file,
+        stores them in <parts_dir>/edges_<range number>.npy so the log is only parsed once, and finds the
+        distinct user_ids and entity_ids of the range with where they first appear.
 
-            for entity in user_mini_dict[user]:
-                if entity in user_entity_dict[user]:
-                    user_entity_dict[user][entity] += user_mini_dict[user][entity]
-                else:
-                    user_entity_dict[user][entity] = user_mini_dict[user][entity]
+        Params:
+            args (tup) : (log_range, range number, parts_dir), see split_log_ranges for log_range
 
-        for entity in entity_mini_dict:
-            if entity not in entity_user_dict:
-                entity_user_dict[entity] = {}
+        Returns:
+            tup : (user first appearances, entity first appearances), see _first_appearances
+    """
+    log_range, range_number, parts_dir = args
+    user_ids, entity_ids, counts = read_log_edges(log_range)
+    columns = (user_ids, entity_ids) if counts is None else (user_ids, entity_ids, counts)
+    np.save(os.path.join(parts_dir, "edges_{}.npy".format(range_number)), np.column_stack(columns))
 
-            for user in entity_mini_dict[entity]:
-                if user in entity_user_dict[entity]:
-                    entity_user_dict[entity][user] += entity_mini_dict[entity][user]
-                else:
-                    entity_user_dict[entity][user] = entity_mini_dict[entity][user]
+    return (_first_appearances(user_ids), _first_appearances(entity_ids))
+
+def _merge_first_appearances(range_appearances):
+    """
+        Merges the first appearances found per range into one index. New ids are handed out in the order the
+        old ids first appear in the log, which is the order of the ranges and then the order within a range.
 
-    return(user_entity_dict, entity_user_dict)
+        Params:
+            range_appearances (arr) : first appearances per range, in range order, see _first_appearances
 
-def _combine_one_hot_mini_dictionaries(mini_dicionaries):
+        Returns:
+            tup : (reverse index -- element i is the old id of new id i, sorted old ids, new ids of the sorted
+                  old ids)
     """
-        Combines the partially completed one hot dictionaries created by the pool workers in order to have
-        two comprehensive dictionaries, the user_entity_dict and entity_user_dict.
+    ids = np.concatenate([unique_ids for unique_ids, _ in range_appearances])
+    ranges = np.repeat(np.arange(len(range_appearances)), [len(unique_ids) for unique_ids, _ in
+                                                           range_appearances])
+    positions = np.concatenate([first_positions for _, first_positions in range_appearances])
+
+    unique_ids, first = np.unique(ids[np.lexsort((positions, ranges))], return_index=True)
+    appearance_order = np.argsort(first)
+    reversed_index = unique_ids[appearance_order]
+    new_ids = np.empty(len(unique_ids), dtype=np.int64)
+    new_ids[appearance_order] = np.arange(len(unique_ids))
+
+    return (reversed_index, unique_ids, new_ids)
+
+def old_to_new_ids(reversed_index, old_ids):
+    """
+        Maps old ids to the new ids handed out by reindex_log_file, using the reverse index it saved
 
         Params:
-            mini_dicionaries (arr) : each element is a tuple containing:
-                                     (user_entity_mini_dict, entity_user_mini_dict)
+            reversed_index (arr) : element i is the old id of new id i, e.g. user_reverse_index.npy
+            old_ids        (arr) : old ids to map, all of which must be in the index
 
         Returns:
-            tup : comprehensive_user_entity_dict, comprehensive_entity_user_dict
-    """
-    user_entity_dict = {}
-    entity_user_dict = {}
-    for pair in mini_dicionaries:
-        user_mini_dict = pair[0]
-        entity_mini_dict = pair[1]
-        
-        for user in user_mini_dict:
-            if user not in user_entity_dict:
-                user_entity_dict[user] = {}
-
-            for entity in user_mini_dict[user]:
-                if entity not in user_entity_dict[user]:
-                    user_entity_dict[user][entity] = 1
-
-        for entity in entity_mini_dict:
-            if entity not in entity_user_dict:
-                entity_user_dict[entity] = {}
-            
-            for user in entity_mini_dict[entity]:
-                if user not in entity_user_dict[entity]:
-                    entity_user_dict[entity][user] = 1
+            arr : the new ids
+    """
+    order = np.argsort(reversed_index)
+    positions = np.searchsorted(reversed_index, old_ids, sorter=order)
+    positions = np.minimum(positions, len(order) - 1)
+    new_ids = order[positions]
+    if not np.array_equal(reversed_index[new_ids], old_ids):
+        raise ValueError("some of the old ids passed in are not in the index")
 
-    return (user_entity_dict, entity_user_dict)
+    return new_ids
 
-def create_dictionaries(raw_log_file, one_hot=False, n_processes=None, save=True,
-                        output_dir=DEFAULT_DIR):
+def _reindex_log_range(args):
+    """
+        Second pass of reindex_log_file, called by pool workers. Maps the edges of one range (stored by
+        _scan_log_range) to the new ids, with a binary search in the sorted old ids, and writes them out to
+        <parts_dir>/converted_<range number>.npy or .csv. The lookup arrays are memory-mapped from parts_dir.
+
+        Params:
+            args (tup) : (range number, parts_dir, as_csv)
+
+        Returns:
+            int : number of edges reindexed
+    """
+    range_number, parts_dir, as_csv = args
+    edges = np.load(os.path.join(parts_dir, "edges_{}.npy".format(range_number)))
+    for column, index_type in ((0, "user"), (1, "entity")):
+        sorted_ids = np.load(os.path.join(parts_dir, index_type + "_sorted_ids.npy"), mmap_mode="r")
+        new_ids = np.load(os.path.join(parts_dir, index_type + "_new_ids.npy"), mmap_mode="r")
+        edges[:, column] = new_ids[np.searchsorted(sorted_ids, edges[:, column])]
+
+    if as_csv:
+        with open(os.path.join(parts_dir, "converted_{}.csv".format(range_number)), "wb") as f:
+            f.write(_format_log_block(edges[:, 0], edges[:, 1]))
+    else:
+        np.save(os.path.join(parts_dir, "converted_{}.npy".format(range_number)), edges)
+
+    return edges.shape[0]
+
+def reindex_log_file(raw_log_file, save=True, output_dir=DEFAULT_DIR, n_processes=None):
+    """
+        Function reads a log file of the expected format of: user_id, entity_id and reindexes users and
+        entities to ensure that user_ids and entity_ids start from zero and are consecutive. New ids are
+        handed out in the order the old ids first appear in the log. The result of the conversion and the
+        mapping between the new indicies and the old ones can either be returned or written out. The log file
+        will be writeen out in the expected log format (or as a binary edge log named converted_logs.npy if a
+        binary edge log was passed in, see edge_log), while the mappings will be written out as .npy
+        arrays, user_reverse_index.npy and entity_reverse_index.npy, where element i is the old id of new id i
+        (see old_to_new_ids for the other direction).
+
+        The log is never held in memory as a whole. It is split into ranges (see split_log_ranges) and
+        processed in two parallel passes: the first parses each range and finds its distinct ids, which are
+        merged into the global mappings, the second maps each range to the new ids with array lookups and
+        writes it out.
+        The converted ranges are then streamed into the output file in order.
+
+        In order to preserve links between a user and their entity visitation pattern, or an entity and its
+        user visitation pattern, user and entity ids must start at 0 and be consecutive. For more on this you
+        can read the readme.
+
+        Params:
+            raw_log_file (str) : name of log file to reindex, a csv or a binary edge log (.npy)
+            save        (bool) : boolean to indicate whether to save the results of reindexing
+            output_dir   (str) : directory to write out to
+            n_processes  (int) : number of processes to use, if left None, danny will use 2 less than the
+                                 number of cores available on your machine
+
+        Returns:
+            tup | bool : if the results are not to be saved the function returns:
+                         (array of reindexed edges, user reverse index, entity reverse index), each row of
+                         the edges is user_id, entity_id (and count for binary edge logs with counts)
+                         else it returns True to indicate the results were saved
     """
-        Chunks the raw logs (user_id, entity_id) into units of 500000 lines, sets up a pool of workers, and
-        distributes the work of building larger count or one hot dictionaries of the following forms:
+    #pylint: disable=too-many-locals
+    n_processes = MAX_PROCESSES - 2 if n_processes is None else n_processes
+    as_csv = save and not is_edge_log(raw_log_file)
+    start_time = time.time()
+    log_ranges = split_log_ranges(raw_log_file, n_processes)
+    pool = Pool(processes=n_processes)
 
-        user-entity dict:
-            key - user_id
-            value - dict :
-                           key - entity_id
-                           value - count or 1
+    with tempfile.TemporaryDirectory(dir=output_dir if save else None) as parts_dir:
+        range_appearances = pool.map(_scan_log_range, [(log_range, i, parts_dir)
+                                                       for i, log_range in enumerate(log_ranges)])
+        logging.info("read in logs in %s seconds", time.time() - start_time)
+        start_time = time.time()
 
-        entity-user dict:
-            key - entity_id
-            value - dict :
-                           key - user_id
-                           value - count or 1
+        reversed_indices = []
+        for position, index_type in enumerate(["user", "entity"]):
+            reversed_index, sorted_ids, new_ids = _merge_first_appearances([appearances[position] for
+                                                                            appearances in range_appearances])
+            np.save(os.path.join(parts_dir, index_type + "_sorted_ids.npy"), sorted_ids)
+            np.save(os.path.join(parts_dir, index_type + "_new_ids.npy"), new_ids)
+            reversed_indices.append(reversed_index)
 
-        Each worker creates their own version of these dictionaries, which then get merged into one large
-        comprehensive dictionary, which can then be saved or returned to the user.
+        del range_appearances
+        logging.info("built mappings in %s seconds", time.time() - start_time)
+        start_time = time.time()
+
+        n_edges = pool.map(_reindex_log_range, [(i, parts_dir, as_csv) for i in range(len(log_ranges))])
+        pool.close()
+        pool.join()
+        logging.info("converted logs in %s seconds", time.time() - start_time)
+        start_time = time.time()
+
+        if not save:
+            new_logs = np.concatenate([np.load(os.path.join(parts_dir, "converted_{}.npy".format(i)))
+                                       for i in range(len(log_ranges))])
+            return (new_logs, reversed_indices[0], reversed_indices[1])
+
+        if as_csv:
+            with open(output_dir + "converted_logs.csv", "wb") as converted_logs:
+                for i in range(len(log_ranges)):
+                    with open(os.path.join(parts_dir, "converted_{}.csv".format(i)), "rb") as part:
+                        shutil.copyfileobj(part, converted_logs)
+        else:
+            edge_log = read_edge_log(raw_log_file)
+            converted_logs = np.lib.format.open_memmap(output_dir + "converted_logs.npy", mode="w+",
+                                                       dtype=edge_log.dtype,
+                                                       shape=(sum(n_edges), edge_log.shape[1]))
+            position = 0
+            for i, n_range_edges in enumerate(n_edges):
+                converted_logs[position:position + n_range_edges] = \
+                    np.load(os.path.join(parts_dir, "converted_{}.npy".format(i)))
+                position += n_range_edges
+
+            converted_logs.flush()
+            del converted_logs
+
+    logging.info("wrote out converted logs in %s seconds", time.time() - start_time)
+    start_time = time.time()
+
+    for index_type, reversed_index in zip(["user", "entity"], reversed_indices):
+        dtype = np.int32 if len(reversed_index) == 0 or reversed_index.max() <= np.iinfo(np.int32).max \
+                else np.int64
+        np.save(output_dir + index_type + "_reverse_index.npy", reversed_index.astype(dtype))
+
+    logging.info("wrote out mappings in %s seconds", time.time() - start_time)
+
+    return True
+
+def reverse_index(input_type, data_source, index_type=None, save=True, output_dir=DEFAULT_DIR):
+    """
+        Function swithces around key value pairs of a dictionary to allow for both forward and backward
+        switching between new and old indicies for users and entities.
+
+        When inspecting the results of the nearest neighbors it is useful to have the reverse index to see
+        which original user_ids are close to each other. reindex_log_file already writes its reverse indicies
+        out as arrays, this function is for index dictionaries pickled by older versions of danny.
+
+        Params:
+            input_type  (str) : indicates whether a file or dict is being passed into the function
+            data_source (str) : the source of data, so either the file or dict
+            index_type  (str) : indicating what type of index is being saved, i.e. user_index
+                                can be left None if output is not being saved
+            save       (bool) : whether to save the output of the function
+            output_dir  (str) : directory to write out to
+
+        Returns:
+            tup | bool : if the results are not to be saved the function returns the reversed_index
+                         else it returns True to indicate the results were saved
+    """
+    input_types = ["file", "dict"]
+    if input_type not in input_types:
+        raise ValueError("input_type must be one of \"file\" or \"dict\"")
+
+    if input_type == "file" and not isinstance(data_source, str):
+        raise ValueError("data_source must indicated the pickle file you would like to be read in to \
+            to reverse your index")
+
+    if input_type == "dict" and not isinstance(data_source, dict):
+        raise ValueError("data_source must be the needed dictionary/index")
+
+    if save and index_type is None:
+        raise ValueError("index_type cannot be null if the reveresed index is going to be saved. Common \
+            options are: entity, user, site, song, video")
+
+    reversed_index = {}
+
+    if input_type == "file":
+        index = read_pickle_file(data_source)
+    else:
+        index = data_source
+
+    for key in index:
+        reversed_index[index[key]] = key
+
+    if save:
+        reversed_index_file_name = output_dir + index_type + "_reverse_index.pickle"
+        write_pickle_file(reversed_index, reversed_index_file_name)
+
+        del reversed_index
+        return True
+
+    return reversed_index
+
+def create_dictionaries(raw_log_file, one_hot=False, n_processes=None, save=True,
+                        output_dir=DEFAULT_DIR):
+    """
+        Splits the raw logs (user_id, entity_id) into byte ranges, sets up a pool of workers, and distributes
+        the work of building larger count or one hot dictionaries of the following forms:
+
+        user-entity dict (CSR matrix, rows - users, columns - entities):
+            user_entity_dict.indices[indptr[user_id]:indptr[user_id + 1]] - entity_ids visited by user_id
+            user_entity_dict.data[indptr[user_id]:indptr[user_id + 1]]    - count or 1
+
+        entity-user dict (CSC matrix, rows - users, columns - entities):
+            entity_user_dict.indices[indptr[entity_id]:indptr[entity_id + 1]] - user_ids who visited entity_id
+            entity_user_dict.data[indptr[entity_id]:indptr[entity_id + 1]]    - count or 1
+
+        The parent never reads the logs, each worker is only handed the byte offsets of its range and reads
+        and parses that slice of the file itself (see edge_log._read_log_range), so reading the logs scales
+        with the number of processes rather than being serial. Parsing is vectorized with numpy (see
+        edge_log._parse_log_block), no Python object is created per log line. Binary edge logs (see edge_log)
+        skip parsing altogether, each worker memory-maps its rows of the edge log.
+
+        Nothing is merged in the parent. Each worker spills the edges of its range partitioned by
+        user_id % n_processes and by entity_id % n_processes, and then each partition is owned by exactly one
+        worker, which builds the rows (users for the user-entity side, entities for the entity-user side) of
+        that partition. The parent only scatters the finished rows into int32 arrays. Both can then be saved
+        or returned to the user.
+        When saved, the number of entities per user (user_degrees) and users per entity (entity_degrees) are
+        written out next to the dictionaries, all as .npy arrays (see write_index_file), and a summary of the
+        entity degrees (see entity_hub_stats) is kept in the index meta.
 
         Note : for usage in danny, the users and entities in the raw log file must be indexed by consecutive
                numbers starting for zero.
 
         Params:
-            raw_log_file (str) : name of log file to build dictionaries out of
+            raw_log_file (str) : name of log file to build dictionaries out of, a csv or a binary edge log
+                                 (.npy)
             one_hot     (bool) : a 1 insted of the true count will be used when building the dictionary
                                  use this if you want the resulting user-entity matrix to be one hot encoded
             n_processes  (int) : number of processes danny should use when extracting possible
@@ -418,74 +839,76 @@ def create_dictionaries(raw_log_file, one_hot=False, n_processes=None, save=True
     """
     # pylint: disable=too-many-arguments, too-many-locals
     n_processes = MAX_PROCESSES - 2 if n_processes is None else n_processes
-    chunked_logs = []
-    start_time = time.time()
-    with open(raw_log_file) as logs:
-        i = 0
-        chunk = []
-        for line in logs:
-            if i < MAX_LOG_CHUNK:
-                chunk.append(line)
-                i += 1
-            else:
-                chunked_logs.append(chunk)
-                chunk = [line]
-                i = 1
-
-        chunked_logs.append(chunk)
-
-    logging.info("read in logs in %s seconds", time.time() - start_time)
     start_time = time.time()
+    log_ranges = split_log_ranges(raw_log_file, n_processes)
     pool = Pool(processes=n_processes)
 
-    mini_dicionaries = pool.map(_create_one_hot_mini_dictionaries, chunked_logs) if one_hot \
-                       else pool.map(_create_count_mini_dictionaries, chunked_logs)
+    with tempfile.TemporaryDirectory(dir=output_dir if save else None) as spill_dir:
+        pool.map(partition_log_range, [(log_range, i, one_hot, n_processes, spill_dir)
+                                        for i, log_range in enumerate(log_ranges)])
+        logging.info("read in logs and partitioned %s ranges in %s seconds", len(log_ranges),
+                     time.time() - start_time)
+        start_time = time.time()
+
+        user_partitions = pool.map(build_partition, [("user", partition, len(log_ranges), one_hot, spill_dir)
+                                                      for partition in range(n_processes)])
+        entity_partitions = pool.map(build_partition, [("entity", partition, len(log_ranges), one_hot,
+                                                         spill_dir) for partition in range(n_processes)])
 
     pool.close()
     pool.join()
 
-    logging.info("mini dictionaries created in %s seconds", time.time() - start_time)
+    logging.info("partitions built in %s seconds", time.time() - start_time)
     start_time = time.time()
-   
-    if one_hot:
-        combined_dicts = _combine_one_hot_mini_dictionaries(mini_dicionaries)
-    else:
-        combined_dicts = _combine_count_mini_dictionaries(mini_dicionaries)
-
-    logging.info("mini dictionaries combined in %s seconds", time.time() - start_time)
 
-    if save:
-        user_entity_dict_file_name = output_dir + "user_entity_dict.pickle"
-        entity_user_dict_file_name = output_dir + "entity_user_dict.pickle"
+    n_users = max([row_ids[-1] + 1 for row_ids, _, _, _ in user_partitions if len(row_ids) > 0], default=0)
+    n_entities = max([row_ids[-1] + 1 for row_ids, _, _, _ in entity_partitions if len(row_ids) > 0],
+                     default=0)
+    user_entity_dict = csr_matrix(stitch_partitions(user_partitions, n_users), shape=(n_users, n_entities))
+    del user_partitions
+    entity_user_dict = csc_matrix(stitch_partitions(entity_partitions, n_entities),
+                                  shape=(n_users, n_entities))
+    del entity_partitions
 
-        write_pickle_file(combined_dicts[0], user_entity_dict_file_name)
-        write_pickle_file(combined_dicts[1], entity_user_dict_file_name)
+    logging.info("dictionaries packed into CSR/CSC arrays in %s seconds", time.time() - start_time)
 
-        del combined_dicts
+    if save:
+        write_index_file(user_entity_dict, output_dir + "user_entity_dict")
+        write_index_file(entity_user_dict, output_dir + "entity_user_dict")
+        write_index_file(np.diff(user_entity_dict.indptr).astype(np.int32), output_dir + "user_degrees")
+        entity_degrees = np.diff(entity_user_dict.indptr).astype(np.int32)
+        write_index_file(entity_degrees, output_dir + "entity_degrees")
+        hub_stats = entity_hub_stats(entity_degrees)
+        logging.info("entity degrees: %s", hub_stats)
+        bump_index_version(one_hot, output_dir, hub_stats)
+
+        del user_entity_dict
+        del entity_user_dict
         return True
 
-    return combined_dicts
+    return (user_entity_dict, entity_user_dict)
 
 
 def create_matrix(input_type="default", data_source=None, sparse=True, save=True, output_dir=DEFAULT_DIR):
     """
-        Creates either a one_hot or count matrix, encoding the users' entity visitation patterns in the rows, 
+        Creates either a one_hot or count matrix, encoding the users' entity visitation patterns in the rows,
         and each entities' user visitation history in the columns. Takes in a the user_entity_dict and
-        creates the needed matrix via sklearn's DictVectorizer function. The matrix can either be sparse or
-        dense, with the default being sparse.
+        row normalizes its counts directly, as the CSR arrays already are the needed count matrix. The matrix
+        can either be sparse or dense, with the default being sparse.
 
         As stated, the function expects the user_entity_dict outputted by create_dictionaries (or data of a
         similar format) to be passed in. This dictionary can either be passed in, read in from a passed in
         file or in the "default" case danny will know where to find the file.
 
         Params:
-            input_type            (str) : how the user_entity_dict is being passed in
-            data_source (str|dict|None) : a file name, the user_entity_dict or None in which case danyy will
-                                          read in the user_entity_dict from the default location
-            sparse               (bool) : whether the user_entity_matrix should be sparse or not, default is
-                                          sparse
-            save                 (bool) : whether to save the output or not
-            output_dir            (str) : the directory to write the nearest neighbors per each user to
+            input_type                  (str) : how the user_entity_dict is being passed in
+            data_source (str|csr_matrix|None) : an index file name (see read_index_file), the
+                                                user_entity_dict or None in which case danny will read in
+                                                the user_entity_dict from output_dir
+            sparse                     (bool) : whether the user_entity_matrix should be sparse or not,
+                                                default is sparse
+            save                       (bool) : whether to save the output or not
+            output_dir                  (str) : the directory to write the nearest neighbors per each user to
 
         Returns:
             tup | bool : if the results are not to be saved the function returns the user_entity_matrix
@@ -498,37 +921,29 @@ def create_matrix(input_type="default", data_source=None, sparse=True, save=True
         raise ValueError("input_type must be one of \"default\", \"file\" or \"dict\"")
 
     if input_type == "file" and not isinstance(data_source, str):
-        raise ValueError("data_source must indicated the pickle file you would like to be read in to\
+        raise ValueError("data_source must indicated the index file you would like to be read in to\
             to create the user_entity matrix")
 
-    if input_type == "dict" and not isinstance(data_source, dict):
-        raise ValueError("data_source must be the needed dictionary to create the user_entity matrix")
+    if input_type == "dict" and not issparse(data_source):
+        raise ValueError("data_source must be the needed user_entity_dict (CSR matrix) to create the \
+            user_entity matrix")
 
     if input_type in ["file", "default"]:
-        file_name = data_source if input_type == "file" else DEFAULT_DIR + "user_entity_dict.pickle"
-        data_source = read_pickle_file(file_name)
-        logging.info("read in needed pickle files in %s seconds", time.time() - start_time)
+        file_name = data_source if input_type == "file" else output_dir + "user_entity_dict"
+        data_source = read_index_file(file_name)
+        logging.info("read in needed index files in %s seconds", time.time() - start_time)
 
     start_time = time.time()
-    user_dicts = sorted(data_source.items(), key=itemgetter(0))
-    user_dicts = [tup[1] for tup in user_dicts]
-   
-    logging.info("prepped user info for matrix creation %s seconds", time.time() - start_time)
-    start_time = time.time()
-
-    vectorizer = DictVectorizer(sparse=sparse)
-    user_entity_matrix = vectorizer.fit_transform(user_dicts)
-    logging.info("matrix is created in %s seconds", time.time() - start_time)
-    start_time = time.time()
+    user_entity_matrix = normalize(data_source.tocsr().astype(np.float64))
+    logging.info("matrix is created and row normalized in %s seconds", time.time() - start_time)
 
-    user_entity_matrix = normalize(user_entity_matrix)
-    logging.info("matrix is row normalized in %s seconds", time.time() - start_time)
+    if not sparse:
+        user_entity_matrix = user_entity_matrix.toarray()
 
     if save:
-        user_entity_matrix_file_name = output_dir + "user_entity_matrix.pickle"
-        write_pickle_file(user_entity_matrix, user_entity_matrix_file_name)
+        write_index_file(user_entity_matrix, output_dir + "user_entity_matrix")
 
         del user_entity_matrix
         return True
-   
+
     return user_entity_matrix
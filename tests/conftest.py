@@ -0,0 +1,101 @@
+"""
+    Makes danny's flat modules importable from the tests, and builds the small logs they run on
+"""
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def write_log(file_name, edges):
+    """
+        Writes (user_id, entity_id) edges out as a csv log file
+
+        Params:
+            file_name (str) : name of the log file
+            edges     (arr) : array of shape (number of edges, 2)
+    """
+    with open(file_name, "w", encoding="utf-8") as log_file:
+        log_file.write("".join("{},{}\n".format(user_id, entity_id) for user_id, entity_id in edges))
+
+def random_edges(n_users, n_entities, n_edges, seed):
+    """
+        Draws edges covering every user and entity id at least once, so the ids need no reindexing
+
+        Returns:
+            arr : array of shape (n_edges, 2)
+    """
+    rng = np.random.RandomState(seed)
+    edges = np.column_stack([rng.randint(0, n_users, n_edges), rng.randint(0, n_entities, n_edges)])
+    edges[:n_users, 0] = np.arange(n_users)
+    edges[:n_entities, 1] = np.arange(n_entities)
+
+    return edges
+
+def assert_same_index(index, expected):
+    """
+        Asserts two indexes, each a tuple of sparse matrices, hold the same values
+    """
+    for matrix, expected_matrix in zip(index, expected):
+        assert matrix.shape == expected_matrix.shape
+        assert abs(matrix - expected_matrix).max() < 1e-6 if matrix.nnz else expected_matrix.nnz == 0
+
+@pytest.fixture
+def index_dir(tmp_path, monkeypatch):
+    """
+        Builds an index for a 60 user, 25 entity log in a temporary directory
+
+        Returns:
+            str : the index directory, with a trailing slash like danny's output_dir
+    """
+    # pylint: disable=import-outside-toplevel
+    import dictionary_based_nn
+    from supporting_functions import create_dictionaries, create_matrix
+
+    monkeypatch.setattr(dictionary_based_nn, "MAX_PROCESSES", 4)
+    output_dir = str(tmp_path) + "/index/"
+    os.makedirs(output_dir)
+    write_log(str(tmp_path) + "/log.csv", random_edges(60, 25, 400, seed=0))
+    create_dictionaries(str(tmp_path) + "/log.csv", n_processes=2, output_dir=output_dir)
+    create_matrix(output_dir=output_dir)
+
+    return output_dir
+
+def brute_force_neighbors(output_dir, top_k=None, thresh=0.0):
+    """
+        Every user's neighbors from the cosine similarity of all pairs of users, computed densely from the
+        user_entity_dict in output_dir
+
+        Params:
+            output_dir  (str) : the index directory
+            top_k  (int|None) : number of most similar users kept per user, ties by user_id
+            thresh    (float) : only users more similar than thresh (before rounding) are kept
+
+        Returns:
+            dict : key - user_id | value - dict -- key - user_id, value: similarity rounded to 4 decimals
+    """
+    from supporting_functions import read_index  # pylint: disable=import-outside-toplevel
+
+    counts = read_index(output_dir)[0].toarray().astype(np.float64)
+    vectors = counts / np.linalg.norm(counts, axis=1, keepdims=True)
+    similarities = vectors @ vectors.T
+    neighbors = {}
+    for user_id, row in enumerate(similarities):
+        kept = np.flatnonzero(row > thresh)
+        rounded = np.round(row[kept], 4)
+        order = np.lexsort((kept, -rounded))[:top_k]
+        neighbors[user_id] = dict(zip(kept[order].tolist(), rounded[order].tolist()))
+
+    return neighbors
+
+def assert_top_k(found, expected, top_k):
+    """
+        Asserts every user's neighbors in found are their top_k neighbors in expected, as returned by
+        brute_force_neighbors. Any of the users tied at the last kept similarity can make the cut.
+    """
+    assert found.keys() == expected.keys()
+    for user_id, neighbors in found.items():
+        assert all(expected[user_id][neighbor_id] == score for neighbor_id, score in neighbors.items())
+        assert sorted(neighbors.values(), reverse=True) == \
+               sorted(expected[user_id].values(), reverse=True)[:top_k]
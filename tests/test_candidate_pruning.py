@@ -0,0 +1,145 @@
+"""
+    Checks pruning against the dictionary based implementation it replaced, and the hub policies on a log
+    with a hub entity
+"""
+# pylint: disable=missing-function-docstring, invalid-name, redefined-outer-name
+import numpy as np
+import pytest
+from conftest import random_edges, write_log
+import dictionary_based_nn
+from candidate_pruning import _gather_postings, approx_prune_space, describe_hub_policy, resolve_hub_policy
+from candidate_pruning import strict_prune_space
+from dictionary_based_nn import prune_space_batch
+from supporting_functions import create_dictionaries
+
+SUM_SIGNIFICANCE = 10
+
+def _baseline_dictionaries(edges):
+    """
+        Builds the dict of dicts the baseline kept, a user's entities in the order they first show up in
+        the log
+    """
+    user_entity_dict = {}
+    entity_user_dict = {}
+    for user_id, entity_id in edges.tolist():
+        entities = user_entity_dict.setdefault(user_id, {})
+        if entity_id not in entities:
+            entity_user_dict.setdefault(entity_id, []).append(user_id)
+        entities[entity_id] = entities.get(entity_id, 0) + 1
+
+    return (user_entity_dict, entity_user_dict)
+
+def _baseline_approx_candidates(user_id, user_entity_dict, entity_user_dict, user_cap):
+    """
+        The baseline's _approx_prune_space followed by the cut off of its _get_top_n_users_batch (no tie is
+        ever wide enough here to be sampled). The baseline's sums depend on the order of the log, so they are
+        rounded to float32 before the cut off, like danny's
+    """
+    users_to_look_at = {}
+    user_sum = sum(user_entity_dict[user_id].values())
+    user_length = len(user_entity_dict[user_id])
+    for entity, count in user_entity_dict[user_id].items():
+        for key in entity_user_dict[entity]:
+            if user_sum > SUM_SIGNIFICANCE:
+                score = count / user_sum / (abs(user_length - len(user_entity_dict[key])) + 1)
+            else:
+                score = 1
+            users_to_look_at[key] = users_to_look_at.get(key, 0) + score
+
+    scores = {key: float(np.float32(score)) for key, score in users_to_look_at.items()}
+    if len(scores) <= user_cap:
+        return set(scores)
+    cut_off_value = sorted(scores.values(), reverse=True)[user_cap - 1]
+
+    return {key for key, score in scores.items() if score >= cut_off_value}
+
+@pytest.mark.parametrize("user_cap", [3, 8])
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_approx_candidates_match_baseline(tmp_path, monkeypatch, user_cap, shuffle):
+    monkeypatch.setattr(dictionary_based_nn, "MAX_PROCESSES", 4)
+    edges = random_edges(80, 30, 1200, seed=9)
+    if shuffle:
+        edges = edges[np.random.RandomState(10).permutation(len(edges))]
+    write_log(str(tmp_path / "log.csv"), edges)
+    output_dir = str(tmp_path) + "/"
+    create_dictionaries(str(tmp_path / "log.csv"), n_processes=2, output_dir=output_dir)
+
+    candidates = prune_space_batch([output_dir + "user_entity_dict", output_dir + "entity_user_dict"],
+                                   n_processes=2, user_cap=user_cap)
+    user_entity_dict, entity_user_dict = _baseline_dictionaries(edges)
+    for user_id in range(80):
+        found = candidates.indices[candidates.indptr[user_id]:candidates.indptr[user_id + 1]]
+        assert set(found.tolist()) == _baseline_approx_candidates(user_id, user_entity_dict, entity_user_dict,
+                                                                  user_cap)
+
+HUB_EDGES = [(0, 0), (0, 1), (1, 1), (1, 2), (2, 0), (2, 2), (3, 0), (3, 2), (4, 0), (4, 3), (5, 0)]
+
+@pytest.fixture
+def hub_index(tmp_path):
+    """
+        A log where entity 0 is a hub visited by 5 of the 6 users, the other entities have degrees 2, 3 and 1
+    """
+    write_log(str(tmp_path / "log.csv"), HUB_EDGES)
+    return create_dictionaries(str(tmp_path / "log.csv"), n_processes=2, save=False)
+
+def test_resolve_hub_policy(hub_index):
+    hub_policy = resolve_hub_policy(hub_index[1], "skip", max_degree=3)
+
+    assert hub_policy == {"policy": "skip", "max_degree": 3, "percentile": None, "idf": False, "n_users": 6,
+                          "hub_entities": 1, "hub_postings": 5 / 11, "hub_work": 25 / 39}
+    assert resolve_hub_policy(hub_index[1], "sample", percentile=75)["max_degree"] == 3
+    assert resolve_hub_policy(hub_index[1]) is None
+    for policy, max_degree, percentile in (("drop", 3, None), ("skip", None, None), ("skip", 3, 75),
+                                           ("skip", 0, None), ("skip", None, 101)):
+        with pytest.raises(ValueError):
+            resolve_hub_policy(hub_index[1], policy, max_degree, percentile)
+
+@pytest.mark.parametrize("policy, users, posting_lengths", [(None, [0, 2, 3, 4, 5, 0, 1], [5, 2]),
+                                                            ("skip", [0, 1], [0, 2]),
+                                                            ("sample", [0, 3, 5, 0, 1], [3, 2])])
+def test_gather_postings_with_hub_policy(hub_index, policy, users, posting_lengths):
+    hub_policy = resolve_hub_policy(hub_index[1], policy, max_degree=3) if policy else None
+    found_users, found_lengths, counts, degrees = _gather_postings(0, *hub_index, hub_policy)
+
+    assert found_users.tolist() == users
+    assert found_lengths.tolist() == posting_lengths
+    assert counts.tolist() == [1, 1] and degrees.tolist() == [5, 2]
+
+def test_hub_policy_prunes_candidates(hub_index):
+    skip = resolve_hub_policy(hub_index[1], "skip", max_degree=3)
+    sample = resolve_hub_policy(hub_index[1], "sample", max_degree=3)
+
+    assert strict_prune_space(0, *hub_index).tolist() == [0, 1, 2, 3, 4, 5]
+    assert strict_prune_space(0, *hub_index, skip).tolist() == [0, 1]
+    assert strict_prune_space(0, *hub_index, sample).tolist() == [0, 1, 3, 5]
+    assert strict_prune_space(5, *hub_index, skip).tolist() == []
+
+def test_describe_hub_policy(hub_index):
+    assert describe_hub_policy(None) == "none, every posting is walked"
+    assert describe_hub_policy(resolve_hub_policy(hub_index[1], idf=True)) == \
+           "every posting is walked, approximate scores weighted by IDF"
+    assert describe_hub_policy(resolve_hub_policy(hub_index[1], "skip", percentile=75)) == \
+           "skip entities visited by more than 3 users (the 75th percentile of entity degrees), 1 hub " \
+           "entities holding 45.5% of the postings and 64.1% of the pruning work"
+    assert describe_hub_policy(resolve_hub_policy(hub_index[1], "sample", max_degree=3, idf=True)) == \
+           "sample 3 users of entities visited by more than 3 users, 1 hub entities holding 45.5% of the " \
+           "postings and 64.1% of the pruning work, approximate scores weighted by IDF"
+
+def test_idf_weighting(tmp_path, monkeypatch, hub_index):
+    monkeypatch.setattr(dictionary_based_nn, "MAX_PROCESSES", 4)
+    idf = resolve_hub_policy(hub_index[1], idf=True)
+    users, scores = approx_prune_space(0, *hub_index, idf)
+    hub_weight, rare_weight = np.log(7 / 6) + 1, np.log(7 / 3) + 1
+
+    assert users.tolist() == [0, 1, 2, 3, 4, 5]
+    assert scores.tolist() == [float(np.float32(weight)) for weight in
+                               (hub_weight + rare_weight, rare_weight, hub_weight, hub_weight, hub_weight,
+                                hub_weight)]
+
+    write_log(str(tmp_path / "log.csv"), HUB_EDGES)
+    output_dir = str(tmp_path) + "/"
+    create_dictionaries(str(tmp_path / "log.csv"), n_processes=2, output_dir=output_dir)
+    file_names = [output_dir + "user_entity_dict", output_dir + "entity_user_dict"]
+    for hub_policy, candidates in ((None, [0, 1, 2, 3, 4, 5]), (idf, [0, 1])):
+        found = prune_space_batch(file_names, n_processes=2, user_cap=2, hub_policy=hub_policy)
+        assert found.indices[found.indptr[0]:found.indptr[1]].tolist() == candidates
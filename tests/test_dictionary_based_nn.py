@@ -0,0 +1,88 @@
+"""
+    Checks the nearest neighbor modes against the cosine similarity of every pair of users
+"""
+# pylint: disable=missing-function-docstring, invalid-name
+import pytest
+from conftest import assert_top_k, brute_force_neighbors, write_log
+from candidate_pruning import resolve_hub_policy
+from dictionary_based_nn import get_nearest_neighbors_batch
+from index_update import update_index
+from neighbor_store import neighbor_store_to_dict, read_neighbor_store
+from supporting_functions import read_index_file, read_pickle_file
+
+def _as_dict(result_tuples):
+    return {user_id: dict(zip(neighbor_ids.tolist(), scores.tolist()))
+            for user_id, neighbor_ids, scores in result_tuples}
+
+@pytest.mark.parametrize("engine", ["rowwise", "blocked"])
+def test_exact_matches_brute_force(index_dir, engine):
+    found = get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir, save=False,
+                                        engine=engine, block_size=7)
+
+    assert found == brute_force_neighbors(index_dir)
+
+@pytest.mark.parametrize("top_k, thresh", [(5, -1.0), (None, 0.31), (3, 0.21)])
+def test_blocked_top_k_and_thresh_match_brute_force(index_dir, top_k, thresh):
+    found = get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir, save=False,
+                                        engine="blocked", block_size=7, top_k=top_k, thresh=thresh,
+                                        as_dict=False)
+
+    assert_top_k(_as_dict(found), brute_force_neighbors(index_dir, thresh=max(thresh, 0.0)), top_k)
+
+def _saved_neighbors(output_dir, output_format):
+    if output_format == "pickle":
+        return read_pickle_file(output_dir + "similarity_scores.pickle")
+
+    return neighbor_store_to_dict(read_neighbor_store(output_dir + "similarity_scores/", mmap=False))
+
+@pytest.mark.parametrize("output_format", ["pickle", "columnar"])
+def test_changed_users_patch_matches_full_run(index_dir, output_format):
+    get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir, output_format=output_format)
+    write_log(index_dir + "delta.csv", [(0, 1), (0, 2), (7, 24), (60, 3)])
+    update_index(index_dir + "delta.csv", n_processes=2, output_dir=index_dir)
+
+    get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir, output_format=output_format,
+                                changed_users=index_dir + "updated_users.npy")
+    patched = _saved_neighbors(index_dir, output_format)
+    get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir, output_format=output_format)
+
+    assert patched == _saved_neighbors(index_dir, output_format) == brute_force_neighbors(index_dir)
+
+@pytest.mark.parametrize("engine", ["rowwise", "blocked"])
+@pytest.mark.parametrize("output_format", [None, "pickle", "columnar"])
+def test_symmetric_matches_brute_force(index_dir, engine, output_format):
+    save = output_format is not None
+    found = get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir, save=save,
+                                        output_format=output_format if save else "pickle", engine=engine,
+                                        block_size=7, symmetric=True)
+
+    if save:
+        found = _saved_neighbors(index_dir, output_format)
+    assert found == brute_force_neighbors(index_dir)
+
+def test_symmetric_skipping_hubs_matches_one_sided(index_dir):
+    hub_policy = resolve_hub_policy(read_index_file(index_dir + "entity_user_dict"), "skip", percentile=80)
+    found = [get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir, save=False,
+                                         hub_policy=hub_policy, symmetric=symmetric)
+             for symmetric in (False, True)]
+
+    assert found[0] == found[1]
+    assert found[0] != brute_force_neighbors(index_dir)
+
+@pytest.mark.parametrize("engine", ["rowwise", "blocked"])
+def test_fused_matches_brute_force(index_dir, engine):
+    found = get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir, save=False,
+                                        engine=engine, block_size=7, fused=True)
+
+    assert found == brute_force_neighbors(index_dir)
+
+@pytest.mark.parametrize("engine, top_k, thresh", [("rowwise", None, -1.0), ("blocked", 4, 0.21)])
+def test_fused_approx_matches_two_pools(index_dir, engine, top_k, thresh):
+    found = [get_nearest_neighbors_batch(user_cap=8, n_processes=2, output_dir=index_dir, save=False,
+                                         engine=engine, block_size=7, top_k=top_k, thresh=thresh, fused=fused)
+             for fused in (False, True)]
+
+    expected = brute_force_neighbors(index_dir, thresh=max(thresh, 0.0))
+    assert found[0] == found[1]
+    for user_id, neighbors in found[1].items():
+        assert all(expected[user_id][neighbor_id] == score for neighbor_id, score in neighbors.items())
@@ -0,0 +1,47 @@
+"""
+    Checks the log readers against the edges they were written from
+"""
+# pylint: disable=missing-function-docstring, invalid-name
+import numpy as np
+import pytest
+from conftest import assert_same_index, random_edges, write_log
+from edge_log import convert_log_file, read_edge_log, read_log_edges, split_log_ranges
+from supporting_functions import create_dictionaries
+
+@pytest.mark.parametrize("n_ranges", [1, 5, 12, 30, 100])
+def test_ranges_read_every_line_once(tmp_path, n_ranges):
+    edges = random_edges(10, 4, 12, seed=11)
+    write_log(str(tmp_path / "log.csv"), edges)
+
+    read_edges = [np.column_stack(read_log_edges(log_range)[:2])
+                  for log_range in split_log_ranges(str(tmp_path / "log.csv"), n_ranges)]
+    assert np.concatenate(read_edges).tolist() == edges.tolist()
+
+def test_more_processes_than_lines(tmp_path):
+    edges = random_edges(10, 4, 12, seed=11)
+    write_log(str(tmp_path / "log.csv"), edges)
+
+    user_entity_matrix = create_dictionaries(str(tmp_path / "log.csv"), n_processes=30, save=False)[0]
+    assert user_entity_matrix.sum() == 12
+
+@pytest.mark.parametrize("with_counts", [False, True])
+def test_edge_log_matches_csv(tmp_path, with_counts):
+    edges = random_edges(30, 15, 200, seed=8)
+    write_log(str(tmp_path / "log.csv"), edges)
+    convert_log_file(str(tmp_path / "log.csv"), str(tmp_path / "log.npy"), with_counts=with_counts,
+                     n_processes=2)
+
+    edge_log = np.asarray(read_edge_log(str(tmp_path / "log.npy")))
+    counts = edge_log[:, 2] if with_counts else np.ones(len(edge_log), dtype=np.int64)
+    assert edge_log.shape[1] == (3 if with_counts else 2)
+    assert sorted(np.repeat(edge_log[:, :2], counts, axis=0).tolist()) == sorted(edges.tolist())
+
+    from_csv = create_dictionaries(str(tmp_path / "log.csv"), n_processes=2, save=False)
+    from_edge_log = create_dictionaries(str(tmp_path / "log.npy"), n_processes=2, save=False)
+    assert_same_index(from_edge_log, from_csv)
+
+def test_read_edge_log_rejects_other_arrays(tmp_path):
+    np.save(str(tmp_path / "floats.npy"), np.zeros((3, 2)))
+
+    with pytest.raises(ValueError):
+        read_edge_log(str(tmp_path / "floats.npy"))
@@ -0,0 +1,100 @@
+"""
+    Checks updating an index with delta logs against rebuilding it from every log
+"""
+# pylint: disable=missing-function-docstring, invalid-name
+import os
+import numpy as np
+import pytest
+from conftest import assert_same_index, brute_force_neighbors, random_edges, write_log
+import dictionary_based_nn
+import index_update
+from dictionary_based_nn import get_nearest_neighbors_batch
+from index_update import update_index
+from supporting_functions import (create_dictionaries, create_matrix, has_index_segments, read_index,
+                                  read_index_file, read_index_meta, reindex_log_file)
+
+def _build(tmp_path, name, log_file, one_hot=False, sparse=True):
+    output_dir = str(tmp_path / name) + "/"
+    os.makedirs(output_dir, exist_ok=True)
+    create_dictionaries(log_file, one_hot=one_hot, n_processes=2, output_dir=output_dir)
+    create_matrix(sparse=sparse, output_dir=output_dir)
+
+    return output_dir
+
+def _assert_same_dense_index(index, expected):
+    assert_same_index([index[0], index[1]], [expected[0], expected[1]])
+    assert np.abs(np.asarray(index[2]) - np.asarray(expected[2])).max() < 1e-6
+
+@pytest.mark.parametrize("one_hot", [False, True])
+def test_update_index_matches_rebuild(tmp_path, monkeypatch, one_hot):
+    monkeypatch.setattr(dictionary_based_nn, "MAX_PROCESSES", 4)
+    base = random_edges(50, 20, 300, seed=6)
+    delta = random_edges(55, 24, 80, seed=7)
+    write_log(str(tmp_path / "base.csv"), base)
+    write_log(str(tmp_path / "delta.csv"), delta)
+    write_log(str(tmp_path / "full.csv"), np.concatenate([base, delta]))
+
+    updated_dir = _build(tmp_path, "updated", str(tmp_path / "base.csv"), one_hot)
+    rebuilt_dir = _build(tmp_path, "rebuilt", str(tmp_path / "full.csv"), one_hot)
+    version = read_index_meta(updated_dir)["version"]
+    update_index(str(tmp_path / "delta.csv"), n_processes=2, output_dir=updated_dir)
+
+    assert_same_index(read_index(updated_dir), read_index(rebuilt_dir))
+    assert read_index_meta(updated_dir)["version"] > version
+    assert np.load(updated_dir + "updated_users.npy").tolist() == np.unique(delta[:, 0]).tolist()
+    for part in ("user_degrees", "entity_degrees"):
+        assert read_index_file(updated_dir + part).tolist() == read_index_file(rebuilt_dir + part).tolist()
+
+@pytest.mark.parametrize("sparse", [True, False])
+def test_updates_only_append_segments(tmp_path, monkeypatch, sparse):
+    monkeypatch.setattr(dictionary_based_nn, "MAX_PROCESSES", 4)
+    edges = random_edges(40, 60, 600, seed=12)
+    write_log(str(tmp_path / "base.csv"), edges)
+    updated_dir = _build(tmp_path, "updated", str(tmp_path / "base.csv"), sparse=sparse)
+    part_files = [updated_dir + "user_entity_dict_indices.npy", updated_dir + "entity_user_dict_data.npy",
+                  updated_dir + ("user_entity_matrix_indptr.npy" if sparse else "user_entity_matrix.npy")]
+    written = [os.stat(file_name).st_mtime_ns for file_name in part_files]
+
+    rng = np.random.RandomState(13)
+    for update in range(5):
+        if update == 3:
+            monkeypatch.setattr(index_update, "COMPACT_RATIO", 0.01)
+        delta = np.column_stack([rng.randint(0, 42 + update, 2), rng.randint(0, 61 + update, 2)])
+        write_log(str(tmp_path / "delta.csv"), delta)
+        update_index(str(tmp_path / "delta.csv"), n_processes=2, output_dir=updated_dir)
+        edges = np.concatenate([edges, delta])
+        write_log(str(tmp_path / "full.csv"), edges)
+
+        unchanged = [os.stat(file_name).st_mtime_ns for file_name in part_files] == written
+        assert unchanged == has_index_segments(updated_dir + "user_entity_dict") == (update < 3)
+        rebuilt_dir = _build(tmp_path, "rebuilt", str(tmp_path / "full.csv"), sparse=sparse)
+        _assert_same_dense_index(read_index(updated_dir), read_index(rebuilt_dir))
+
+def test_update_maps_ids_through_the_reverse_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(dictionary_based_nn, "MAX_PROCESSES", 4)
+    base = random_edges(30, 12, 200, seed=14) * 7 + 1000
+    delta = np.concatenate([base[:5], [[5, 1000], [1000, 9]]])
+    write_log(str(tmp_path / "base.csv"), base)
+    write_log(str(tmp_path / "delta.csv"), delta)
+    write_log(str(tmp_path / "full.csv"), np.concatenate([base, delta]))
+
+    dirs = []
+    for name in ("updated", "rebuilt"):
+        os.makedirs(str(tmp_path / name))
+        log_file = str(tmp_path / ("base.csv" if name == "updated" else "full.csv"))
+        reindex_log_file(log_file, n_processes=2, output_dir=str(tmp_path / name) + "/")
+        dirs.append(_build(tmp_path, name, str(tmp_path / name / "converted_logs.csv")))
+    update_index(str(tmp_path / "delta.csv"), n_processes=2, output_dir=dirs[0])
+
+    assert_same_index(read_index(dirs[0]), read_index(dirs[1]))
+    for index_type in ("user", "entity"):
+        reverse_indexes = [np.load(output_dir + index_type + "_reverse_index.npy") for output_dir in dirs]
+        assert reverse_indexes[0].tolist() == reverse_indexes[1].tolist()
+
+def test_neighbors_of_an_updated_index_match_brute_force(index_dir):
+    write_log(index_dir + "delta.csv", [(0, 1), (3, 24), (60, 3), (60, 7)])
+    update_index(index_dir + "delta.csv", n_processes=2, output_dir=index_dir)
+    assert has_index_segments(index_dir + "user_entity_matrix")
+
+    neighbors = get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir, save=False)
+    assert neighbors == brute_force_neighbors(index_dir)
@@ -0,0 +1,137 @@
+"""
+    Checks the columnar neighbor store, and the sharded writer that streams results into it
+"""
+# pylint: disable=missing-function-docstring, invalid-name
+import os
+import numpy as np
+import pytest
+from conftest import brute_force_neighbors
+import dictionary_based_nn
+from neighbor_store import get_neighbors, neighbor_store_to_dict, read_neighbor_store, read_shard_manifest
+from neighbor_store import results_to_columns
+from neighbor_store import ShardedNeighborWriter, merge_shards, patch_neighbor_store, write_neighbor_store
+from dictionary_based_nn import get_nearest_neighbors_batch
+from supporting_functions import read_pickle_file
+
+def _result_tuples(user_ids, seed):
+    """
+        Random (user_id, array of user_ids, array of similarities) tuples, as the pool workers return them
+    """
+    rng = np.random.RandomState(seed)
+    result_tuples = []
+    for user_id in user_ids:
+        n_neighbors = rng.randint(0, 6)
+        result_tuples.append((user_id, rng.choice(100, n_neighbors, replace=False),
+                              np.round(rng.rand(n_neighbors), 4)))
+
+    return result_tuples
+
+def _as_dict(result_tuples):
+    return {user_id: dict(zip(np.asarray(neighbor_ids).tolist(), np.round(scores, 4).tolist()))
+            for user_id, neighbor_ids, scores in result_tuples}
+
+@pytest.mark.parametrize("quantize", [False, True])
+def test_store_round_trip(tmp_path, quantize):
+    result_tuples = _result_tuples([5, 1, 3, 9], seed=0)
+    write_neighbor_store(results_to_columns(result_tuples), str(tmp_path), quantize=quantize)
+    store = read_neighbor_store(str(tmp_path))
+
+    assert store["user_ids"].tolist() == [1, 3, 5, 9]
+    assert neighbor_store_to_dict(store) == _as_dict(result_tuples)
+    for user_id, neighbor_ids, scores in result_tuples:
+        order = np.argsort(-scores, kind="stable")
+        found_ids, found_scores = get_neighbors(store, user_id)
+        assert np.allclose(found_scores, scores[order], atol=1e-4)
+        assert np.all(np.diff(found_scores) <= 0)
+        assert set(found_ids[:2].tolist()) <= set(neighbor_ids.tolist())
+        assert len(get_neighbors(store, user_id, n_neighbors=2)[0]) == min(2, len(neighbor_ids))
+    with pytest.raises(ValueError):
+        get_neighbors(store, 2)
+
+def test_patch_neighbor_store(tmp_path):
+    result_tuples = _result_tuples(range(6), seed=1)
+    patch = _result_tuples([2, 4, 8], seed=2)
+    write_neighbor_store(results_to_columns(result_tuples), str(tmp_path), quantize=True)
+    patch_neighbor_store(str(tmp_path), results_to_columns(patch))
+
+    expected = _as_dict(result_tuples)
+    expected.update(_as_dict(patch))
+    assert neighbor_store_to_dict(read_neighbor_store(str(tmp_path))) == expected
+    assert read_neighbor_store(str(tmp_path))["scores"].dtype == np.uint16
+
+@pytest.mark.parametrize("quantize", [False, True])
+def test_columnar_output_matches_pickle(index_dir, quantize):
+    get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir)
+    get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir, output_format="columnar",
+                                quantize=quantize)
+
+    assert neighbor_store_to_dict(read_neighbor_store(index_dir + "similarity_scores/")) == \
+           read_pickle_file(index_dir + "similarity_scores.pickle")
+
+def test_merge_shards_keeps_the_last_shard(tmp_path):
+    first = _result_tuples(range(10), seed=4)
+    second = _result_tuples(range(5, 15), seed=5)
+    for name, result_tuples in (("a", first), ("b", second)):
+        writer = ShardedNeighborWriter(str(tmp_path / name), shard_neighbors=8)
+        writer.add(result_tuples)
+        writer.close()
+
+    store = merge_shards([str(tmp_path / "a"), str(tmp_path / "b")], str(tmp_path / "merged"), quantize=True)
+    expected = _as_dict(first)
+    expected.update(_as_dict(second))
+    assert store["scores"].dtype == np.uint16
+    assert neighbor_store_to_dict(store) == expected
+
+def test_sharded_writer_resumes_after_crash(tmp_path):
+    result_tuples = _result_tuples(range(40), seed=3)
+    output_path = str(tmp_path / "shards")
+    writer = ShardedNeighborWriter(output_path, shard_neighbors=30, meta={"run": 1})
+    for i in range(0, 25, 5):
+        writer.add(result_tuples[i:i + 5])
+    written = writer.completed_user_ids()
+    del writer
+
+    assert not read_shard_manifest(output_path)["complete"]
+    assert 0 < len(written) < 25
+
+    with pytest.raises(ValueError):
+        ShardedNeighborWriter(output_path, shard_neighbors=30, meta={"run": 2}, resume=True)
+    writer = ShardedNeighborWriter(output_path, shard_neighbors=30, meta={"run": 1}, resume=True)
+    assert writer.completed_user_ids().tolist() == written.tolist()
+    writer.add([result_tuple for result_tuple in result_tuples if result_tuple[0] not in set(written)])
+    manifest = writer.close()
+
+    assert manifest["complete"] and manifest["n_users"] == 40
+    store = merge_shards([output_path], str(tmp_path / "merged"))
+    assert store["user_ids"].tolist() == list(range(40))
+    assert neighbor_store_to_dict(store) == _as_dict(result_tuples)
+
+def test_nn_run_resumes_from_checkpoints(index_dir, monkeypatch):
+    monkeypatch.setattr(dictionary_based_nn, "CHECKPOINT_SECONDS", 0)
+    n_added = []
+    add = ShardedNeighborWriter.add
+
+    def add_until_interrupted(writer, result_tuples):
+        if len(n_added) == 3:
+            raise RuntimeError("interrupted")
+        n_added.append(len(result_tuples))
+        return add(writer, result_tuples)
+
+    monkeypatch.setattr(ShardedNeighborWriter, "add", add_until_interrupted)
+    with pytest.raises(RuntimeError):
+        get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir,
+                                    output_format="columnar", checkpoint=True)
+    checkpoint_dir = index_dir + dictionary_based_nn.CHECKPOINT_DIR
+    assert read_shard_manifest(checkpoint_dir)["n_users"] == sum(n_added) < 60
+
+    def add_counted(writer, result_tuples):
+        n_added.append(len(result_tuples))
+        return add(writer, result_tuples)
+
+    monkeypatch.setattr(ShardedNeighborWriter, "add", add_counted)
+    get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir, output_format="columnar",
+                                resume=True)
+    assert sum(n_added) == 60
+    assert not os.path.exists(checkpoint_dir)
+    assert neighbor_store_to_dict(read_neighbor_store(index_dir + "similarity_scores/")) == \
+           brute_force_neighbors(index_dir)
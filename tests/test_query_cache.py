@@ -0,0 +1,60 @@
+"""
+    Checks the eviction and invalidation of the neighbor query cache
+"""
+# pylint: disable=missing-function-docstring, invalid-name
+import os
+from conftest import write_log
+from index_update import update_index
+from query_cache import NeighborCache
+from supporting_functions import read_index_meta
+
+def test_cache_evicts_least_recently_used():
+    cache = NeighborCache(max_entries=2, policy="lru")
+    cache.set_version(1)
+    cache.put((1, "approx", 5), [(2, 0.5)])
+    cache.put((2, "approx", 5), [(1, 0.5)])
+    cache.get((1, "approx", 5))
+    cache.put((3, "approx", 5), [(1, 0.1)])
+
+    assert cache.get((2, "approx", 5)) is None
+    assert cache.get((1, "approx", 5)) == [(2, 0.5)]
+    assert cache.stats()["evictions"] == 1
+
+def test_cache_evicts_least_frequently_used():
+    cache = NeighborCache(max_entries=2, policy="lfu")
+    cache.set_version(1)
+    cache.put((1, "approx", 5), [(2, 0.5)])
+    cache.put((2, "approx", 5), [(1, 0.5)])
+    cache.get((1, "approx", 5))
+    cache.get((1, "approx", 5))
+    cache.get((2, "approx", 5))
+    cache.put((3, "approx", 5), [(1, 0.1)])
+
+    assert cache.get((2, "approx", 5)) is None
+    assert cache.get((1, "approx", 5)) is not None
+    assert cache.get((3, "approx", 5)) is not None
+
+def test_cache_evicts_by_bytes():
+    cache = NeighborCache(max_bytes=2000)
+    cache.set_version(1)
+    cache.put((1, "exact", -1), [(i, 0.1) for i in range(100)])
+    assert cache.stats()["entries"] == 0
+
+    for user_id in range(20):
+        cache.put((user_id, "exact", -1), [(i, 0.1) for i in range(5)])
+    stats = cache.stats()
+    assert 0 < stats["entries"] < 20 and stats["bytes"] <= 2000
+    assert stats["evictions"] == 20 - stats["entries"]
+    assert cache.get((19, "exact", -1)) is not None
+
+def test_cache_drops_results_of_an_older_index(index_dir):
+    cache = NeighborCache(output_dir=index_dir)
+    cache.put((1, "approx", 5), [(2, 0.5)])
+    assert cache.get((1, "approx", 5)) == [(2, 0.5)]
+
+    write_log(os.path.dirname(index_dir.rstrip("/")) + "/delta.csv", [(0, 1), (60, 3)])
+    update_index(os.path.dirname(index_dir.rstrip("/")) + "/delta.csv", n_processes=2, output_dir=index_dir)
+
+    assert cache.get((1, "approx", 5)) is None
+    assert cache.stats()["invalidations"] == 1
+    assert cache.stats()["version"] == read_index_meta(index_dir)["version"]
@@ -0,0 +1,37 @@
+"""
+    Checks that the shards of an nn job split the users and add up to a single run
+"""
+# pylint: disable=missing-function-docstring, invalid-name
+import numpy as np
+import pytest
+from dictionary_based_nn import get_nearest_neighbors_batch
+from neighbor_store import neighbor_store_to_dict, read_neighbor_store
+from sharding import SHARD_SCHEMES, merge_shard_parts, shard_user_ids
+
+@pytest.mark.parametrize("shard_scheme", SHARD_SCHEMES)
+def test_shards_split_the_users(shard_scheme):
+    user_ids = np.arange(3, 100, 2)
+    shards = [shard_user_ids(user_ids, (index, 4), 100, shard_scheme) for index in range(1, 5)]
+
+    assert sorted(np.concatenate(shards).tolist()) == user_ids.tolist()
+    if shard_scheme == "range":
+        assert all(((shard >= 25 * i) & (shard < 25 * (i + 1))).all() for i, shard in enumerate(shards))
+
+@pytest.mark.parametrize("shard_scheme", ["range", "hash"])
+def test_shard_union_matches_single_run(index_dir, shard_scheme):
+    get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir, output_format="columnar")
+    expected = neighbor_store_to_dict(read_neighbor_store(index_dir + "similarity_scores/", mmap=False))
+
+    for index in (1, 2, 3):
+        get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir, shard=(index, 3),
+                                    shard_scheme=shard_scheme)
+    merge_shard_parts(index_dir)
+
+    assert len(expected) == 60
+    assert neighbor_store_to_dict(read_neighbor_store(index_dir + "similarity_scores/")) == expected
+
+def test_merge_shard_parts_needs_every_part(index_dir):
+    get_nearest_neighbors_batch(user_cap=-1, n_processes=2, output_dir=index_dir, shard=(1, 2))
+
+    with pytest.raises(ValueError):
+        merge_shard_parts(index_dir)
@@ -0,0 +1,36 @@
+"""
+    Checks the batched neighbor queries against the single user queries and the cosine similarity of every
+    pair of users
+"""
+# pylint: disable=missing-function-docstring, invalid-name
+import pytest
+from conftest import assert_top_k, brute_force_neighbors
+from supporting_functions import read_index
+from user_functions import get_neighbors_many, get_user_neighbors_above_thresh, get_user_neighbors_approx
+from user_functions import get_user_neighbors_exact
+
+SINGLE_USER_FUNCTIONS = {"exact": get_user_neighbors_exact, "approx": get_user_neighbors_approx,
+                         "above_thresh": get_user_neighbors_above_thresh}
+
+def _rounded(nearest_neighbors):
+    return {user_id: {neighbor_id: round(score, 4) for neighbor_id, score in neighbors}
+            for user_id, neighbors in nearest_neighbors.items()}
+
+@pytest.mark.parametrize("mode", ["exact", "approx", "above_thresh"])
+def test_neighbors_many_matches_brute_force(index_dir, mode):
+    index = read_index(index_dir)
+    options = {"thresh": 0.31} if mode == "above_thresh" else {"n_neighbors": 6}
+    found = get_neighbors_many(range(60), *index, mode=mode, block_size=7, **options)
+
+    if mode == "above_thresh":
+        assert _rounded(found) == brute_force_neighbors(index_dir, thresh=0.31)
+    else:
+        assert_top_k(_rounded(found), brute_force_neighbors(index_dir), 6)
+    for user_id in (0, 17, 59):
+        expected = SINGLE_USER_FUNCTIONS[mode](user_id, *index, **options)
+        assert sorted(_rounded({user_id: found[user_id]})[user_id].values()) == \
+               sorted(_rounded({user_id: expected})[user_id].values())
+
+def test_neighbors_many_rejects_unknown_users(index_dir):
+    with pytest.raises(ValueError):
+        get_neighbors_many([0, 60], *read_index(index_dir))
@@ -8,16 +8,21 @@
         get_user_neighbors_exact
         get_user_neighbors_approx
         get_user_neighbors_above_thresh
+        get_neighbors_many
 """
 import logging
-from operator import itemgetter
 import time
-from dictionary_based_nn import _strict_prune_space, _approx_prune_space
-from dictionary_based_nn import _find_similarities, _format_similarities
-from dictionary_based_nn import DEFAULT_USER_CAP
+import numpy as np
+from candidate_pruning import strict_prune_space, approx_prune_space, is_known_user, cut_off_score
+from candidate_pruning import approx_mask_products, DEFAULT_USER_CAP
+from pool_workers import find_similarities, select_similarities, top_k_positions, block_products
+from pool_workers import top_n_per_row
+from dictionary_based_nn import DEFAULT_BLOCK_SIZE
+
+QUERY_MODES = ["exact", "approx", "above_thresh"]
 
 def get_user_neighbors_exact(user_id, user_entity_dict, entity_user_dict, user_entity_matrix,
-                             n_neighbors=20, sparse=True):
+                             n_neighbors=20, sparse=True, cache=None):
     """
         Given the three needed data structures that power danny you can quickly get information about any one
         user's information. The three structures act as an index to get information about a user. This
@@ -25,47 +30,56 @@ def get_user_neighbors_exact(user_id, user_entity_dict, entity_user_dict, user_e
         about this mode in dictionary_based_nn.
 
         Params:
-            user_id               (int) : id of user whose nearest neighbors are wanted
-            user_entity_dict     (dict) : dictionary where: key – user_id | value - list of entity ids user
-                                          has visited
-            entity_user_dict     (dict) : dictionary where: key - entity_id | value - list of user ids that
-                                          have visited the entity
-            user_entity_matrix (matrix) : matrix where each row contains a user's entity visitation pattern
-                                          encoded as a count vector. Each column contains each entity's user
-                                          vistiation record encoded as a count vector. Can be sparse.
-            n_neighbors           (int) : number of neighbors requested
-            sparse               (bool) : is the matrix a sparse one or not
+            user_id                 (int) : id of user whose nearest neighbors are wanted
+            user_entity_dict (csr_matrix) : user-entity dictionary, row user_id holds the entity ids user
+                                            has visited
+            entity_user_dict (csc_matrix) : entity-user dictionary, column entity_id holds the user ids that
+                                            have visited the entity
+            user_entity_matrix   (matrix) : matrix where each row contains a user's entity visitation pattern
+                                            encoded as a count vector. Each column contains each entity's user
+                                            vistiation record encoded as a count vector. Can be sparse.
+            n_neighbors             (int) : number of neighbors requested
+            sparse                 (bool) : is the matrix a sparse one or not
+            cache         (NeighborCache) : query_cache.NeighborCache to look the result up in and store it
+                                            in, None computes it every time
 
         Returns:
             arr : each element is a tuple (user_id, dot_product) representing the n closest neighbors in
                   order from closest to furthest
     """
     # pylint: disable=too-many-arguments, too-many-locals
-    if user_id not in user_entity_dict:
+    if not is_known_user(user_id, user_entity_dict):
         raise ValueError("The user_id passed in is not found in the user_entity_dict")
 
-    start_time = time.time()
-    relevant_users = _strict_prune_space(user_id, user_entity_dict, entity_user_dict)
+    if cache is not None:
+        cached = cache.get((user_id, "exact", n_neighbors))
+        if cached is not None:
+            return cached
 
-    users_to_compare_to = list(relevant_users.keys())
+    start_time = time.time()
+    users_to_compare_to = strict_prune_space(user_id, user_entity_dict, entity_user_dict).tolist()
 
     logging.info("Took %s seconds to prune search space", time.time() - start_time)
     start_time = time.time()
-    
-    results = _find_similarities(user_id, user_entity_matrix, users_to_compare_to, sparse)
+
+    results = find_similarities(user_id, user_entity_matrix, users_to_compare_to, sparse)
 
     logging.info("Took %s seconds to preform needed dot products", time.time() - start_time)
     start_time = time.time()
 
-    results_dict = _format_similarities(users_to_compare_to, results)
+    similar_users, similarities = select_similarities(users_to_compare_to, results)
 
-    nearest_neighbors = sorted(results_dict.items(), key=itemgetter(1), reverse=True)[:n_neighbors]
+    order = top_k_positions(similarities, n_neighbors)
+    nearest_neighbors = list(zip(similar_users[order].tolist(), similarities[order].tolist()))
     logging.info("Took %s seconds to get number of requested neighbors", time.time() - start_time)
 
+    if cache is not None:
+        cache.put((user_id, "exact", n_neighbors), nearest_neighbors)
+
     return nearest_neighbors
 
 def get_user_neighbors_approx(user_id, user_entity_dict, entity_user_dict, user_entity_matrix,
-                              n_neighbors=20, sparse=True):
+                              n_neighbors=20, sparse=True, cache=None):
     """
         Given the three needed data structures that power danny you can quickly get information about any one
         user's given information. The three structures act as an index to get information about a user. This
@@ -74,102 +88,183 @@ def get_user_neighbors_approx(user_id, user_entity_dict, entity_user_dict, user_
             * In practice I have seen this work faster than its exact counterpart
 
         Params:
-            user_id               (int) : id of user whose nearest neighbors are wanted
-            user_entity_dict     (dict) : dictionary where: key – user_id | value - list of entity ids user
-                                          has visited
-            entity_user_dict     (dict) : dictionary where: key - entity_id | value - list of user ids that
-                                          have visited the entity
-            user_entity_matrix (matrix) : matrix where each row contains a user's entity visitation pattern
-                                          encoded as a count vector. Each column contains each entity's user
-                                          vistiation record encoded as a count vector. Can be sparse.
-            n_neighbors           (int) : number of neighbors requested
-            sparse               (bool) : is the matrix a sparse one or not
+            user_id                 (int) : id of user whose nearest neighbors are wanted
+            user_entity_dict (csr_matrix) : user-entity dictionary, row user_id holds the entity ids user
+                                            has visited
+            entity_user_dict (csc_matrix) : entity-user dictionary, column entity_id holds the user ids that
+                                            have visited the entity
+            user_entity_matrix   (matrix) : matrix where each row contains a user's entity visitation pattern
+                                            encoded as a count vector. Each column contains each entity's user
+                                            vistiation record encoded as a count vector. Can be sparse.
+            n_neighbors             (int) : number of neighbors requested
+            sparse                 (bool) : is the matrix a sparse one or not
+            cache         (NeighborCache) : query_cache.NeighborCache to look the result up in and store it
+                                            in, None computes it every time
 
         Returns:
             arr : each element is a tuple (user_id, dot_product) representing the n closest neighbors in
                   order
     """
     # pylint: disable=too-many-arguments, too-many-locals, too-many-branches
-    if user_id not in user_entity_dict:
+    if not is_known_user(user_id, user_entity_dict):
         raise ValueError("The user_id passed in is not found in the user_entity_dict")
 
+    if cache is not None:
+        cached = cache.get((user_id, "approx", n_neighbors))
+        if cached is not None:
+            return cached
+
     start_time = time.time()
-    relevant_users = _approx_prune_space(user_id, user_entity_dict, entity_user_dict)
+    relevant_users, scores = approx_prune_space(user_id, user_entity_dict, entity_user_dict)
     if len(relevant_users) > DEFAULT_USER_CAP:
-        sorted_users = sorted(relevant_users.items(), key=itemgetter(1), reverse=True)
-        cut_off_value = sorted_users[DEFAULT_USER_CAP - 1][1]
-        users_to_compare_to = []
-        for tup in sorted_users:
-            if tup[1] >= cut_off_value:
-                users_to_compare_to.append(tup[0])
-            else:
-                break
+        cut_off_value = cut_off_score(scores, DEFAULT_USER_CAP)
+        users_to_compare_to = relevant_users[scores >= cut_off_value].tolist()
     else:
-        users_to_compare_to = list(relevant_users.keys())
+        users_to_compare_to = relevant_users.tolist()
 
     logging.info("Took %s seconds to prune search space", time.time() - start_time)
     start_time = time.time()
 
-    results = _find_similarities(user_id, user_entity_matrix, users_to_compare_to, sparse)
+    results = find_similarities(user_id, user_entity_matrix, users_to_compare_to, sparse)
 
     logging.info("Took %s seconds to preform needed dot products", time.time() - start_time)
     start_time = time.time()
 
-    results_dict = _format_similarities(users_to_compare_to, results)
+    similar_users, similarities = select_similarities(users_to_compare_to, results)
 
-    nearest_neighbors = sorted(results_dict.items(), key=itemgetter(1), reverse=True)[:n_neighbors]
+    order = top_k_positions(similarities, n_neighbors)
+    nearest_neighbors = list(zip(similar_users[order].tolist(), similarities[order].tolist()))
     logging.info("Took %s seconds to get number of requested neighbors", time.time() - start_time)
 
+    if cache is not None:
+        cache.put((user_id, "approx", n_neighbors), nearest_neighbors)
+
     return nearest_neighbors
 
 def get_user_neighbors_above_thresh(user_id, user_entity_dict, entity_user_dict, user_entity_matrix,
-                                    thresh=0.9, sparse=True, sort=False):
+                                    thresh=0.9, sparse=True, sort=False, cache=None):
     """
         Given the three needed data structures that power danny you can quickly get information about any one
         user's given information. The three structures act as an index to get information about a user. This
         function returns all users who are within a certain distance of a user.
 
         Params:
-            user_id               (int) : id of user whose nearest neighbors are wanted
-            user_entity_dict     (dict) : dictionary where: key – user_id | value - list of entity ids user
-                                          has visited
-            entity_user_dict     (dict) : dictionary where: key - entity_id | value - list of user ids that
-                                          have visited the entity
-            user_entity_matrix (matrix) : matrix where each row contains a user's entity visitation pattern
-                                          encoded as a count vector. Each column contains each entity's user
-                                          vistiation record encoded as a count vector. Can be sparse.
-            thresh              (float) : minimum dot product required for a user to be considered close
-            sparse               (bool) : is the matrix a sparse one or not
-            sort                 (bool) : return the users sorted by the closest to furthest
+            user_id                 (int) : id of user whose nearest neighbors are wanted
+            user_entity_dict (csr_matrix) : user-entity dictionary, row user_id holds the entity ids user
+                                            has visited
+            entity_user_dict (csc_matrix) : entity-user dictionary, column entity_id holds the user ids that
+                                            have visited the entity
+            user_entity_matrix   (matrix) : matrix where each row contains a user's entity visitation pattern
+                                            encoded as a count vector. Each column contains each entity's user
+                                            vistiation record encoded as a count vector. Can be sparse.
+            thresh                (float) : minimum dot product required for a user to be considered close
+            sparse                 (bool) : is the matrix a sparse one or not
+            sort                   (bool) : return the users sorted by the closest to furthest
+            cache         (NeighborCache) : query_cache.NeighborCache to look the result up in and store it
+                                            in, None computes it every time
 
         Returns:
             arr : each element is a tuple (user_id, dot_product) representing all neighbors within a certain
                   distance from the passed in user
     """
     # pylint: disable=too-many-arguments, too-many-locals
-    if user_id not in user_entity_dict:
+    if not is_known_user(user_id, user_entity_dict):
         raise ValueError("The user_id passed in is not found in the user_entity_dict")
 
-    start_time = time.time()
-    relevant_users = _strict_prune_space(user_id, user_entity_dict, entity_user_dict)
+    if cache is not None:
+        cached = cache.get((user_id, "above_thresh", thresh, sort))
+        if cached is not None:
+            return cached
 
-    users_to_compare_to = list(relevant_users.keys())
+    start_time = time.time()
+    users_to_compare_to = strict_prune_space(user_id, user_entity_dict, entity_user_dict).tolist()
 
     logging.info("Took %s seconds to prune search space", time.time() - start_time)
     start_time = time.time()
-    
-    results = _find_similarities(user_id, user_entity_matrix, users_to_compare_to, sparse)
+
+    results = find_similarities(user_id, user_entity_matrix, users_to_compare_to, sparse)
 
     logging.info("Took %s seconds to preform needed dot products", time.time() - start_time)
     start_time = time.time()
 
-    results_dict = _format_similarities(users_to_compare_to, results, thresh=thresh)
+    similar_users, similarities = select_similarities(users_to_compare_to, results, thresh=thresh)
 
     if sort:
-        nearest_neighbors = sorted(results_dict.items(), key=itemgetter(1), reverse=True)
-    else:
-        nearest_neighbors = results_dict.items()
-    
+        order = top_k_positions(similarities, len(similarities))
+        similar_users = similar_users[order]
+        similarities = similarities[order]
+
+    nearest_neighbors = list(zip(similar_users.tolist(), similarities.tolist()))
+
     logging.info("Took %s seconds to get number of requested neighbors", time.time() - start_time)
 
+    if cache is not None:
+        cache.put((user_id, "above_thresh", thresh, sort), nearest_neighbors)
+
+    return nearest_neighbors
+
+def get_neighbors_many(user_ids, user_entity_dict, entity_user_dict, user_entity_matrix, mode="approx",
+                       n_neighbors=20, thresh=0.9, sparse=True, block_size=DEFAULT_BLOCK_SIZE):
+    """
+        Batched form of the three functions above, for when many users are looked up at once. Instead of
+        pruning, slicing the matrix and doing a mat-vec once per user, each block of users gets one sparse
+        product with the whole matrix (which only has entries for the users sharing an entity with a user
+        in the block), approximate mode prunes the whole block at once, and the top neighbors of every row
+        are selected together. The results are the same as the single user functions', except that users
+        tied on a score are ordered by user_id, and a dot product computed in a different order can differ
+        in its last bit, which can only matter for a user exactly at thresh.
+
+        Params:
+            user_ids                (arr) : ids of users whose nearest neighbors are wanted
+            user_entity_dict (csr_matrix) : user-entity dictionary, row user_id holds the entity ids user
+                                            has visited
+            entity_user_dict (csc_matrix) : entity-user dictionary, column entity_id holds the user ids that
+                                            have visited the entity
+            user_entity_matrix   (matrix) : matrix where each row contains a user's entity visitation pattern
+                                            encoded as a count vector. Each column contains each entity's user
+                                            vistiation record encoded as a count vector. Can be sparse.
+            mode                    (str) : one of QUERY_MODES, which of the functions above to match
+            n_neighbors             (int) : number of neighbors requested, not used by "above_thresh"
+            thresh                (float) : minimum dot product, only used by "above_thresh"
+            sparse                 (bool) : is the matrix a sparse one or not
+            block_size              (int) : number of users per sparse product
+
+        Returns:
+            dict : key - user_id | value - list of (user_id, dot_product) tuples as returned by the function
+                   matching mode, from closest to furthest (the "above_thresh" results are always sorted)
+    """
+    # pylint: disable=too-many-arguments, too-many-locals
+    if mode not in QUERY_MODES:
+        raise ValueError("mode must be one of {}".format(QUERY_MODES))
+
+    user_ids = np.unique(np.asarray(user_ids, dtype=np.int64))
+    in_range = (user_ids >= 0) & (user_ids < user_entity_dict.shape[0])
+    known = in_range.copy()
+    known[in_range] = np.diff(user_entity_dict.indptr)[user_ids[in_range]] > 0
+    if not known.all():
+        raise ValueError("The user_ids {} are not found in the user_entity_dict".format(
+            user_ids[~known][:10].tolist()))
+
+    start_time = time.time()
+    matrix_t = user_entity_matrix.T.tocsr() if sparse else None
+    n_neighbors = None if mode == "above_thresh" else n_neighbors
+    thresh = thresh if mode == "above_thresh" else -1.0
+
+    nearest_neighbors = {}
+    for start in range(0, len(user_ids), block_size):
+        block = user_ids[start:start + block_size]
+        products = block_products(block, user_entity_matrix, matrix_t, sparse)
+        if mode == "approx":
+            products = approx_mask_products(products, block, user_entity_dict, entity_user_dict,
+                                            DEFAULT_USER_CAP)
+
+        indptr, similar_users, similarities = top_n_per_row(products, n_neighbors, thresh)
+        similar_users = similar_users.tolist()
+        similarities = similarities.tolist()
+        for i, user_id in enumerate(block.tolist()):
+            nearest_neighbors[user_id] = list(zip(similar_users[indptr[i]:indptr[i + 1]],
+                                                  similarities[indptr[i]:indptr[i + 1]]))
+
+    logging.info("Took %s seconds to find the neighbors of %s users", time.time() - start_time, len(user_ids))
+
     return nearest_neighbors